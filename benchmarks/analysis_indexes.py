@@ -0,0 +1,152 @@
+"""
+Бенчмарк индексов таблицы analysis.
+
+Заполняет отдельную БД синтетическими анализами, снимает планы (EXPLAIN)
+и задержки запросов из handlers/analyses.py сначала без индексов, затем
+с индексами из db.py.
+
+    python -m benchmarks.analysis_indexes --rows 10000000 --users 10000
+    BENCH_DATABASE_URL=mysql+aiomysql://... python -m benchmarks.analysis_indexes
+
+ВНИМАНИЕ: таблица analysis в целевой БД пересоздаётся. Не указывайте
+рабочую базу.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+BENCH_DATABASE_URL = os.getenv("BENCH_DATABASE_URL", "sqlite+aiosqlite:///bench_analysis.db")
+os.environ.setdefault("DATABASE_URL", BENCH_DATABASE_URL)
+
+from sqlalchemy import select, func, desc, insert, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from db import Analysis
+
+GROUPS = {
+    f"Группа {g}": [f"Анализ {g}-{n}" for n in range(10)]
+    for g in range(5)
+}
+TABLE = Analysis.__table__
+
+
+def user_queries(telegram_id: int, name: str, day: date):
+    """Запросы из хендлеров просмотра анализов для одного пользователя"""
+    latest = select(
+        Analysis.name, func.max(Analysis.date).label("max_date")
+    ).where(Analysis.telegram_id == telegram_id).group_by(Analysis.name).subquery()
+    return {
+        "all_msg": select(Analysis.name, Analysis.result, Analysis.reference, Analysis.date).join(
+            latest, (Analysis.name == latest.c.name) & (Analysis.date == latest.c.max_date)
+        ).where(Analysis.telegram_id == telegram_id),
+        "view_analysis": select(Analysis).where(
+            Analysis.telegram_id == telegram_id, Analysis.name == name
+        ).order_by(desc(Analysis.date)),
+        "date_list": select(Analysis.date).where(
+            Analysis.telegram_id == telegram_id
+        ).distinct().order_by(desc(Analysis.date)),
+        "view_date": select(Analysis.name, Analysis.result, Analysis.reference).where(
+            Analysis.telegram_id == telegram_id, Analysis.date == day
+        ),
+        "groups": select(Analysis.group_name).where(Analysis.telegram_id == telegram_id).distinct(),
+    }
+
+
+async def seed(engine, rows: int, users: int, batch: int):
+    async with engine.begin() as conn:
+        await conn.run_sync(lambda c: TABLE.drop(c, checkfirst=True))
+        await conn.run_sync(lambda c: TABLE.create(c))
+        await conn.run_sync(lambda c: [ix.drop(c) for ix in TABLE.indexes])
+
+    rnd = random.Random(42)
+    pairs = [(g, n) for g, names in GROUPS.items() for n in names]
+    start = date(2015, 1, 1)
+    done = 0
+    t0 = time.perf_counter()
+    while done < rows:
+        size = min(batch, rows - done)
+        chunk = []
+        for i in range(size):
+            group, name = rnd.choice(pairs)
+            chunk.append({
+                "telegram_id": (done + i) % users + 1,
+                "name": name,
+                "group_name": group,
+                "reference": "3.5-5.5",
+                "units": "ммоль/л",
+                "result": f"{rnd.uniform(2, 7):.2f}",
+                "date": start + timedelta(days=rnd.randrange(3650)),
+            })
+        async with engine.begin() as conn:
+            await conn.execute(insert(TABLE), chunk)
+        done += size
+        print(f"\rзаписано {done}/{rows}", end="", flush=True)
+    print(f"\nзаполнение: {time.perf_counter() - t0:.1f} с")
+
+
+async def explain(conn, stmt) -> str:
+    compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    res = await conn.execute(text(prefix + str(compiled)))
+    return "\n".join("    " + " | ".join(str(v) for v in row) for row in res.all())
+
+
+async def measure(engine, users: int, repeat: int, label: str):
+    print(f"\n===== {label} =====")
+    rnd = random.Random(7)
+    names = [n for ns in GROUPS.values() for n in ns]
+    samples = [
+        (rnd.randint(1, users), rnd.choice(names), date(2015, 1, 1) + timedelta(days=rnd.randrange(3650)))
+        for _ in range(repeat)
+    ]
+    async with engine.connect() as conn:
+        for key, stmt in user_queries(*samples[0]).items():
+            print(f"\n[{key}] план:\n{await explain(conn, stmt)}")
+        print()
+        for key in user_queries(*samples[0]):
+            timings = []
+            for sample in samples:
+                stmt = user_queries(*sample)[key]
+                t0 = time.perf_counter()
+                (await conn.execute(stmt)).all()
+                timings.append((time.perf_counter() - t0) * 1000)
+            timings.sort()
+            p95 = timings[int(len(timings) * 0.95) - 1] if len(timings) >= 20 else timings[-1]
+            print(f"[{key}] p50={statistics.median(timings):.2f} мс p95={p95:.2f} мс max={timings[-1]:.2f} мс")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--batch", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=50, help="запросов на каждый сценарий")
+    parser.add_argument("--skip-seed", action="store_true", help="использовать уже заполненную таблицу")
+    args = parser.parse_args()
+
+    engine = create_async_engine(BENCH_DATABASE_URL)
+    if not args.skip_seed:
+        await seed(engine, args.rows, args.users, args.batch)
+    else:
+        async with engine.begin() as conn:
+            await conn.run_sync(lambda c: [ix.drop(c, checkfirst=True) for ix in TABLE.indexes])
+
+    await measure(engine, args.users, args.repeat, "без индексов")
+
+    t0 = time.perf_counter()
+    async with engine.begin() as conn:
+        await conn.run_sync(lambda c: [ix.create(c) for ix in TABLE.indexes])
+        if conn.dialect.name == "sqlite":
+            await conn.execute(text("ANALYZE"))
+    print(f"\nпостроение индексов: {time.perf_counter() - t0:.1f} с")
+
+    await measure(engine, args.users, args.repeat, "с индексами")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
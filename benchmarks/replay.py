@@ -0,0 +1,530 @@
+"""
+Бенчмарк полного цикла обработки апдейтов.
+
+Прогоняет синтетические апдейты через настоящий Dispatcher из bot.py:
+middlewares, FSM-хранилище, роутеры и хендлеры работают как в проде,
+а вместо Telegram подставлена фейковая сессия бота без сети. Сценарии
+повторяют действия пользователя целиком (ввод данных, добавление
+анализов, выгрузки, назначения, загрузка обследования); кнопки
+«нажимаются» по клавиатурам, которые бот реально отправил.
+
+    python -m benchmarks.replay --users 200 --history 500
+    python -m benchmarks.replay --flows all_msg all_pdf --history 5000 --handlers
+    python -m benchmarks.replay --mixed --users 300
+    REPLAY_DATABASE_URL=mysql+aiomysql://... python -m benchmarks.replay
+
+По каждому сценарию печатаются апдейты/с и p50/p95/p99 времени
+обработки одного апдейта. Рабочие файлы (SQLite, загрузки) создаются во
+временном каталоге.
+
+ВНИМАНИЕ: все таблицы целевой БД пересоздаются. Не указывайте рабочую базу.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from collections import Counter
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Any, AsyncGenerator, Dict, List, Optional, Union
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, File, InlineKeyboardMarkup, InputFile, Message, User
+from aiogram.types import Document as TgDocument
+
+from services.reference import reference_columns
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_ID = 100000
+BOT_TOKEN = f"{BOT_ID}:replay-benchmark-token"
+
+# Справочник анализов и сиды истории
+GROUPS = {
+    f"Группа {g}": [f"Анализ {g}-{n}" for n in range(10)]
+    for g in range(5)
+}
+
+
+# ---------------- фейковый Telegram ----------------
+
+class ReplaySession(BaseSession):
+    """
+    Сессия бота без сети: отвечает на методы Bot API правдоподобными
+    объектами, вычитывает отправляемые файлы и запоминает последнюю
+    inline-клавиатуру в каждом чате, чтобы сценарий мог по ней «нажать».
+    """
+
+    def __init__(self, latency_ms: float = 0.0):
+        super().__init__()
+        self.latency = latency_ms / 1000
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self.bytes_downloaded = 0
+        self._message_ids: Dict[int, int] = {}
+        self._keyboards: Dict[int, Message] = {}
+        self._files: Dict[str, int] = {}
+        self._bot_user = User(id=BOT_ID, is_bot=True, first_name="Replay")
+
+    def next_message_id(self, chat_id: int) -> int:
+        self._message_ids[chat_id] = self._message_ids.get(chat_id, 0) + 1
+        return self._message_ids[chat_id]
+
+    def register_file(self, file_id: str, size: int):
+        self._files[file_id] = size
+
+    def last_keyboard(self, chat_id: int) -> Optional[Message]:
+        return self._keyboards.get(chat_id)
+
+    def _remember(self, chat_id: int, message_id: int, text: Optional[str], markup: Any, **fields) -> Message:
+        message = Message(
+            message_id=message_id,
+            date=datetime.now(),
+            chat=Chat(id=chat_id, type="private"),
+            from_user=self._bot_user,
+            text=text,
+            reply_markup=markup if isinstance(markup, InlineKeyboardMarkup) else None,
+            **fields,
+        )
+        if isinstance(markup, InlineKeyboardMarkup):
+            self._keyboards[chat_id] = message
+        elif chat_id in self._keyboards and self._keyboards[chat_id].message_id == message_id:
+            # Клавиатуру у этого сообщения убрали
+            del self._keyboards[chat_id]
+        return message
+
+    async def _consume(self, bot: Bot, method: TelegramMethod):
+        for name in type(method).model_fields:
+            value = getattr(method, name, None)
+            if isinstance(value, InputFile):
+                async for chunk in value.read(bot):
+                    self.bytes_sent += len(chunk)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None):
+        name = type(method).__name__
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if name in ("SendMessage", "SendDocument", "SendPhoto"):
+            await self._consume(bot, method)
+            chat_id = int(method.chat_id)
+            message_id = self.next_message_id(chat_id)
+            fields = {}
+            if name == "SendDocument":
+                # Повторная отправка по file_id приходит строкой — её и возвращаем
+                file_id = method.document if isinstance(method.document, str) else f"sent-{chat_id}-{message_id}"
+                fields["document"] = TgDocument(file_id=file_id, file_unique_id=file_id)
+            return self._remember(
+                chat_id, message_id,
+                getattr(method, "text", None) or getattr(method, "caption", None),
+                method.reply_markup, **fields,
+            )
+        if name in ("EditMessageText", "EditMessageReplyMarkup", "EditMessageCaption", "EditMessageMedia"):
+            await self._consume(bot, method)
+            return self._remember(
+                int(method.chat_id), method.message_id,
+                getattr(method, "text", None), method.reply_markup,
+            )
+        if name == "GetFile":
+            return File(
+                file_id=method.file_id,
+                file_unique_id=method.file_id,
+                file_size=self._files.get(method.file_id, 0),
+                file_path=f"documents/{method.file_id}",
+            )
+        if name in ("AnswerCallbackQuery", "DeleteMessage", "SendChatAction"):
+            return True
+        raise NotImplementedError(f"ReplaySession: метод {name} не поддержан")
+
+    async def stream_content(
+        self,
+        url: str,
+        headers: Optional[Dict[str, Any]] = None,
+        timeout: int = 30,
+        chunk_size: int = 65536,
+        raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        file_id = url.rsplit("/", 1)[-1]
+        left = self._files.get(file_id, 0)
+        chunk = os.urandom(min(chunk_size, max(left, 1)))
+        while left > 0:
+            part = chunk[:min(chunk_size, left)]
+            self.bytes_downloaded += len(part)
+            left -= len(part)
+            yield part
+
+    async def close(self) -> None:
+        pass
+
+
+# ---------------- сценарии ----------------
+
+@dataclass
+class Text:
+    text: str
+
+
+@dataclass
+class Press:
+    """Нажатие кнопки последней inline-клавиатуры: по тексту или по номеру"""
+    button: Union[str, int]
+
+
+@dataclass
+class Document:
+    file_name: str = "scan.pdf"
+
+
+Step = Union[Text, Press, Document]
+
+FLOWS: Dict[str, List[Step]] = {
+    "profile": [
+        Text("📝 Данные пользователя"), Text("🖊 Ввести данные"), Text("Иванов Иван Иванович"),
+        Press("Снижение веса"), Text("Бег, 3 раза в неделю"), Text("180"), Text("80"),
+        Press("Нет"), Press("Нет"), Text("Нет"), Text("Диабет у родителей"), Text("Жалоб нет"),
+        # удаляем, чтобы следующий круг снова мог ввести профиль
+        Text("❌ Удалить данные"), Text("Да"),
+    ],
+    "add_analysis": [
+        Text("🧪 Анализы"), Text("➕ Добавить анализ"), Text("15.02.2025"),
+        Press(0), Press(0), Press(0), Text("5.6"),
+        Press(1), Press(1), Press(0), Text("4,2"), Text("4.2"),
+        Press("✅ Закончить ввод"),
+    ],
+    "bulk_analysis": [
+        Text("🧪 Анализы"), Text("📥 Добавить списком"), Text("15.02.2025"),
+        Text("\n".join(
+            [f"Анализ {g}-{n} {4 + n / 10:.1f} ммоль/л" for g in range(3) for n in range(3)] + ["Анализ 4-4 90"]
+        )),
+        Press(1),  # у строки без единицы два варианта — выбираем мг/дл
+    ],
+    "all_msg": [Text("📋 Посмотреть анализы"), Press("Все анализы"), Press("Сообщением")],
+    "all_pdf": [Text("📋 Посмотреть анализы"), Press("Все анализы"), Press("PDF")],
+    "trend": [
+        Text("📋 Посмотреть анализы"), Press("Динамика"), Press(0), Press(0), Press("📈 График"),
+    ],
+    "appointment": [
+        Text("💊 Назначения врачей"), Text("➕ Добавить назначение"), Text("01.03.2025"),
+        Text("Терапевт"), Text("Витамин D 2000 МЕ ежедневно"),
+        Press("➕ Ещё от этого врача"), Text("Контроль анализов через месяц"), Press("✅ Готово"),
+    ],
+    "examination": [
+        Text("🩻 Обследования"), Text("➕ Добавить обследование"), Text("УЗИ брюшной полости"),
+        Text("15.02.2025"), Text("Без патологии"), Document(),
+        # Скачивание дважды: второй раз файл уходит по сохранённому file_id
+        Text("📋 Посмотреть обследования"), Press(0), Press("📎 Скачать файл"),
+        Text("📋 Посмотреть обследования"), Press(0), Press("📎 Скачать файл"),
+    ],
+}
+
+
+class ScriptError(Exception):
+    pass
+
+
+class Replayer:
+    """Собирает сырые апдейты по шагам сценария и скармливает их диспетчеру"""
+
+    def __init__(self, dp, bot: Bot, session: ReplaySession, file_size: int):
+        self.dp = dp
+        self.bot = bot
+        self.session = session
+        self.file_size = file_size
+        self._update_id = 0
+
+    def _next_update_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    @staticmethod
+    def _user(user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": "Пользователь", "username": f"user{user_id}"}
+
+    def _message(self, user_id: int, **fields) -> Dict[str, Any]:
+        return {
+            "update_id": self._next_update_id(),
+            "message": {
+                "message_id": self.session.next_message_id(user_id),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id),
+                **fields,
+            },
+        }
+
+    def build(self, user_id: int, step: Step) -> Dict[str, Any]:
+        if isinstance(step, Text):
+            return self._message(user_id, text=step.text)
+        if isinstance(step, Document):
+            file_id = f"doc-{user_id}-{self._update_id + 1}"
+            self.session.register_file(file_id, self.file_size)
+            return self._message(user_id, document={
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_name": step.file_name,
+                "mime_type": "application/pdf",
+                "file_size": self.file_size,
+            })
+
+        message = self.session.last_keyboard(user_id)
+        if message is None:
+            raise ScriptError(f"нет клавиатуры для нажатия {step.button!r}")
+        buttons = [b for row in message.reply_markup.inline_keyboard for b in row]
+        if isinstance(step.button, int):
+            if step.button >= len(buttons):
+                raise ScriptError(f"в клавиатуре нет кнопки №{step.button}")
+            button = buttons[step.button]
+        else:
+            button = next((b for b in buttons if b.text == step.button), None)
+            if button is None:
+                raise ScriptError(f"в клавиатуре нет кнопки {step.button!r}")
+        raw_message = message.model_dump(mode="json", by_alias=True, exclude_none=True)
+        return {
+            "update_id": self._next_update_id(),
+            "callback_query": {
+                "id": str(self._update_id),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "message": raw_message,
+                "data": button.callback_data,
+            },
+        }
+
+    async def feed(self, user_id: int, step: Step) -> float:
+        raw = self.build(user_id, step)
+        started = time.perf_counter()
+        result = await self.dp.feed_raw_update(self.bot, raw)
+        elapsed = (time.perf_counter() - started) * 1000
+        if result is UNHANDLED:
+            raise ScriptError(f"апдейт не обработан ни одним хендлером: {step}")
+        return elapsed
+
+
+# ---------------- подготовка БД ----------------
+
+async def prepare_db(db, users: List[int], history: int, appointments: int, batch: int = 5000):
+    from sqlalchemy import insert
+    from services.analysis_latest import rebuild as rebuild_latest  # импортирует db — только после настройки окружения
+
+    async with db.engine.begin() as conn:
+        await conn.run_sync(db.Base.metadata.drop_all)
+    await db.init_db()
+
+    rnd = random.Random(42)
+    catalog_rows = []
+    for group, names in GROUPS.items():
+        for name in names:
+            catalog_rows.append(dict(
+                name=name, group_name=group, unit="ммоль/л", standard_unit="ммоль/л",
+                reference_values="3.5-5.5", standard_reference="3.5-5.5", conversion_to_standard=1.0,
+            ))
+            catalog_rows.append(dict(
+                name=name, group_name=group, unit="мг/дл", standard_unit="ммоль/л",
+                reference_values="63-99", standard_reference="3.5-5.5", conversion_to_standard=0.0555,
+            ))
+
+    pairs = [(g, n) for g, names in GROUPS.items() for n in names]
+    start = date(2015, 1, 1)
+
+    def analyses():
+        for user_id in users:
+            for _ in range(history):
+                group, name = rnd.choice(pairs)
+                result = f"{rnd.uniform(2, 7):.2f}"
+                yield dict(
+                    telegram_id=user_id, name=name, group_name=group, reference="3.5-5.5",
+                    units="ммоль/л", result=result,
+                    date=start + timedelta(days=rnd.randrange(3650)),
+                    **reference_columns(result, "3.5-5.5"),
+                )
+
+    def doctor_appointments():
+        for user_id in users:
+            for i in range(appointments):
+                yield dict(
+                    telegram_id=user_id, appointment_date=start + timedelta(days=rnd.randrange(3650)),
+                    doctor=rnd.choice(("Терапевт", "Кардиолог", "Эндокринолог")),
+                    recommendation=f"Назначение №{i}", created_at=datetime.utcnow(),
+                )
+
+    async def bulk(table, rows):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= batch:
+                async with db.engine.begin() as conn:
+                    await conn.execute(insert(table), chunk)
+                chunk = []
+        if chunk:
+            async with db.engine.begin() as conn:
+                await conn.execute(insert(table), chunk)
+
+    t0 = time.perf_counter()
+    await bulk(db.AnalyzesMem.__table__, catalog_rows)
+    await bulk(db.Analysis.__table__, analyses())
+    await bulk(db.DoctorAppointment.__table__, doctor_appointments())
+    await rebuild_latest(db.async_session)
+    print(
+        f"БД: {len(users)} польз. × {history} анализов, {appointments} назначений "
+        f"— заполнение {time.perf_counter() - t0:.1f} с"
+    )
+
+
+# ---------------- прогон и отчёт ----------------
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(q * len(values))) - 1))
+    return values[index]
+
+
+async def run_flow(replayer: Replayer, flow: str, users: List[int], rounds: int, concurrency: int):
+    steps = FLOWS[flow]
+    timings: List[float] = []
+    errors = Counter()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def play(user_id: int):
+        async with slots:
+            for _ in range(rounds):
+                for step in steps:
+                    try:
+                        timings.append(await replayer.feed(user_id, step))
+                    except ScriptError as e:
+                        errors[str(e)] += 1
+                        break
+                    except Exception:
+                        errors[traceback.format_exc(limit=-3)] += 1
+                        break
+
+    started = time.perf_counter()
+    await asyncio.gather(*(play(u) for u in users))
+    wall = time.perf_counter() - started
+    timings.sort()
+    return {
+        "flow": flow,
+        "updates": len(timings),
+        "ups": len(timings) / wall if wall else 0.0,
+        "p50": percentile(timings, 0.50),
+        "p95": percentile(timings, 0.95),
+        "p99": percentile(timings, 0.99),
+        "max": timings[-1] if timings else 0.0,
+        "errors": errors,
+    }
+
+
+def print_report(results, session: ReplaySession):
+    print(f"\n{'сценарий':<14}{'апдейтов':>10}{'апд/с':>10}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}{'ошибок':>8}")
+    for r in results:
+        print(
+            f"{r['flow']:<14}{r['updates']:>10}{r['ups']:>10.1f}{r['p50']:>10.2f}"
+            f"{r['p95']:>10.2f}{r['p99']:>10.2f}{r['max']:>10.2f}{sum(r['errors'].values()):>8}"
+        )
+    for r in results:
+        for error, count in r["errors"].most_common(3):
+            print(f"\n[{r['flow']}] ×{count}: {error}")
+
+    calls = ", ".join(f"{k}={v}" for k, v in session.calls.most_common())
+    print(f"\nBot API: {calls}")
+    print(f"отправлено файлов: {session.bytes_sent / 1024 / 1024:.1f} МБ, "
+          f"скачано: {session.bytes_downloaded / 1024 / 1024:.1f} МБ")
+
+
+def print_handlers(snapshot):
+    print(f"\n{'хендлер':<62}{'n':>7}{'p95 мс':>9}{'p95 БД':>9}{'p95 SQL':>9}")
+    for handler, hist in snapshot.items():
+        print(
+            f"{handler[-61:]:<62}{hist['wall_ms']['count']:>7}{hist['wall_ms']['p95']:>9.1f}"
+            f"{hist['db_ms']['p95']:>9.1f}{hist['statements']['p95']:>9.0f}"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--history", type=int, default=200, help="анализов в истории каждого пользователя")
+    parser.add_argument("--appointments", type=int, default=20, help="назначений в истории каждого пользователя")
+    parser.add_argument("--rounds", type=int, default=2, help="повторов сценария на пользователя")
+    parser.add_argument("--concurrency", type=int, default=0, help="одновременно активных пользователей (0 — все)")
+    parser.add_argument("--flows", nargs="+", choices=list(FLOWS), default=list(FLOWS))
+    parser.add_argument("--file-kb", type=int, default=512, help="размер загружаемого файла обследования")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="имитация задержки Bot API")
+    parser.add_argument("--fsm", choices=("sql", "memory"), default="sql")
+    parser.add_argument("--workdir", help="каталог для SQLite и загрузок (по умолчанию временный)")
+    parser.add_argument("--mixed", action="store_true", help="запустить сценарии одновременно")
+    parser.add_argument("--handlers", action="store_true", help="вывести метрики по хендлерам")
+    parser.add_argument("--send-limits", action="store_true",
+                        help="включить лимиты отправки Telegram (по умолчанию выключены, чтобы мерить сам бот)")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bot-replay-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)  # uploaded_files и SQLite — в рабочем каталоге бенчмарка
+    sys.path.insert(0, REPO_ROOT)
+
+    # Окружение задаём до импорта bot.py: он читает его при импорте
+    os.environ["DATABASE_URL"] = os.getenv("REPLAY_DATABASE_URL", "sqlite+aiosqlite:///replay.db")
+    os.environ["BOT_TOKEN"] = BOT_TOKEN
+    os.environ["FSM_STORAGE"] = args.fsm
+    os.environ.pop("WEBHOOK_URL", None)
+    os.environ["SEND_LIMITS"] = "1" if args.send_limits else "0"
+    if "PDF_FONT_PATH" not in os.environ:
+        # Vera из reportlab без кириллицы, но для замера времени сборки PDF подходит
+        import reportlab
+        os.environ["PDF_FONT_PATH"] = os.path.join(os.path.dirname(reportlab.__file__), "fonts", "Vera.ttf")
+
+    import db
+    import bot as app
+    dp, tg = app.build_app()
+    from middlewares.metrics import metrics
+
+    users = [1_000_000 + i for i in range(args.users)]
+    await prepare_db(db, users, args.history, args.appointments)
+
+    session = ReplaySession(latency_ms=args.api_latency_ms)
+    session.middleware = tg.session.middleware  # те же request-middleware, что у бота
+    tg.session = session
+    replayer = Replayer(dp, tg, session, args.file_kb * 1024)
+
+    await dp.emit_startup(bot=tg, dispatcher=dp, bots=[tg])
+    results = []
+    try:
+        if args.mixed:
+            # Сценарии идут одновременно, пользователи поделены между ними:
+            # видно, как тяжёлые апдейты одних задерживают лёгкие у других
+            n = len(args.flows)
+            results = await asyncio.gather(*(
+                run_flow(replayer, flow, users[i::n], args.rounds, args.concurrency or len(users))
+                for i, flow in enumerate(args.flows)
+            ))
+        else:
+            for flow in args.flows:
+                results.append(await run_flow(replayer, flow, users, args.rounds, args.concurrency or len(users)))
+                print(f"{flow}: {results[-1]['updates']} апдейтов, {results[-1]['ups']:.1f} апд/с")
+    finally:
+        await dp.emit_shutdown(bot=tg, dispatcher=dp, bots=[tg])
+        await db.engine.dispose()
+
+    print_report(results, session)
+    if args.handlers:
+        print_handlers(metrics.snapshot())
+    if args.send_limits:
+        from middlewares.send_limiter import send_limiter
+        print("\nочередь отправки:", send_limiter.snapshot())
+
+    if not args.workdir:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -6,7 +6,25 @@ from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 
-from handlers import start, user_data, kbju, analyses, recommendations, appointments, examinations, delete_data
+from db import async_session, engine
+from services.fsm_storage import SQLStorage
+from middlewares.db_session import DbSessionMiddleware
+from middlewares.metrics import (
+    instrument_engine, ApiTimingMiddleware, UpdateMetricsMiddleware, HandlerNameMiddleware
+)
+from middlewares.send_limiter import send_limiter
+from services.catalog import catalog
+from services.reports import renderer
+from services.lab_import import lab_importer
+from services.reminders import reminder_scheduler
+from services.cold_files import cold_files
+from services.purge import data_purger
+from services.export import data_exporter
+from services.webhook import WEBHOOK_URL, run_webhook
+from services.sharding import BOT_WORKERS, run_sharded
+from handlers import (
+    start, user_data, kbju, analyses, recommendations, appointments, examinations, export_data, delete_data
+)
 
 
 # Загрузка реального токена из .env
@@ -15,29 +33,88 @@ TOKEN = os.getenv("BOT_TOKEN")
 if not TOKEN:
     raise ValueError("BOT_TOKEN is missing in .env file")
 
-# Инициализация бота
-bot = Bot(
-    token=TOKEN,
-    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-)
-dp = Dispatcher(storage=MemoryStorage())
-
-dp.include_routers(
-    start.router,
-    user_data.router,
-    kbju.router,
-    analyses.router,
-    recommendations.router,
-    appointments.router,
-    examinations.router,
-    delete_data.router
-)
+
+def build_app():
+    """
+    Собирает бота и диспетчер с middleware, роутерами и фоновыми задачами.
+
+    Роутеры хендлеров — модульные и подключаются к диспетчеру один раз,
+    поэтому функция вызывается один раз на процесс: при обычном запуске и
+    в каждом воркере BOT_WORKERS.
+    """
+    # Инициализация бота
+    bot = Bot(
+        token=TOKEN,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+    )
+    # FSM по умолчанию хранится в БД: диалоги переживают перезапуск, и её видят
+    # все воркеры BOT_WORKERS. FSM_STORAGE=memory — старое поведение.
+    if os.getenv("FSM_STORAGE", "sql") == "memory":
+        dp = Dispatcher(storage=MemoryStorage())
+    else:
+        storage = SQLStorage(async_session)
+        dp = Dispatcher(storage=storage, events_isolation=storage.create_isolation())
+
+    # Все запросы к Bot API — через лимиты Telegram (общий и на чат) с повтором при 429.
+    # Первый зарегистрированный request-middleware — внешний: ожидание в очереди
+    # лимитера не попадает в api_ms, а каждая попытка после 429 меряется отдельно.
+    bot.session.middleware(send_limiter)
+
+    # Метрики: время хендлера, SQL и запросы к Bot API на каждый апдейт
+    instrument_engine(engine)
+    bot.session.middleware(ApiTimingMiddleware())
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.message.middleware(HandlerNameMiddleware())
+    dp.callback_query.middleware(HandlerNameMiddleware())
+
+    # Одна сессия БД на апдейт вместо async_session() в каждом хендлере
+    dp.update.outer_middleware(DbSessionMiddleware(async_session))
+
+    dp.include_routers(
+        start.router,
+        user_data.router,
+        kbju.router,
+        analyses.router,
+        recommendations.router,
+        appointments.router,
+        examinations.router,
+        export_data.router,
+        delete_data.router
+    )
+
+    # Справочник анализов загружаем в память один раз при старте
+    dp.startup.register(catalog.load)
+    # Пул процессов для PDF поднимаем при старте и останавливаем вместе с ботом
+    dp.startup.register(renderer.start)
+    # Напоминания о приёмах отправляет только основной процесс
+    dp.startup.register(reminder_scheduler.start)
+    dp.shutdown.register(reminder_scheduler.shutdown)
+    # Сжатие давно не скачанных файлов обследований — тоже в основном процессе
+    dp.startup.register(cold_files.start)
+    dp.shutdown.register(cold_files.shutdown)
+    # Удаление всех данных пользователя — фоновыми пачками, переживает перезапуск
+    dp.startup.register(data_purger.start)
+    dp.shutdown.register(data_purger.shutdown)
+    dp.shutdown.register(lab_importer.shutdown)
+    dp.shutdown.register(data_exporter.shutdown)
+    dp.shutdown.register(renderer.shutdown)
+    dp.shutdown.register(send_limiter.close)
+    return dp, bot
+
 
 # Запуск
-async def main():
+async def main(dp: Dispatcher, bot: Bot):
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    dp, bot = build_app()
+    # Если задан WEBHOOK_URL — принимаем апдейты вебхуком, иначе long polling.
+    # BOT_WORKERS > 1 — polling в супервизоре и обработка в N процессах.
+    if WEBHOOK_URL:
+        run_webhook(dp, bot)
+    elif BOT_WORKERS > 1:
+        run_sharded(dp, bot)
+    else:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(main(dp, bot))
 
@@ -1,6 +1,7 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, Integer, String, Text, Float, BigInteger, Date, DateTime
+from sqlalchemy import Column, Integer, String, Text, Float, BigInteger, Date, DateTime, Index, inspect, insert
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from os import getenv
 from dotenv import load_dotenv
 from datetime import datetime
@@ -11,8 +12,44 @@ load_dotenv()
 
 DATABASE_URL = getenv("DATABASE_URL")
 
+# Настройки пула соединений (можно переопределить в .env)
+DB_ECHO = getenv("DB_ECHO", "0") == "1"
+DB_POOL_SIZE = int(getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = int(getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(getenv("DB_POOL_RECYCLE", "1800"))  # меньше wait_timeout MySQL
+DB_POOL_PRE_PING = getenv("DB_POOL_PRE_PING", "1") == "1"
+
+
+def _engine_options(url: str) -> dict:
+    """Параметры create_async_engine с учётом диалекта"""
+    options = {
+        "echo": DB_ECHO,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+    # У SQLite нет сетевого пула — размеры очереди к нему неприменимы
+    if not url.startswith("sqlite"):
+        options.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+        )
+    return options
+
+
+def upsert(dialect: str, model, values: dict, keys, set_: dict):
+    """INSERT, который при конфликте по первичному ключу ``keys`` обновляет строку значениями ``set_``"""
+    if dialect == "mysql":
+        return mysql.insert(model).values(**values).on_duplicate_key_update(**set_)
+    if dialect in ("sqlite", "postgresql"):
+        stmt = (sqlite if dialect == "sqlite" else postgresql).insert(model)
+        return stmt.values(**values).on_conflict_do_update(index_elements=keys, set_=set_)
+    return insert(model).values(**values)
+
+
 # Создаем асинхронный движок SQLAlchemy
-engine = create_async_engine(DATABASE_URL, echo=True)
+engine = create_async_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
 
 # Создаем сессию для работы с БД
 async_session = sessionmaker(
@@ -54,6 +91,38 @@ class Analysis(Base):
     units = Column(String(50))
     result = Column(Text)
     date = Column(Date)
+    # Числа, разобранные из result/reference при записи (services/reference.py)
+    result_value = Column(Float)
+    ref_min = Column(Float)
+    ref_max = Column(Float)
+
+    __table_args__ = (
+        # последние результаты, динамика и удаление по названию
+        Index("ix_analysis_user_name_date", "telegram_id", "name", "date"),
+        # список дат сдачи и вывод за дату
+        Index("ix_analysis_user_date", "telegram_id", "date"),
+        # группы пользователя и названия внутри группы
+        Index("ix_analysis_user_group_name", "telegram_id", "group_name", "name"),
+    )
+
+# Последний и предыдущий результат по каждому анализу пользователя.
+# Поддерживается services/analysis_latest.py при добавлении и удалении анализов,
+# чтобы «Все анализы» читались одним диапазоном по первичному ключу.
+class AnalysisLatest(Base):
+    __tablename__ = "analysis_latest"
+
+    telegram_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    name = Column(String(255), primary_key=True)
+    group_name = Column(String(255))
+    latest_id = Column(Integer, nullable=False)   # analysis.id последнего результата
+    previous_id = Column(Integer)                 # analysis.id предыдущего результата
+    result = Column(Text)
+    result_value = Column(Float)
+    ref_min = Column(Float)
+    ref_max = Column(Float)
+    reference = Column(String(255))
+    units = Column(String(50))
+    date = Column(Date)
 
 # Модель справочника анализов
 class AnalyzesMem(Base):
@@ -77,6 +146,10 @@ class Recommendation(Base):
     category = Column(String(100), nullable=False)
     text = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_recommendations_user_category_created", "telegram_id", "category", "created_at"),
+    )
     
 # Модель назначений врача
 class DoctorAppointment(Base):
@@ -88,6 +161,10 @@ class DoctorAppointment(Base):
     doctor = Column(String(100), nullable=False)
     recommendation = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_doctor_appointments_user_doctor_date", "telegram_id", "doctor", "appointment_date"),
+    )
     
 class InstrumentalExamination(Base):
     __tablename__ = "instrumental_examinations"
@@ -98,12 +175,121 @@ class InstrumentalExamination(Base):
     name = Column(Text, nullable=False)
     description = Column(Text, nullable=False)
     file_path = Column(Text)  # путь к загруженному файлу
+    file_name = Column(String(255))  # исходное имя файла у пользователя
+    file_hash = Column(String(64))   # sha256 объекта в services/file_store.py; пусто у старых файлов
+    # file_id последней отправки файла в Telegram: повторно отправляем по нему, без чтения диска
+    tg_file_id = Column(String(255))
+    tg_file_unique_id = Column(String(64))
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_instrumental_examinations_user_date", "telegram_id", "examination_date"),
+    )
+
+def _add_missing_columns(sync_conn):
+    """create_all не меняет существующие таблицы — добавляем новые nullable-колонки"""
+    inspector = inspect(sync_conn)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {col["name"] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                col_type = column.type.compile(dialect=sync_conn.dialect)
+                sync_conn.exec_driver_sql(
+                    f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"
+                )
+
+
+def _create_missing_indexes(sync_conn):
+    """create_all не добавляет индексы в уже существующие таблицы — досоздаём их"""
+    inspector = inspect(sync_conn)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(sync_conn)
+
+
+# Состояния FSM (aiogram), чтобы диалоги переживали перезапуск бота
+class FSMRecord(Base):
+    __tablename__ = "fsm_storage"
+
+    key = Column(String(255), primary_key=True)
+    state = Column(String(255))
+    data = Column(Text)  # JSON
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Версия медицинских данных пользователя: растёт при каждом добавлении/удалении,
+# по ней проверяется актуальность закэшированных отчётов
+class UserDataVersion(Base):
+    __tablename__ = "user_data_versions"
+
+    telegram_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    version = Column(BigInteger, nullable=False, default=0)
+
+# Короткие id для названий в callback_data (services/name_registry.py):
+# группы и названия анализов, врачи, категории рекомендаций пользователя
+class CallbackName(Base):
+    __tablename__ = "callback_names"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    telegram_id = Column(BigInteger, nullable=False)
+    kind = Column(String(20), nullable=False)
+    name = Column(String(255), nullable=False)
+
+    __table_args__ = (
+        Index("ux_callback_names_user_kind_name", "telegram_id", "kind", "name", unique=True),
+    )
+
+# Напоминания о приёмах (services/reminders.py): одна строка — одно
+# сообщение о визите к врачу; после отправки строка удаляется
+class AppointmentReminder(Base):
+    __tablename__ = "appointment_reminders"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    telegram_id = Column(BigInteger, nullable=False)
+    doctor = Column(String(100), nullable=False)
+    appointment_date = Column(Date, nullable=False)
+    remind_at = Column(DateTime, nullable=False)  # время сервера
+
+    __table_args__ = (
+        Index("ix_appointment_reminders_due", "remind_at", "id"),
+        Index("ix_appointment_reminders_visit", "telegram_id", "doctor", "appointment_date"),
+    )
+
+# Объекты хранилища файлов (services/file_store.py): сколько обследований
+# ссылается на файл с этим содержимым
+class StoredFile(Base):
+    __tablename__ = "stored_files"
+
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_access = Column(DateTime)    # последнее скачивание пользователем
+    compression = Column(String(10))  # gz / xz — файл сжат (services/cold_files.py); none — сжимать не стоит
+    stored_size = Column(BigInteger)  # размер на диске после сжатия
+
+# Заявки на удаление всех данных пользователя (services/purge.py);
+# строка живёт, пока удаление не закончено
+class PurgeJob(Base):
+    __tablename__ = "purge_jobs"
+
+    telegram_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    chat_id = Column(BigInteger, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
 # Функция для создания всех таблиц
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_create_missing_indexes)
 
 # Запуск инициализации БД при прямом запуске
 if __name__ == "__main__":
@@ -2,28 +2,41 @@ from aiogram import Router, F
 from keyboards.main_menu import InlineKeyboardButton, InlineKeyboardMarkup, analysis_keyboard
 from aiogram.types import(
     Message,
-    FSInputFile,
+    BufferedInputFile,
     CallbackQuery
     )
 from aiogram.fsm.context import FSMContext
-from sqlalchemy import select, delete, desc, func
+from aiogram.exceptions import TelegramBadRequest
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, delete
+from sqlalchemy.orm import aliased
 from datetime import datetime, date, timedelta
 import dateparser
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-import re
 import tempfile
-from io import BytesIO
-import os
 
-from states.analysis_states import AddAnalysis, DeleteFlow
-from db import async_session, AnalyzesMem, Analysis
+from keyboards.callbacks import (
+    CatalogGroupCb, CatalogNameCb, ViewGroupCb, ViewAnalysisCb, ViewChartCb, DeleteGroupCb, DeleteNameCb
+)
+from states.analysis_states import AddAnalysis, BulkAddAnalysis, ImportLabPdf, DeleteFlow
+from db import Analysis, AnalysisLatest
+from services.catalog import catalog
+from services.reference import reference_columns, status_emoji, status_color
+from services.reports import renderer, render_analyses_pdf, render_trend_png, ReportQueueFull
+from services.trend import series_stats, trend_caption
+from services.pagination import KeysetPager, TEXT_PAGE_SIZE, BUTTON_PAGE_SIZE
+from services.name_registry import name_registry, GROUP, ANALYSIS
+from services.report_cache import report_cache, get_version, bump_version
+from services.analysis_latest import refresh_latest
+from services.bulk_entry import parse_block, analysis_values, save_analyses, BULK_MAX_LINES
+from services.lab_import import lab_importer, LAB_PDF_MAX_MB
+from services.file_store import file_store, FileTooLarge
 router = Router() 
 
+# Постраничные списки: история одного анализа, даты сдачи и записи для удаления
+analysis_pager = KeysetPager("pg:va", Analysis.date, Analysis.id, size=TEXT_PAGE_SIZE)
+dates_pager = KeysetPager("pg:vd", Analysis.date, size=BUTTON_PAGE_SIZE)
+delete_pager = KeysetPager("pg:da", Analysis.date, Analysis.id, size=BUTTON_PAGE_SIZE)
+
 
 @router.message(F.text == "🧪 Анализы")
 async def analyses_menu_handler(message: Message):
@@ -40,33 +53,26 @@ async def start_add_analysis(message: Message, state: FSMContext):
     await state.set_state(AddAnalysis.date)
 
 
+def _parse_date(text: str) -> date:
+    text = text.strip().lower()
+    if text in ['сегодня', 'today']:
+        return date.today()
+    if text in ['вчера', 'yesterday']:
+        return date.today() - timedelta(days=1)
+    dt = dateparser.parse(text, languages=['ru', 'en'])
+    if not dt:
+        raise ValueError
+    return dt.date()
+
+
 @router.message(AddAnalysis.date)
 async def process_date(message: Message, state: FSMContext):
-    text = message.text.strip().lower()
     try:
-        if text in ['сегодня', 'today']:
-            parsed_date = date.today()
-        elif text in ['вчера', 'yesterday']:
-            parsed_date = date.today() - timedelta(days=1)
-        else:
-            dt = dateparser.parse(text, languages=['ru', 'en'])
-            if not dt:
-                raise ValueError
-            parsed_date = dt.date()
-
+        parsed_date = _parse_date(message.text)
         await state.update_data(date=parsed_date)
 
-        async with async_session() as session:
-            q = select(AnalyzesMem.group_name).distinct()
-            res = await session.execute(q)
-            groups = [r[0] for r in res.all()]
-
-        kb = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [InlineKeyboardButton(text=g, callback_data=f"group|{g}")] for g in groups
-            ] + [[InlineKeyboardButton(text="✅ Закончить ввод", callback_data="finish")]]
-        )
-        await message.answer("Выберите группу анализа:", reply_markup=kb)
+        await catalog.ensure_fresh()
+        await message.answer("Выберите группу анализа:", reply_markup=catalog.groups_keyboard())
         await state.set_state(AddAnalysis.select_group)
     except Exception:
         await message.answer(
@@ -74,21 +80,17 @@ async def process_date(message: Message, state: FSMContext):
         )
 
 
-@router.callback_query(F.data.startswith('group|'), AddAnalysis.select_group)
-async def choose_group(callback: CallbackQuery, state: FSMContext):
-    group = callback.data.split("|", 1)[1]
+@router.callback_query(CatalogGroupCb.filter(), AddAnalysis.select_group)
+async def choose_group(callback: CallbackQuery, callback_data: CatalogGroupCb, state: FSMContext):
+    await catalog.ensure_fresh()
+    entry = catalog.get(callback_data.mem_id)
+    kb = catalog.names_keyboard(entry.group_name) if entry else None
+    if kb is None:
+        await callback.answer("Группа не найдена в справочнике.", show_alert=True)
+        return
+    group = entry.group_name
     await state.update_data(group=group)
 
-    async with async_session() as session:
-        q = select(AnalyzesMem.name).where(AnalyzesMem.group_name == group).distinct()
-        res = await session.execute(q)
-        names = [r[0] for r in res.all()]
-
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=n, callback_data=f"analysis|{n}")] for n in names
-        ] + [[InlineKeyboardButton(text="🔙 Назад к группам", callback_data="back_to_groups")]]
-    )
     await callback.message.answer(f"Группа: {group}. Выберите анализ:", reply_markup=kb)
     await state.set_state(AddAnalysis.select_analysis)
     await callback.answer()
@@ -96,40 +98,22 @@ async def choose_group(callback: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == 'back_to_groups', AddAnalysis.select_analysis)
 async def back_to_groups(callback: CallbackQuery, state: FSMContext):
-    async with async_session() as session:
-        q = select(AnalyzesMem.group_name).distinct()
-        res = await session.execute(q)
-        groups = [r[0] for r in res.all()]
-
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=g, callback_data=f"group|{g}")] for g in groups
-        ] + [[InlineKeyboardButton(text="✅ Закончить ввод", callback_data="finish")]]
-    )
-    await callback.message.answer("Выберите группу анализа:", reply_markup=kb)
+    await catalog.ensure_fresh()
+    await callback.message.answer("Выберите группу анализа:", reply_markup=catalog.groups_keyboard())
     await state.set_state(AddAnalysis.select_group)
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith('analysis|'), AddAnalysis.select_analysis)
-async def choose_analysis(callback: CallbackQuery, state: FSMContext):
-    name = callback.data.split("|", 1)[1]
-    data = await state.get_data()
-    group = data.get("group")
-
-    async with async_session() as session:
-        q = select(AnalyzesMem).where(
-            AnalyzesMem.group_name == group,
-            AnalyzesMem.name == name
-        )
-        res = await session.execute(q)
-        variants = res.scalars().all()
+@router.callback_query(CatalogNameCb.filter(), AddAnalysis.select_analysis)
+async def choose_analysis(callback: CallbackQuery, callback_data: CatalogNameCb, state: FSMContext):
+    await catalog.ensure_fresh()
+    entry = catalog.get(callback_data.mem_id)
+    kb = catalog.variants_keyboard(entry.group_name, entry.name) if entry else None
+    if kb is None:
+        await callback.answer("Анализ не найден в справочнике.", show_alert=True)
+        return
+    name = entry.name
 
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=f"{v.unit} ({v.reference_values})", callback_data=f"variant|{v.id}")] for v in variants
-        ] + [[InlineKeyboardButton(text="🔙 Назад к анализам", callback_data="back_to_analyses")]]
-    )
     await callback.message.answer(f"Анализ: {name}. Выберите Единицы измерения:", reply_markup=kb)
     await state.set_state(AddAnalysis.select_variant)
     await callback.answer()
@@ -140,17 +124,11 @@ async def back_to_analyses(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     group = data.get("group")
 
-    async with async_session() as session:
-        q = select(AnalyzesMem.name).where(AnalyzesMem.group_name == group).distinct()
-        res = await session.execute(q)
-        names = [r[0] for r in res.all()]
-
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=n, callback_data=f"analysis|{n}")] for n in names
-        ] + [[InlineKeyboardButton(text="🔙 Назад к группам", callback_data="back_to_groups")]]
+    await catalog.ensure_fresh()
+    await callback.message.answer(
+        f"Группа: {group}. Выберите анализ:",
+        reply_markup=catalog.names_keyboard(group)
     )
-    await callback.message.answer(f"Группа: {group}. Выберите анализ:", reply_markup=kb)
     await state.set_state(AddAnalysis.select_analysis)
     await callback.answer()
 
@@ -158,8 +136,11 @@ async def back_to_analyses(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.startswith('variant|'), AddAnalysis.select_variant)
 async def choose_variant(callback: CallbackQuery, state: FSMContext):
     mem_id = int(callback.data.split("|", 1)[1])
-    async with async_session() as session:
-        mem = await session.get(AnalyzesMem, mem_id)
+    await catalog.ensure_fresh()
+    mem = catalog.get(mem_id)
+    if mem is None:
+        await callback.answer("Вариант не найден в справочнике.", show_alert=True)
+        return
 
     # Сохраняем в state все, что нужно для пересчёта и сохранения
     await state.update_data(
@@ -180,7 +161,7 @@ async def choose_variant(callback: CallbackQuery, state: FSMContext):
 
 
 @router.message(AddAnalysis.result)
-async def process_result(message: Message, state: FSMContext):
+async def process_result(message: Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     try:
         raw_val = float(message.text.strip())
@@ -188,35 +169,27 @@ async def process_result(message: Message, state: FSMContext):
         # Пересчитываем в стандартные единицы и округляем до сотых
         standardized_val = round(raw_val * data['conversion_to_standard'], 2)
 
-        async with async_session() as session:
-            async with session.begin():
-                new = Analysis(
-                    telegram_id=message.from_user.id,
-                    name=data['name'],
-                    group_name=data['group'],
-                    units=data['standard_unit'],
-                    reference=data['standard_reference'],
-                    result=str(standardized_val),
-                    date=data['date']
-                )
-                session.add(new)
+        new = Analysis(
+            telegram_id=message.from_user.id,
+            name=data['name'],
+            group_name=data['group'],
+            units=data['standard_unit'],
+            reference=data['standard_reference'],
+            result=str(standardized_val),
+            date=data['date'],
+            **reference_columns(standardized_val, data['standard_reference'])
+        )
+        session.add(new)
+        await refresh_latest(session, message.from_user.id, data['name'])
+        await bump_version(session, message.from_user.id)
+        await session.commit()
 
         # После сохранения — показать клавиатуру выбора
-        async with async_session() as session:
-            q = select(AnalyzesMem.group_name).distinct()
-            res = await session.execute(q)
-            groups = [r[0] for r in res.all()]
-
-        kb = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [InlineKeyboardButton(text=g, callback_data=f"group|{g}")]
-                for g in groups
-            ] + [[InlineKeyboardButton(text="✅ Закончить ввод", callback_data="finish")]]
-        )
+        await catalog.ensure_fresh()
         await message.answer(
             f"✅ Сохранено: {data['name']} = {standardized_val} {data['standard_unit']}.\n"
             "Выберите следующий анализ или закончите:",
-            reply_markup=kb
+            reply_markup=catalog.groups_keyboard()
         )
         await state.set_state(AddAnalysis.select_group)
 
@@ -229,11 +202,183 @@ async def finish_adding(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.answer()
 
-# --------------- Просмотр анализов -----------------
+# --------------- Ввод анализов списком -----------------
+
+@router.message(F.text == "📥 Добавить списком")
+async def start_bulk_add(message: Message, state: FSMContext):
+    await state.clear()
+    await message.answer(
+        "Введите дату сдачи анализов (дд.мм.гггг, 'сегодня', 'вчера'):"
+    )
+    await state.set_state(BulkAddAnalysis.date)
 
-pdfmetrics.registerFont(
-    TTFont('ArialUnicode', r'C:\Windows\Fonts\arial.ttf')
-)
+
+@router.message(BulkAddAnalysis.date)
+async def bulk_date(message: Message, state: FSMContext):
+    try:
+        parsed_date = _parse_date(message.text)
+    except Exception:
+        await message.answer(
+            "❌ Не удалось распознать дату. Введите в формате дд.мм.гггг, 'сегодня' или 'вчера'."
+        )
+        return
+
+    await state.update_data(date=parsed_date)
+    await message.answer(
+        "Вставьте результаты одним сообщением, по одному на строку "
+        f"(до {BULK_MAX_LINES} строк), например:\n\n"
+        "Гемоглобин 135 г/л\n"
+        "Глюкоза 5,4 ммоль/л"
+    )
+    await state.set_state(BulkAddAnalysis.lines)
+
+
+async def _ask_next_ambiguous(message: Message, state: FSMContext):
+    data = await state.get_data()
+    pending = data.get("pending", [])
+    if not pending:
+        await message.answer("Ввод анализов завершён.", reply_markup=analysis_keyboard)
+        await state.clear()
+        return
+
+    item = pending[0]
+    kb = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=f"{m.name} — {m.unit} ({m.reference_values})", callback_data=f"bulk_pick|{m.id}")]
+            for m in (catalog.get(mem_id) for mem_id in item["ids"]) if m is not None
+        ] + [[InlineKeyboardButton(text="⏭ Пропустить", callback_data="bulk_skip")]]
+    )
+    await message.answer(f"❓ Уточните строку «{item['line']}»:", reply_markup=kb)
+    await state.set_state(BulkAddAnalysis.confirm)
+
+
+@router.message(BulkAddAnalysis.lines, F.text)
+async def bulk_lines(message: Message, state: FSMContext, session: AsyncSession):
+    data = await state.get_data()
+    await catalog.ensure_fresh()
+    parsed = parse_block(message.text, catalog)
+
+    ok = [p for p in parsed if p.status == "ok"]
+    rows = [analysis_values(message.from_user.id, p.candidates[0], p.value, data['date']) for p in ok]
+    if rows:
+        await save_analyses(session, message.from_user.id, rows)
+
+    lines = []
+    if rows:
+        lines.append(f"✅ Сохранено: {len(rows)}")
+        lines += [f"{r['name']} = {r['result']} {r['units']}" for r in rows]
+    failed = [p.line for p in parsed if p.status in ("unknown", "invalid")]
+    if failed:
+        lines.append("\n⚠️ Не распознано (введите их пошагово):")
+        lines += failed
+    if lines:
+        await message.answer("\n".join(lines))
+
+    # Неоднозначные строки подтверждаем по одной
+    pending = [
+        {"line": p.line, "value": p.value, "ids": [c.id for c in p.candidates]}
+        for p in parsed if p.status == "ambiguous"
+    ]
+    await state.update_data(pending=pending)
+    await _ask_next_ambiguous(message, state)
+
+
+@router.callback_query(BulkAddAnalysis.confirm, F.data.startswith("bulk_pick|"))
+async def bulk_pick(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
+    mem_id = int(callback.data.split("|", 1)[1])
+    data = await state.get_data()
+    pending = data.get("pending", [])
+    await catalog.ensure_fresh()
+    mem = catalog.get(mem_id)
+    if not pending or mem is None or mem_id not in pending[0]["ids"]:
+        await callback.answer("Вариант не найден в справочнике.", show_alert=True)
+        return
+
+    row = analysis_values(callback.from_user.id, mem, pending[0]["value"], data['date'])
+    await save_analyses(session, callback.from_user.id, [row])
+
+    await callback.message.edit_text(
+        f"✅ Сохранено: {row['name']} = {row['result']} {row['units']}"
+    )
+    await state.update_data(pending=pending[1:])
+    await _ask_next_ambiguous(callback.message, state)
+    await callback.answer()
+
+
+@router.callback_query(BulkAddAnalysis.confirm, F.data == "bulk_skip")
+async def bulk_skip(callback: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    pending = data.get("pending", [])
+    await callback.message.edit_text(f"⏭ Пропущено: {pending[0]['line']}" if pending else "⏭ Пропущено")
+    await state.update_data(pending=pending[1:])
+    await _ask_next_ambiguous(callback.message, state)
+    await callback.answer()
+
+# --------------- Импорт PDF из лаборатории -----------------
+
+@router.message(F.text == "📄 Загрузить PDF из лаборатории")
+async def start_pdf_import(message: Message, state: FSMContext):
+    await state.clear()
+    await message.answer(
+        "Введите дату сдачи анализов (дд.мм.гггг, 'сегодня', 'вчера'):"
+    )
+    await state.set_state(ImportLabPdf.date)
+
+
+@router.message(ImportLabPdf.date)
+async def pdf_import_date(message: Message, state: FSMContext):
+    try:
+        parsed_date = _parse_date(message.text)
+    except Exception:
+        await message.answer(
+            "❌ Не удалось распознать дату. Введите в формате дд.мм.гггг, 'сегодня' или 'вчера'."
+        )
+        return
+
+    await state.update_data(date=parsed_date)
+    await message.answer(f"Отправьте PDF-файл с результатами (до {LAB_PDF_MAX_MB} МБ).")
+    await state.set_state(ImportLabPdf.file)
+
+
+@router.message(ImportLabPdf.file, F.document)
+async def pdf_import_file(message: Message, state: FSMContext):
+    doc = message.document
+    is_pdf = doc.mime_type == "application/pdf" or (doc.file_name or "").lower().endswith(".pdf")
+    if not is_pdf:
+        await message.answer("❌ Это не PDF. Отправьте файл в формате PDF.")
+        return
+    if doc.file_size and doc.file_size > LAB_PDF_MAX_MB * 1024 * 1024:
+        await message.answer(f"❌ Файл больше {LAB_PDF_MAX_MB} МБ.")
+        return
+
+    progress = await message.answer("⏳ Загружаю файл…")
+
+    try:
+        # Файл пишется на диск по частям, без блокирующих вызовов; размер проверяется на лету
+        downloaded = await file_store.download(
+            message.bot, doc.file_id, LAB_PDF_MAX_MB * 1024 * 1024, directory=tempfile.gettempdir(), suffix=".pdf"
+        )
+    except FileTooLarge:
+        await progress.edit_text(f"❌ Файл больше {LAB_PDF_MAX_MB} МБ. Отправьте файл поменьше.")
+        return
+    except Exception:
+        await progress.edit_text("❌ Не удалось скачать файл. Отправьте его ещё раз.")
+        return
+    path = downloaded.path
+
+    # Состояние сбрасываем только с файлом на руках: при ошибке скачивания
+    # дата сохранена, и пользователь просто отправляет файл ещё раз
+    data = await state.get_data()
+    await state.clear()
+    await progress.edit_text("⏳ Файл получен, читаю страницы…")
+    lab_importer.start(message.bot, progress.chat.id, progress.message_id, message.from_user.id, path, data['date'])
+
+
+@router.message(ImportLabPdf.file)
+async def pdf_import_not_file(message: Message):
+    await message.answer("Отправьте PDF-файл документом.")
+
+# --------------- Просмотр анализов -----------------
 
 @router.message(F.text == "📋 Посмотреть анализы")
 async def show_analysis_menu(message: Message):
@@ -247,7 +392,7 @@ async def show_analysis_menu(message: Message):
 
 # 2. Обработка выбора опции
 @router.callback_query(F.data.startswith("view_option|"))
-async def handle_view_option(callback: CallbackQuery):
+async def handle_view_option(callback: CallbackQuery, session: AsyncSession):
     option = callback.data.split("|", 1)[1]
     # Опция "Все анализы"
     if option == "all":
@@ -260,38 +405,27 @@ async def handle_view_option(callback: CallbackQuery):
 
     # Опция "По дате сдачи"
     elif option == "date":
-        async with async_session() as session:
-            q = select(Analysis.date).where(
-                Analysis.telegram_id == callback.from_user.id
-            ).distinct().order_by(desc(Analysis.date))
-            res = await session.execute(q)
-            dates = [r[0] for r in res.all()]
-        if not dates:
+        kb = await _dates_keyboard(session, callback.from_user.id)
+        if kb is None:
             await callback.message.answer("У вас нет ни одного анализа.")
         else:
-            kb = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text=d.strftime("%d.%m.%Y"), callback_data=f"view_date|{d.isoformat()}")]
-                    for d in dates
-                ] + [[InlineKeyboardButton(text="🔙 Назад", callback_data="show_menu")]]
-            )
             await callback.message.answer("Выберите дату сдачи:", reply_markup=kb)
 
     # Опция "Динамика"
     elif option == "trend":
         # Выводим группы анализов, как в текущей реализации
-        async with async_session() as session:
-            q = select(Analysis.group_name).where(
-                Analysis.telegram_id == callback.from_user.id
-            ).distinct()
-            res = await session.execute(q)
-            groups = [r[0] for r in res.all()]
+        q = select(Analysis.group_name).where(
+            Analysis.telegram_id == callback.from_user.id
+        ).distinct()
+        res = await session.execute(q)
+        groups = [r[0] for r in res.all()]
         if not groups:
             await callback.message.answer("📋 У вас ещё нет ни одного анализа.")
         else:
+            ids = await name_registry.ids(callback.from_user.id, GROUP, groups)
             kb = InlineKeyboardMarkup(
                 inline_keyboard=[
-                    [InlineKeyboardButton(text=g, callback_data=f"view_group|{g}")]
+                    [InlineKeyboardButton(text=g, callback_data=ViewGroupCb(id=ids[g]).pack())]
                     for g in groups
                 ] + [[InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_view")]]
             )
@@ -302,25 +436,29 @@ async def handle_view_option(callback: CallbackQuery):
 
 # 3. Вывод всех анализов сообщением (последние результаты)
 @router.callback_query(F.data == "all_msg")
-async def all_msg(callback: CallbackQuery):
-    async with async_session() as session:
-        subq = select(
-            Analysis.name,
-            func.max(Analysis.date).label("max_date")
-        ).where(
-            Analysis.telegram_id == callback.from_user.id
-        ).group_by(Analysis.name).subquery()
-        q = select(
-            Analysis.name,
-            Analysis.result,
-            Analysis.reference,
-            Analysis.date
-        ).join(
-            subq,
-            (Analysis.name == subq.c.name) & (Analysis.date == subq.c.max_date)
-        )
-        res = await session.execute(q)
-        rows = res.all()
+async def all_msg(callback: CallbackQuery, session: AsyncSession):
+    # Если анализы не менялись — отдаём готовый текст без пересборки
+    version = await get_version(session, callback.from_user.id)
+    cache_key = ("all_msg", callback.from_user.id)
+    text = report_cache.get(cache_key, version)
+    if text is not None:
+        await callback.message.answer(text)
+        await callback.answer()
+        return
+
+    # Последние результаты поддерживаются в analysis_latest — один диапазон по ключу
+    q = select(
+        AnalysisLatest.name,
+        AnalysisLatest.result,
+        AnalysisLatest.date,
+        AnalysisLatest.result_value,
+        AnalysisLatest.ref_min,
+        AnalysisLatest.ref_max
+    ).where(
+        AnalysisLatest.telegram_id == callback.from_user.id
+    ).order_by(AnalysisLatest.name)
+    res = await session.execute(q)
+    rows = res.all()
 
     if not rows:
         await callback.message.answer("У вас нет ни одного анализа.")
@@ -328,195 +466,144 @@ async def all_msg(callback: CallbackQuery):
         return
 
     text = "<b>Последние результаты по всем анализам:</b>\n"
-    for name, result, reference, date in rows:
-        # приводим к числу (учёт 4,5 и 4.5)
-        res_num = None
-        if result:
-            try:
-                res_num = float(result.replace(',', '.'))
-            except ValueError:
-                pass
-
-        # парсим диапазон reference
-        min_ref = max_ref = None
-        if reference:
-            parts = re.split(r'[^0-9\.]+', reference)
-            nums = [p.replace(',', '.') for p in parts if p]
-            if len(nums) >= 2:
-                try:
-                    min_ref, max_ref = float(nums[0]), float(nums[1])
-                except ValueError:
-                    pass
-
-        # выбираем эмодзи
-        if res_num is not None and min_ref is not None and max_ref is not None:
-            emoji = '🟢' if min_ref <= res_num <= max_ref else '🔴'
-        else:
-            emoji = ''
-
+    for name, result, date, result_value, ref_min, ref_max in rows:
+        emoji = status_emoji(result_value, ref_min, ref_max)
         text += f"{emoji}{name} = {result} ({date.strftime('%d.%m.%Y')})\n"
 
+    report_cache.put(cache_key, version, text)
     await callback.message.answer(text)
     await callback.answer()
 
 # 4. Вывод всех анализов в PDF (два последних результата)
+def _pdf_item(item):
+    if item is None:
+        return None
+    return {
+        "result": item.result,
+        "date": item.date.strftime('%d.%m.%Y'),
+        "color": status_color(item.result_value, item.ref_min, item.ref_max),
+    }
+
+
 @router.callback_query(F.data == "all_pdf")
-async def all_pdf(callback: CallbackQuery):
-    # --- Получаем данные ---
-    async with async_session() as session:
-        q = (
-            select(Analysis)
-            .where(Analysis.telegram_id == callback.from_user.id)
-            .order_by(Analysis.name, desc(Analysis.date))
-        )
-        res = await session.execute(q)
-        analyses = res.scalars().all()
-
-    # --- Группируем по названию ---
-    grouped = {}
-    for a in analyses:
-        grouped.setdefault(a.name, []).append(a)
-
-    # --- Подготовка таблицы и стилей ---
-    data = [[
-        'Анализ', 'Последний результат (дата)',
-        'Предыдущий результат (дата)', 'Референс', 'Ед. изм.'
-    ]]
-    styles = [
-        ('FONTNAME',   (0,0), (-1,-1), 'ArialUnicode'),
-        ('GRID',       (0,0), (-1,-1), 0.5, colors.black),
-        ('BACKGROUND', (0,0), (-1,0), colors.lightgrey),
-    ]
+async def all_pdf(callback: CallbackQuery, session: AsyncSession):
+    # --- Готовый PDF для этой версии данных: file_id после первой отправки или байты ---
+    version = await get_version(session, callback.from_user.id)
+    cache_key = ("all_pdf", callback.from_user.id)
+    cached = report_cache.get(cache_key, version)
+    if isinstance(cached, str):
+        try:
+            await callback.message.answer_document(cached)
+            await callback.answer()
+            return
+        except TelegramBadRequest:
+            cached = None  # file_id больше не принимается — отправим файл заново
+    if cached is not None:
+        await _send_pdf(callback, cache_key, version, cached)
+        return
 
-    # Шаблон для Paragraph
-    stylesheet = getSampleStyleSheet()
-    body = stylesheet['BodyText']
-    body.fontName = 'ArialUnicode'
-    body.fontSize = 10
-
-    row = 1
-    for name, items in grouped.items():
-        last = items[0]
-        prev = items[1] if len(items) > 1 else None
-
-        # Функция для создания окрашенного Paragraph
-        def make_para(item):
-            txt = item.result
-            date_str = item.date.strftime('%d.%m.%Y')
-            color = None
-            try:
-                val = float(item.result.replace(',', '.'))
-                parts = re.split(r'[^0-9,\.]+', item.reference or '')
-                nums = [p.replace(',', '.') for p in parts if p]
-                if len(nums) >= 2:
-                    lo, hi = map(float, nums[:2])
-                    color = 'green' if lo <= val <= hi else 'red'
-            except:
-                pass
-
-            if color:
-                # цветим только число, дату оставляем чёрной
-                return Paragraph(
-                    f'<font name="ArialUnicode">'
-                    f'<font color="{color}">{txt}</font> '
-                    f'({date_str})'
-                    f'</font>',
-                    body
-                )
-            else:
-                return Paragraph(f'{txt} ({date_str})', body)
-
-        last_para = make_para(last)
-        prev_para = make_para(prev) if prev else Paragraph('—', body)
-
-        data.append([
-            Paragraph(name, body),
-            last_para,
-            prev_para,
-            Paragraph(last.reference or '—', body),
-            Paragraph(last.units or '—', body),
-        ])
-        row += 1
-
-    # --- Генерируем PDF ---
-    buf = BytesIO()
-    doc = SimpleDocTemplate(buf, pagesize=A4)
-    tbl = Table(
-        data,
-        colWidths=[80, 150, 150, 70, 60],  # 80 пунктов для столбца "Ед. изм."
-        repeatRows=1
+    # --- Последний результат из analysis_latest, предыдущий — по его id ---
+    prev = aliased(Analysis)
+    q = (
+        select(AnalysisLatest, prev)
+        .outerjoin(prev, prev.id == AnalysisLatest.previous_id)
+        .where(AnalysisLatest.telegram_id == callback.from_user.id)
+        .order_by(AnalysisLatest.name)
     )
-    tbl.setStyle(TableStyle(styles))
-    doc.build([tbl])
-    buf.seek(0)
+    res = await session.execute(q)
+
+    # В воркер уходят только простые значения: последний и предыдущий результат
+    rows = [
+        {
+            "name": last.name,
+            "last": _pdf_item(last),
+            "prev": _pdf_item(previous),
+            "reference": last.reference,
+            "units": last.units,
+        }
+        for last, previous in res.all()
+    ]
+
+    # --- Генерируем PDF в пуле процессов, не блокируя остальных ---
+    try:
+        pdf = await renderer.run(render_analyses_pdf, rows)
+    except ReportQueueFull:
+        await callback.answer("⏳ Сейчас формируется много отчётов, попробуйте через минуту.", show_alert=True)
+        return
 
-    # --- Отправляем пользователю ---
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tf:
-        tf.write(buf.read())
-        path = tf.name
+    await _send_pdf(callback, cache_key, version, pdf)
 
-    await callback.message.answer_document(FSInputFile(path, filename='all_analyses.pdf'))
+
+async def _send_pdf(callback: CallbackQuery, cache_key, version: int, pdf: bytes):
+    # Отправляем прямо из памяти и запоминаем file_id для повторных запросов
+    sent = await callback.message.answer_document(BufferedInputFile(pdf, filename='all_analyses.pdf'))
+    report_cache.put(cache_key, version, sent.document.file_id if sent.document else pdf)
     await callback.answer()
-    os.remove(path)
+
+async def _dates_keyboard(session: AsyncSession, telegram_id: int, cursor=None, backward=False):
+    page = await dates_pager.fetch(
+        session,
+        select().where(Analysis.telegram_id == telegram_id, Analysis.date.isnot(None)).distinct(),
+        cursor, backward,
+    )
+    if not page.rows:
+        return None
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=d.strftime("%d.%m.%Y"), callback_data=f"view_date|{d.isoformat()}")]
+            for (d,) in page.rows
+        ] + [row for row in (dates_pager.nav_buttons(page),) if row]
+        + [[InlineKeyboardButton(text="🔙 Назад", callback_data="show_menu")]]
+    )
+
+
+@router.callback_query(F.data.startswith(dates_pager.prefix + "|"))
+async def view_dates_page(callback: CallbackQuery, session: AsyncSession):
+    cursor, backward = dates_pager.parse(callback.data)
+    kb = await _dates_keyboard(session, callback.from_user.id, cursor, backward)
+    if kb is None:
+        await callback.answer("Записи изменились, откройте список заново.", show_alert=True)
+        return
+    await _edit_page(callback, "Выберите дату сдачи:", kb)
 
 # 5. Вывод по дате
 @router.callback_query(F.data.startswith("view_date|"))
-async def view_date(callback: CallbackQuery):
+async def view_date(callback: CallbackQuery, session: AsyncSession):
     iso = callback.data.split("|", 1)[1]
     date = datetime.fromisoformat(iso).date()
-    async with async_session() as session:
-        q = select(Analysis.name, Analysis.result, Analysis.reference).where(
-            Analysis.telegram_id == callback.from_user.id,
-            Analysis.date == date
-        )
-        res = await session.execute(q)
-        rows = res.all()
+    q = select(
+        Analysis.name, Analysis.result, Analysis.reference,
+        Analysis.result_value, Analysis.ref_min, Analysis.ref_max
+    ).where(
+        Analysis.telegram_id == callback.from_user.id,
+        Analysis.date == date
+    )
+    res = await session.execute(q)
+    rows = res.all()
 
     if not rows:
         await callback.message.answer("Нет записей за выбранную дату.")
     else:
         text = f"<b>Результаты анализов за {date.strftime('%d.%m.%Y')}:</b>\n"
-        for name, result, reference in rows:
-            # пытаемся привести результат к числу (учёт 4,5 и 4.5)
-            res_num = None
-            if result:
-                try:
-                    res_num = float(result.replace(',', '.'))
-                except ValueError:
-                    pass
-
-            # парсим границы референсного диапазона
-            min_ref = max_ref = None
-            if reference:
-                parts = re.split(r'[^0-9,\.]+', reference)
-                nums = [p.replace(',', '.') for p in parts if p]
-                if len(nums) >= 2:
-                    try:
-                        min_ref, max_ref = float(nums[0]), float(nums[1])
-                    except ValueError:
-                        pass
-
-            # выбираем эмодзи
-            if res_num is not None and min_ref is not None and max_ref is not None:
-                emoji = '🟢' if min_ref <= res_num <= max_ref else '🔴'
-            else:
-                emoji = ''
-
+        for name, result, reference, result_value, ref_min, ref_max in rows:
+            emoji = status_emoji(result_value, ref_min, ref_max)
             text += f"{name} = {emoji}{result} ({reference})\n"
         await callback.message.answer(text)
         await callback.answer()
 
 # 6. Группы и отдельный анализ (динамика) — текущая реализация
-@router.callback_query(F.data.startswith("view_group|"))
-async def view_group(callback: CallbackQuery):
-    group = callback.data.split("|", 1)[1]
-    async with async_session() as session:
-        q = select(Analysis.name).where(
-            Analysis.telegram_id == callback.from_user.id,
-            Analysis.group_name == group
-        ).distinct()
-        res = await session.execute(q)
-        names = [r[0] for r in res.all()]
+@router.callback_query(ViewGroupCb.filter())
+async def view_group(callback: CallbackQuery, callback_data: ViewGroupCb, session: AsyncSession):
+    group = await name_registry.name(callback.from_user.id, GROUP, callback_data.id)
+    if group is None:
+        await callback.answer("Список устарел, откройте его заново.", show_alert=True)
+        return
+    q = select(Analysis.name).where(
+        Analysis.telegram_id == callback.from_user.id,
+        Analysis.group_name == group
+    ).distinct()
+    res = await session.execute(q)
+    names = [r[0] for r in res.all()]
 
     if not names:
         await callback.message.answer(
@@ -524,9 +611,10 @@ async def view_group(callback: CallbackQuery):
             reply_markup=None
         )
     else:
+        ids = await name_registry.ids(callback.from_user.id, ANALYSIS, names)
         kb = InlineKeyboardMarkup(
             inline_keyboard=[
-                [InlineKeyboardButton(text=n, callback_data=f"view_analysis|{n}")]
+                [InlineKeyboardButton(text=n, callback_data=ViewAnalysisCb(id=ids[n]).pack())]
                 for n in names
             ] + [[InlineKeyboardButton(text="🔙 Назад", callback_data="cancel_view")]]
         )
@@ -536,54 +624,145 @@ async def view_group(callback: CallbackQuery):
         )
     await callback.answer()
 
-@router.callback_query(F.data.startswith("view_analysis|"))
-async def view_analysis(callback: CallbackQuery):
-    name = callback.data.split("|", 1)[1]
-    async with async_session() as session:
-        q = select(Analysis).where(
-            Analysis.telegram_id == callback.from_user.id,
-            Analysis.name == name
-        ).order_by(desc(Analysis.date))
-        res = await session.execute(q)
-        analyses = res.scalars().all()
+async def _analysis_page(session: AsyncSession, telegram_id: int, name: str, cursor=None, backward=False):
+    page = await analysis_pager.fetch(
+        session,
+        select(Analysis).where(Analysis.telegram_id == telegram_id, Analysis.name == name),
+        cursor, backward,
+    )
+    lines = []
+    for row in page.rows:
+        a = row[0]
+        dt = a.date.strftime("%d.%m.%Y") if a.date else '—'
+        # 🟢 если в норме, 🔴 если вне — по числам, сохранённым при записи
+        emoji = status_emoji(a.result_value, a.ref_min, a.ref_max)
+        lines.append(
+            f"📅 {dt}: {emoji}{a.result or '—'} {a.units or ''} "
+            f"(Референс: {a.reference or '—'})"
+        )
+    text = page.fit(f"<b>Анализы {name}:</b>\n\n", lines)
+    name_id = await name_registry.id(telegram_id, ANALYSIS, name)
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        row for row in (
+            analysis_pager.nav_buttons(page),
+            [InlineKeyboardButton(text="📈 График", callback_data=ViewChartCb(id=name_id).pack())],
+        ) if row
+    ])
+    return page, text, kb
 
-    if not analyses:
+
+@router.callback_query(ViewAnalysisCb.filter())
+async def view_analysis(callback: CallbackQuery, callback_data: ViewAnalysisCb, session: AsyncSession):
+    name = await name_registry.name(callback.from_user.id, ANALYSIS, callback_data.id)
+    if name is None:
+        await callback.answer("Анализ не найден.", show_alert=True)
+        return
+    # Кэшируется первая страница — её открывают чаще всего
+    version = await get_version(session, callback.from_user.id)
+    cache_key = ("view_analysis", callback.from_user.id, name)
+    cached = report_cache.get(cache_key, version)
+    if cached is not None:
+        text, kb = cached
+        await callback.message.answer(text, reply_markup=kb)
+        await callback.answer()
+        return
+
+    page, text, kb = await _analysis_page(session, callback.from_user.id, name)
+    if not page.rows:
         await callback.message.answer(
             "У вас нет записей для этого анализа."
         )
     else:
-        text = f"<b>Анализы {name}:</b>\n\n"
-        for a in analyses:
-            dt = a.date.strftime("%d.%m.%Y") if a.date else '—'
-            res_num = None
-            if a.result:
-                try:
-                    res_num = float(a.result.replace(',', '.'))
-                except ValueError:
-                    pass
-
-            # парсим границы нормы из строки reference, например "60-80"
-            min_ref = max_ref = None
-            if a.reference:
-                parts = re.split(r'[^0-9,\.]+', a.reference)
-                nums = [p.replace(',', '.') for p in parts if p]
-                if len(nums) >= 2:
-                    try:
-                        min_ref, max_ref = float(nums[0]), float(nums[1])
-                    except ValueError:
-                        pass
-
-            # выбираем эмодзи: 🟢 если в норме, 🔴 если вне
-            if res_num is not None and min_ref is not None and max_ref is not None:
-                emoji = '🟢' if min_ref <= res_num <= max_ref else '🔴'
-            else:
-                emoji = ''
-
-            text += (
-                f"📅 {dt}: {emoji}{a.result or '—'} {a.units or ''} "
-                f"(Референс: {a.reference or '—'})\n"
-            )
-        await callback.message.answer(text)
+        report_cache.put(cache_key, version, (text, kb))
+        await callback.message.answer(text, reply_markup=kb)
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith(analysis_pager.prefix + "|"))
+async def view_analysis_page(callback: CallbackQuery, session: AsyncSession):
+    cursor, backward = analysis_pager.parse(callback.data)
+    # Название берём по id строки-курсора — в callback_data его не хранить
+    name = await session.scalar(
+        select(Analysis.name).where(Analysis.id == cursor[-1], Analysis.telegram_id == callback.from_user.id)
+    )
+    if name is None:
+        await callback.answer("Записи изменились, откройте анализ заново.", show_alert=True)
+        return
+    page, text, kb = await _analysis_page(session, callback.from_user.id, name, cursor, backward)
+    await _edit_page(callback, text, kb)
+
+
+async def _edit_page(callback: CallbackQuery, text: str, kb: InlineKeyboardMarkup):
+    try:
+        await callback.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass  # повторное нажатие: текст не изменился
+    await callback.answer()
+
+
+@router.callback_query(ViewChartCb.filter())
+async def view_chart(callback: CallbackQuery, callback_data: ViewChartCb, session: AsyncSession):
+    name = await name_registry.name(callback.from_user.id, ANALYSIS, callback_data.id)
+    if name is None:
+        await callback.answer("Анализ не найден.", show_alert=True)
+        return
+    # --- Готовый график этой версии: (file_id или png, подпись) ---
+    version = await get_version(session, callback.from_user.id)
+    cache_key = ("view_chart", callback.from_user.id, name)
+    cached = report_cache.get(cache_key, version)
+    if cached is not None:
+        photo, caption = cached
+        if not isinstance(photo, str):
+            await _send_chart(callback, cache_key, version, photo, caption)
+            return
+        try:
+            await callback.message.answer_photo(photo, caption=caption)
+            await callback.answer()
+            return
+        except TelegramBadRequest:
+            pass  # file_id больше не принимается — нарисуем заново
+
+    # --- Ряд значений столбцами: только даты и числа ---
+    res = await session.execute(
+        select(Analysis.date, Analysis.result_value, Analysis.ref_min, Analysis.ref_max, Analysis.units)
+        .where(
+            Analysis.telegram_id == callback.from_user.id,
+            Analysis.name == name,
+            Analysis.result_value.isnot(None),
+            Analysis.date.isnot(None),
+        )
+        .order_by(Analysis.date, Analysis.id)
+    )
+    rows = res.all()
+    if len(rows) < 2:
+        await callback.answer("Для графика нужно хотя бы два числовых результата.", show_alert=True)
+        return
+
+    days = [r.date.toordinal() for r in rows]
+    values = [r.result_value for r in rows]
+    last = rows[-1]
+    caption = trend_caption(name, last.units, series_stats(days, values), last.result_value, last.ref_min, last.ref_max)
+    series = {
+        "name": name, "units": last.units, "days": days, "values": values,
+        "ref_min": last.ref_min, "ref_max": last.ref_max,
+    }
+    try:
+        png = await renderer.run(render_trend_png, series)
+    except ReportQueueFull:
+        await callback.answer("⏳ Сейчас формируется много отчётов, попробуйте через минуту.", show_alert=True)
+        return
+    if png is None:
+        # Нет растрового бэкенда reportlab — остаётся сводка текстом
+        await callback.message.answer(caption)
+        await callback.answer()
+        return
+
+    await _send_chart(callback, cache_key, version, png, caption)
+
+
+async def _send_chart(callback: CallbackQuery, cache_key, version: int, png: bytes, caption: str):
+    sent = await callback.message.answer_photo(BufferedInputFile(png, filename='trend.png'), caption=caption)
+    report_cache.put(cache_key, version, (sent.photo[-1].file_id if sent.photo else png, caption))
     await callback.answer()
 
 # 7. Отмена просмотра
@@ -593,27 +772,41 @@ async def cancel_view(callback: CallbackQuery):
     await callback.answer()
     
 # --------------- Удаление анализов -----------------
+async def _delete_groups_keyboard(telegram_id: int, groups: list) -> InlineKeyboardMarkup:
+    ids = await name_registry.ids(telegram_id, GROUP, groups)
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=g, callback_data=DeleteGroupCb(id=ids[g]).pack())]
+            for g in groups
+        ] + [[InlineKeyboardButton(text="❌ Отмена", callback_data="del_cancel")]]
+    )
+
+
+async def _delete_names_keyboard(telegram_id: int, names: list) -> InlineKeyboardMarkup:
+    ids = await name_registry.ids(telegram_id, ANALYSIS, names)
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=n, callback_data=DeleteNameCb(id=ids[n]).pack())]
+            for n in names
+        ] + [[InlineKeyboardButton(text="◀️ Назад", callback_data="del_back")]]
+    )
+
+
 @router.message(F.text == "❌ Удалить анализ")
-async def start_delete_analysis(message: Message, state: FSMContext):
+async def start_delete_analysis(message: Message, state: FSMContext, session: AsyncSession):
     # Шаг 1: список групп
-    async with async_session() as session:
-        res = await session.execute(
-            select(Analysis.group_name)
-            .where(Analysis.telegram_id == message.from_user.id)
-            .distinct()
-        )
-        groups = [r[0] for r in res.all()]
+    res = await session.execute(
+        select(Analysis.group_name)
+        .where(Analysis.telegram_id == message.from_user.id)
+        .distinct()
+    )
+    groups = [r[0] for r in res.all()]
 
     if not groups:
         await message.answer("У вас ещё нет ни одного анализа для удаления.")
         return
 
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=g, callback_data=f"del_group|{g}")]
-            for g in groups
-        ] + [[InlineKeyboardButton(text="❌ Отмена", callback_data="del_cancel")]]
-    )
+    kb = await _delete_groups_keyboard(message.from_user.id, groups)
     await message.answer("Выберите группу анализа для удаления:", reply_markup=kb)
     await state.set_state(DeleteFlow.waiting_for_group)
 
@@ -624,90 +817,67 @@ async def cancel_delete_group(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.answer()
 
-@router.callback_query(DeleteFlow.waiting_for_group, F.data.startswith("del_group|"))
-async def choose_delete_group(callback: CallbackQuery, state: FSMContext):
-    group = callback.data.split("|", 1)[1]
+@router.callback_query(DeleteFlow.waiting_for_group, DeleteGroupCb.filter())
+async def choose_delete_group(callback: CallbackQuery, callback_data: DeleteGroupCb, state: FSMContext, session: AsyncSession):
+    group = await name_registry.name(callback.from_user.id, GROUP, callback_data.id)
+    if group is None:
+        await callback.answer("Список устарел, откройте его заново.", show_alert=True)
+        await state.clear()
+        return
     await state.update_data(group=group)
 
     # Шаг 2: список названий в группе
-    async with async_session() as session:
-        res = await session.execute(
-            select(Analysis.name)
-            .where(
-                Analysis.telegram_id == callback.from_user.id,
-                Analysis.group_name == group
-            )
-            .distinct()
+    res = await session.execute(
+        select(Analysis.name)
+        .where(
+            Analysis.telegram_id == callback.from_user.id,
+            Analysis.group_name == group
         )
-        names = [r[0] for r in res.all()]
+        .distinct()
+    )
+    names = [r[0] for r in res.all()]
 
     if not names:
         await callback.message.edit_text("В этой группе нет анализов.")
         await state.clear()
         return
 
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=n, callback_data=f"del_name|{n}")]
-            for n in names
-        ] + [[InlineKeyboardButton(text="◀️ Назад", callback_data="del_back")]]
-    )
+    kb = await _delete_names_keyboard(callback.from_user.id, names)
     await callback.message.edit_text("Выберите название анализа:", reply_markup=kb)
     await state.set_state(DeleteFlow.waiting_for_name)
     await callback.answer()
 
 # «Назад» к выбору группы
 @router.callback_query(DeleteFlow.waiting_for_name, F.data == "del_back")
-async def back_to_group(callback: CallbackQuery, state: FSMContext):
-    async with async_session() as session:
-        res = await session.execute(
-            select(Analysis.group_name)
-            .where(Analysis.telegram_id == callback.from_user.id)
-            .distinct()
-        )
-        groups = [r[0] for r in res.all()]
-
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=g, callback_data=f"del_group|{g}")]
-            for g in groups
-        ] + [[InlineKeyboardButton(text="❌ Отмена", callback_data="del_cancel")]]
+async def back_to_group(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
+    res = await session.execute(
+        select(Analysis.group_name)
+        .where(Analysis.telegram_id == callback.from_user.id)
+        .distinct()
     )
+    groups = [r[0] for r in res.all()]
+
+    kb = await _delete_groups_keyboard(callback.from_user.id, groups)
     await callback.message.edit_text("Выберите группу анализа для удаления:", reply_markup=kb)
     await state.set_state(DeleteFlow.waiting_for_group)
     await callback.answer()
 
-@router.callback_query(DeleteFlow.waiting_for_name, F.data.startswith("del_name|"))
-async def choose_delete_name(callback: CallbackQuery, state: FSMContext):
-    name = callback.data.split("|", 1)[1]
+@router.callback_query(DeleteFlow.waiting_for_name, DeleteNameCb.filter())
+async def choose_delete_name(callback: CallbackQuery, callback_data: DeleteNameCb, state: FSMContext, session: AsyncSession):
+    name = await name_registry.name(callback.from_user.id, ANALYSIS, callback_data.id)
+    if name is None:
+        await callback.answer("Список устарел, откройте его заново.", show_alert=True)
+        await state.clear()
+        return
     await state.update_data(name=name)
 
-    # Шаг 3: список конкретных записей
-    async with async_session() as session:
-        res = await session.execute(
-            select(Analysis)
-            .where(
-                Analysis.telegram_id == callback.from_user.id,
-                Analysis.name == name
-            )
-            .order_by(desc(Analysis.date))
-        )
-        analyses = res.scalars().all()
-
-    if not analyses:
+    # Шаг 3: список конкретных записей, по странице за раз
+    kb = await _delete_records_keyboard(session, callback.from_user.id, name)
+    if kb is None:
         await callback.message.edit_text("Нет записей для этого анализа.")
         await state.clear()
         return
 
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(
-                text=f"{a.date.strftime('%d.%m.%Y')}: {a.result or '—'} {a.units or ''}",
-                callback_data=f"del_select|{a.id}"
-            )]
-            for a in analyses
-        ] + [[InlineKeyboardButton(text="◀️ Назад", callback_data="del_back")]]
-    )
     await callback.message.edit_text(
         f"Вы выбрали «{name}». Выберите запись для удаления:",
         reply_markup=kb
@@ -715,37 +885,67 @@ async def choose_delete_name(callback: CallbackQuery, state: FSMContext):
     await state.set_state(DeleteFlow.waiting_for_analysis)
     await callback.answer()
 
+async def _delete_records_keyboard(session: AsyncSession, telegram_id: int, name: str, cursor=None, backward=False):
+    page = await delete_pager.fetch(
+        session,
+        select(Analysis.id, Analysis.result, Analysis.units)
+        .where(Analysis.telegram_id == telegram_id, Analysis.name == name),
+        cursor, backward,
+    )
+    if not page.rows:
+        return None
+    rows = [
+        [InlineKeyboardButton(
+            text=f"{row.date.strftime('%d.%m.%Y')}: {row.result or '—'} {row.units or ''}",
+            callback_data=f"del_select|{row.id}"
+        )]
+        for row in page.rows
+    ]
+    nav = delete_pager.nav_buttons(page)
+    if nav:
+        rows.append(nav)
+    rows.append([InlineKeyboardButton(text="◀️ Назад", callback_data="del_back")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@router.callback_query(DeleteFlow.waiting_for_analysis, F.data.startswith(delete_pager.prefix + "|"))
+async def choose_delete_record_page(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
+    cursor, backward = delete_pager.parse(callback.data)
+    name = (await state.get_data()).get("name")
+    kb = await _delete_records_keyboard(session, callback.from_user.id, name, cursor, backward) if name else None
+    if kb is None:
+        await callback.answer("Список изменился, откройте его заново.", show_alert=True)
+        return
+    try:
+        await callback.message.edit_reply_markup(reply_markup=kb)
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
+
 # «Назад» к выбору названия анализа
 @router.callback_query(DeleteFlow.waiting_for_analysis, F.data == "del_back")
-async def back_to_name(callback: CallbackQuery, state: FSMContext):
+async def back_to_name(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     group = data.get("group")
-    async with async_session() as session:
-        res = await session.execute(
-            select(Analysis.name)
-            .where(
-                Analysis.telegram_id == callback.from_user.id,
-                Analysis.group_name == group
-            )
-            .distinct()
+    res = await session.execute(
+        select(Analysis.name)
+        .where(
+            Analysis.telegram_id == callback.from_user.id,
+            Analysis.group_name == group
         )
-        names = [r[0] for r in res.all()]
-
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=n, callback_data=f"del_name|{n}")]
-            for n in names
-        ] + [[InlineKeyboardButton(text="◀️ Назад", callback_data="del_back")]]
+        .distinct()
     )
+    names = [r[0] for r in res.all()]
+
+    kb = await _delete_names_keyboard(callback.from_user.id, names)
     await callback.message.edit_text("Выберите название анализа:", reply_markup=kb)
     await state.set_state(DeleteFlow.waiting_for_name)
     await callback.answer()
 
 @router.callback_query(DeleteFlow.waiting_for_analysis, F.data.startswith("del_select|"))
-async def confirm_delete(callback: CallbackQuery, state: FSMContext):
+async def confirm_delete(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     analysis_id = int(callback.data.split("|", 1)[1])
-    async with async_session() as session:
-        analysis = await session.get(Analysis, analysis_id)
+    analysis = await session.get(Analysis, analysis_id)
 
     if not analysis:
         await callback.message.edit_text("Запись не найдена.")
@@ -767,11 +967,20 @@ async def confirm_delete(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.callback_query(DeleteFlow.confirm_delete, F.data.startswith("del_confirm|"))
-async def process_delete_confirm(callback: CallbackQuery, state: FSMContext):
+async def process_delete_confirm(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     analysis_id = int(callback.data.split("|", 1)[1])
-    async with async_session() as session:
-        async with session.begin():
-            await session.execute(delete(Analysis).where(Analysis.id == analysis_id))
+    name = await session.scalar(select(Analysis.name).where(
+        Analysis.id == analysis_id,
+        Analysis.telegram_id == callback.from_user.id
+    ))
+    await session.execute(delete(Analysis).where(
+        Analysis.id == analysis_id,
+        Analysis.telegram_id == callback.from_user.id
+    ))
+    if name is not None:
+        await refresh_latest(session, callback.from_user.id, name)
+    await bump_version(session, callback.from_user.id)
+    await session.commit()
 
     await callback.message.edit_text("✅ Анализ успешно удалён.")
     await state.clear()
@@ -4,16 +4,37 @@ from aiogram.types import(
     CallbackQuery
     )
 from aiogram.fsm.context import FSMContext
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
+from aiogram.exceptions import TelegramBadRequest
 from datetime import datetime
 
 from keyboards.main_menu import InlineKeyboardButton, InlineKeyboardMarkup, doctor_keyboard
+from keyboards.callbacks import DoctorCb
 from states.appointment_states import AppointmentFlow, EditAppointmentState
-from db import DoctorAppointment, async_session
+from db import DoctorAppointment
+from services.pagination import KeysetPager, BUTTON_PAGE_SIZE, TEXT_PAGE_SIZE
+from services.name_registry import name_registry, DOCTOR
+from services.reminders import schedule_visit, unschedule_visit
 
 
 router = Router() 
 
+appointments_pager = KeysetPager(
+    "pg:ap", DoctorAppointment.appointment_date, DoctorAppointment.id, size=TEXT_PAGE_SIZE
+)
+# Кнопки назначений для редактирования и удаления: prefix → (pager, префикс callback кнопки)
+edit_appointments_pager = KeysetPager(
+    "pg:ape", DoctorAppointment.appointment_date, DoctorAppointment.id, size=BUTTON_PAGE_SIZE
+)
+delete_appointments_pager = KeysetPager(
+    "pg:apd", DoctorAppointment.appointment_date, DoctorAppointment.id, size=BUTTON_PAGE_SIZE
+)
+_APPOINTMENT_LISTS = {
+    edit_appointments_pager.prefix: (edit_appointments_pager, "edit_appt_"),
+    delete_appointments_pager.prefix: (delete_appointments_pager, "delete_appt_"),
+}
+
 @router.message(F.text == "💊 Назначения врачей")
 async def analyses_menu_handler(message: Message):
     await message.answer("Выберите действие с Назначениями врачей:", reply_markup=doctor_keyboard)
@@ -47,7 +68,7 @@ async def process_doctor(message: Message, state: FSMContext):
 
 # Обработка одной рекомендации
 @router.message(AppointmentFlow.recommendation)
-async def process_recommendation(message: Message, state: FSMContext):
+async def process_recommendation(message: Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     appt = DoctorAppointment(
         telegram_id=message.from_user.id,
@@ -55,9 +76,9 @@ async def process_recommendation(message: Message, state: FSMContext):
         doctor=data["doctor"],
         recommendation=message.text.strip()
     )
-    async with async_session() as session:
-        async with session.begin():
-            session.add(appt)
+    session.add(appt)
+    await schedule_visit(session, appt.telegram_id, appt.doctor, appt.appointment_date)
+    await session.commit()
 
     # Предлагаем, что делать дальше
     kb = InlineKeyboardMarkup(inline_keyboard=[[
@@ -93,107 +114,179 @@ async def finish_appointments(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     
 # --------------- Посмотреть назначение -----------------
+async def _doctors_rows(telegram_id: int, doctors: list, action: str) -> list:
+    # В кнопке — id врача из реестра: имя может не влезть в 64 байта callback_data
+    ids = await name_registry.ids(telegram_id, DOCTOR, doctors)
+    return [
+        [InlineKeyboardButton(text=doc, callback_data=DoctorCb(action=action, id=ids[doc]).pack())]
+        for doc in doctors
+    ]
+
+
+async def _doctor_name(callback: types.CallbackQuery, callback_data: DoctorCb):
+    """Имя врача по id из кнопки; None (с алертом), если кнопка устарела"""
+    doctor = await name_registry.name(callback.from_user.id, DOCTOR, callback_data.id)
+    if doctor is None:
+        await callback.answer("Список устарел, откройте его заново.", show_alert=True)
+    return doctor
+
 @router.message(F.text == "📋 Посмотреть назначения")
-async def view_doctor_appointments(message: types.Message):
+async def view_doctor_appointments(message: types.Message, session: AsyncSession):
     telegram_id = message.from_user.id
 
-    async with async_session() as session:
-        result = await session.execute(
-            select(DoctorAppointment.doctor).where(DoctorAppointment.telegram_id == telegram_id)
-        )
-        doctors = list(set(row[0] for row in result.fetchall()))
+    result = await session.execute(
+        select(DoctorAppointment.doctor).where(DoctorAppointment.telegram_id == telegram_id)
+    )
+    doctors = list(set(row[0] for row in result.fetchall()))
 
     if not doctors:
         await message.answer("У вас пока нет назначений.")
         return
 
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=doc, callback_data=f"view_appt_{doc}")]
-            for doc in doctors
-        ]
-    )
+    keyboard = InlineKeyboardMarkup(inline_keyboard=await _doctors_rows(telegram_id, doctors, "view"))
     await message.answer("Выберите врача, чтобы посмотреть назначения:", reply_markup=keyboard)
     
-@router.callback_query(F.data.startswith("view_appt_"))
-async def show_appointments_by_doctor(callback: types.CallbackQuery):
+async def _appointments_page(session: AsyncSession, telegram_id: int, doctor: str, cursor=None, backward=False):
+    page = await appointments_pager.fetch(
+        session,
+        select(DoctorAppointment).where(
+            DoctorAppointment.telegram_id == telegram_id,
+            DoctorAppointment.doctor == doctor
+        ),
+        cursor, backward,
+    )
+    lines = []
+    for row in page.rows:
+        appt = row[0]
+        date = appt.appointment_date.strftime("%d.%m.%Y")
+        lines.append(f"🗓 <b>{date}</b>\n📝 {appt.recommendation}\n")
+    text = page.fit(f"📋 Назначения от врача: <b>{doctor}</b>\n\n", lines)
+    nav = appointments_pager.nav_buttons(page)
+    return page, text, InlineKeyboardMarkup(inline_keyboard=[nav] if nav else [])
+
+
+@router.callback_query(DoctorCb.filter(F.action == "view"))
+async def show_appointments_by_doctor(callback: types.CallbackQuery, callback_data: DoctorCb, session: AsyncSession):
     telegram_id = callback.from_user.id
-    doctor = callback.data.removeprefix("view_appt_")
-
-    async with async_session() as session:
-        result = await session.execute(
-            select(DoctorAppointment).where(
-                DoctorAppointment.telegram_id == telegram_id,
-                DoctorAppointment.doctor == doctor
-            ).order_by(DoctorAppointment.appointment_date.desc())
-        )
-        appointments = result.scalars().all()
+    doctor = await _doctor_name(callback, callback_data)
+    if doctor is None:
+        return
 
-    if not appointments:
+    page, text, kb = await _appointments_page(session, telegram_id, doctor)
+    if not page.rows:
         await callback.message.answer("Назначений от этого врача не найдено.")
         await callback.answer()
         return
 
-    text = f"📋 Назначения от врача: <b>{doctor}</b>\n\n"
-    for appt in appointments:
-        date = appt.appointment_date.strftime("%d.%m.%Y")
-        text += f"🗓 <b>{date}</b>\n📝 {appt.recommendation}\n\n"
+    await callback.message.answer(text, reply_markup=kb)
+    await callback.answer()
+
 
-    await callback.message.answer(text)
+@router.callback_query(F.data.startswith(appointments_pager.prefix + "|"))
+async def show_appointments_page(callback: types.CallbackQuery, session: AsyncSession):
+    cursor, backward = appointments_pager.parse(callback.data)
+    # Врач — по id строки-курсора
+    doctor = await session.scalar(
+        select(DoctorAppointment.doctor).where(
+            DoctorAppointment.id == cursor[-1],
+            DoctorAppointment.telegram_id == callback.from_user.id
+        )
+    )
+    if doctor is None:
+        await callback.answer("Назначения изменились, откройте список заново.", show_alert=True)
+        return
+    page, text, kb = await _appointments_page(session, callback.from_user.id, doctor, cursor, backward)
+    try:
+        await callback.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        pass
     await callback.answer()
 
 # --------------- Редактировать назначение -----------------
 
+async def _appointment_buttons(session: AsyncSession, telegram_id: int, doctor: str, pager: KeysetPager,
+                               cursor=None, backward=False):
+    action = _APPOINTMENT_LISTS[pager.prefix][1]
+    page = await pager.fetch(
+        session,
+        select(DoctorAppointment.id, DoctorAppointment.recommendation).where(
+            DoctorAppointment.telegram_id == telegram_id,
+            DoctorAppointment.doctor == doctor
+        ),
+        cursor, backward,
+    )
+    if not page.rows:
+        return None
+
+    rows = [
+        [InlineKeyboardButton(
+            text=f"{row.appointment_date.strftime('%d.%m.%Y')} {row.recommendation[:25]}{'...' if len(row.recommendation) > 25 else ''}",
+            callback_data=f"{action}{row.id}"
+        )]
+        for row in page.rows
+    ]
+    nav = pager.nav_buttons(page)
+    if nav:
+        rows.append(nav)
+    if pager is delete_appointments_pager:
+        rows.append([InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_delete")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@router.callback_query(F.data.startswith(edit_appointments_pager.prefix + "|"))
+@router.callback_query(F.data.startswith(delete_appointments_pager.prefix + "|"))
+async def appointment_buttons_page(callback: types.CallbackQuery, session: AsyncSession):
+    pager = _APPOINTMENT_LISTS[callback.data.split("|", 1)[0]][0]
+    cursor, backward = pager.parse(callback.data)
+    # Врач — по id строки-курсора, как в show_appointments_page
+    doctor = await session.scalar(
+        select(DoctorAppointment.doctor).where(
+            DoctorAppointment.id == cursor[-1],
+            DoctorAppointment.telegram_id == callback.from_user.id
+        )
+    )
+    kb = None
+    if doctor is not None:
+        kb = await _appointment_buttons(session, callback.from_user.id, doctor, pager, cursor, backward)
+    if kb is None:
+        await callback.answer("Назначения изменились, откройте список заново.", show_alert=True)
+        return
+    try:
+        await callback.message.edit_reply_markup(reply_markup=kb)
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
+
+
 @router.message(F.text == "✏️ Редактировать назначения")
-async def choose_doctor_to_edit(callback: types.Message):
+async def choose_doctor_to_edit(callback: types.Message, session: AsyncSession):
     telegram_id = callback.from_user.id
 
-    async with async_session() as session:
-        result = await session.execute(
-            select(DoctorAppointment.doctor).where(DoctorAppointment.telegram_id == telegram_id)
-        )
-        doctors = list(set(row[0] for row in result.fetchall()))
+    result = await session.execute(
+        select(DoctorAppointment.doctor).where(DoctorAppointment.telegram_id == telegram_id)
+    )
+    doctors = list(set(row[0] for row in result.fetchall()))
 
     if not doctors:
         await callback.answer("У вас пока нет назначений.")
         return
 
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=doc, callback_data=f"edit_doc_{doc}")]
-            for doc in doctors
-        ]
-    )
+    keyboard = InlineKeyboardMarkup(inline_keyboard=await _doctors_rows(telegram_id, doctors, "edit"))
     await callback.answer("Выберите врача для редактирования назначения:", reply_markup=keyboard)
 
 # Обработчик выбора врача для редактирования
-@router.callback_query(F.data.startswith("edit_doc_"))
-async def choose_appointment_to_edit(callback: types.CallbackQuery):
+@router.callback_query(DoctorCb.filter(F.action == "edit"))
+async def choose_appointment_to_edit(callback: types.CallbackQuery, callback_data: DoctorCb, session: AsyncSession):
     telegram_id = callback.from_user.id
-    doctor = callback.data.removeprefix("edit_doc_")
-
-    async with async_session() as session:
-        result = await session.execute(
-            select(DoctorAppointment).where(
-                DoctorAppointment.telegram_id == telegram_id,
-                DoctorAppointment.doctor == doctor
-            ).order_by(DoctorAppointment.appointment_date.desc())
-        )
-        appointments = result.scalars().all()
+    doctor = await _doctor_name(callback, callback_data)
+    if doctor is None:
+        return
 
-    if not appointments:
+    keyboard = await _appointment_buttons(session, telegram_id, doctor, edit_appointments_pager)
+    if keyboard is None:
         await callback.message.edit_text("У этого врача нет назначений.")
         return
 
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(
-                text=f"{appt.appointment_date.strftime('%d.%m.%Y')} {appt.recommendation[:25]}{'...' if len(appt.recommendation) > 25 else ''}",
-                callback_data=f"edit_appt_{appt.id}"
-            )]
-            for appt in appointments
-        ]
-    )
     await callback.message.edit_text("Выберите назначение для редактирования:", reply_markup=keyboard)
 
 # Обработчик выбора назначения для редактирования
@@ -211,22 +304,21 @@ async def ask_for_new_text(callback: types.CallbackQuery, state: FSMContext):
 
 # Обработчик ввода нового текста для назначения
 @router.message(EditAppointmentState.waiting_for_text)
-async def save_edited_text(message: types.Message, state: FSMContext):
+async def save_edited_text(message: types.Message, state: FSMContext, session: AsyncSession):
     new_text = message.text
     data = await state.get_data()
     appt_id = data['appt_id']
 
-    async with async_session() as session:
-        result = await session.execute(select(DoctorAppointment).where(DoctorAppointment.id == appt_id))
-        appt = result.scalar_one_or_none()
+    result = await session.execute(select(DoctorAppointment).where(DoctorAppointment.id == appt_id))
+    appt = result.scalar_one_or_none()
 
-        if not appt:
-            await message.answer("Ошибка: назначение не найдено.")
-            await state.clear()
-            return
+    if not appt:
+        await message.answer("Ошибка: назначение не найдено.")
+        await state.clear()
+        return
 
-        appt.recommendation = new_text
-        await session.commit()
+    appt.recommendation = new_text
+    await session.commit()
 
     await message.answer("Текст назначения успешно обновлён ✅")
     await state.clear()
@@ -241,25 +333,19 @@ async def cancel_edit(callback: types.CallbackQuery, state: FSMContext):
 
 # Обработчик команды "Удалить назначения"
 @router.message(F.text == "❌ Удалить назначения")
-async def choose_doctor_to_delete(callback: types.Message):
+async def choose_doctor_to_delete(callback: types.Message, session: AsyncSession):
     telegram_id = callback.from_user.id
 
-    async with async_session() as session:
-        result = await session.execute(
-            select(DoctorAppointment.doctor).where(DoctorAppointment.telegram_id == telegram_id)
-        )
-        doctors = list(set(row[0] for row in result.fetchall()))  # Уникальные врачи
+    result = await session.execute(
+        select(DoctorAppointment.doctor).where(DoctorAppointment.telegram_id == telegram_id)
+    )
+    doctors = list(set(row[0] for row in result.fetchall()))  # Уникальные врачи
 
     if not doctors:
         await callback.answer("У вас пока нет назначений.")
         return
 
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=doc, callback_data=f"delete_doc_{doc}")]
-            for doc in doctors
-        ]
-    )
+    keyboard = InlineKeyboardMarkup(inline_keyboard=await _doctors_rows(telegram_id, doctors, "delete"))
 
     # Добавляем кнопку отмены
     keyboard.inline_keyboard.append([InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_delete")])
@@ -268,38 +354,19 @@ async def choose_doctor_to_delete(callback: types.Message):
 
 
 # Обработчик выбора врача для удаления
-@router.callback_query(F.data.startswith("delete_doc_"))
-async def choose_appointment_to_delete(callback: types.CallbackQuery):
+@router.callback_query(DoctorCb.filter(F.action == "delete"))
+async def choose_appointment_to_delete(callback: types.CallbackQuery, callback_data: DoctorCb, session: AsyncSession):
     telegram_id = callback.from_user.id
-    doctor = callback.data.removeprefix("delete_doc_")
-
-    async with async_session() as session:
-        result = await session.execute(
-            select(DoctorAppointment).where(
-                DoctorAppointment.telegram_id == telegram_id,
-                DoctorAppointment.doctor == doctor
-            ).order_by(DoctorAppointment.appointment_date.desc())
-        )
-        appointments = result.scalars().all()
+    doctor = await _doctor_name(callback, callback_data)
+    if doctor is None:
+        return
 
-    if not appointments:
+    # Кнопка отмены добавляется в _appointment_buttons
+    keyboard = await _appointment_buttons(session, telegram_id, doctor, delete_appointments_pager)
+    if keyboard is None:
         await callback.message.edit_text("У этого врача нет назначений.")
         return
 
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(
-                text=f"{appt.appointment_date.strftime('%d.%m.%Y')} {appt.recommendation[:25]}{'...' if len(appt.recommendation) > 25 else ''}",
-                callback_data=f"delete_appt_{appt.id}"
-            )]
-            for appt in appointments
-        ]
-    )
-
-    # Добавляем кнопку отмены с использованием append
-    cancel_button = InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_delete")
-    keyboard.inline_keyboard.append([cancel_button])  # исправлено на append
-
     await callback.message.edit_text("Выберите назначение для удаления:", reply_markup=keyboard)
 
 
@@ -318,22 +385,23 @@ async def confirm_delete_appointment(callback: types.CallbackQuery, state: FSMCo
 
 # Обработчик подтверждения удаления
 @router.callback_query(F.data == "confirm_delete_yes")
-async def delete_appointment(callback: types.CallbackQuery, state: FSMContext):
+async def delete_appointment(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     appt_id = data['appt_id']
 
-    async with async_session() as session:
-        result = await session.execute(select(DoctorAppointment).where(DoctorAppointment.id == appt_id))
-        appt = result.scalar_one_or_none()
+    result = await session.execute(select(DoctorAppointment).where(DoctorAppointment.id == appt_id))
+    appt = result.scalar_one_or_none()
 
-        if not appt:
-            await callback.message.edit_text("Ошибка: назначение не найдено.")
-            await state.clear()
-            return
+    if not appt:
+        await callback.message.edit_text("Ошибка: назначение не найдено.")
+        await state.clear()
+        return
 
-        # Удаляем назначение
-        await session.delete(appt)
-        await session.commit()
+    # Удаляем назначение, а с последним назначением визита — и его напоминания
+    await session.delete(appt)
+    await session.flush()
+    await unschedule_visit(session, appt.telegram_id, appt.doctor, appt.appointment_date)
+    await session.commit()
 
     await callback.message.edit_text("Назначение успешно удалено ✅")
     await state.clear()
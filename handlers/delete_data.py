@@ -1,10 +1,11 @@
 from aiogram import Router, types, F
 from states.del_states import DeleteAllData
 from aiogram.fsm.context import FSMContext
-from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from db import async_session, UserData, Analysis, DoctorAppointment, InstrumentalExamination, Recommendation
 from states.del_states import DeleteAllData 
+from services.purge import request_purge, data_purger
+from services.name_registry import name_registry
 
 router = Router() 
 
@@ -20,20 +21,15 @@ async def start_delete_all_data(message: types.Message, state: FSMContext):
 
 # Обработка ответа
 @router.message(DeleteAllData.waiting_for_confirmation)
-async def process_delete_confirmation(message: types.Message, state: FSMContext):
+async def process_delete_confirmation(message: types.Message, state: FSMContext, session: AsyncSession):
     if message.text.strip().upper() == "ПОДТВЕРЖДАЮ":
-        telegram_id = message.from_user.id
-        async with async_session() as session:
-            # Удаляем данные из всех таблиц
-            await session.execute(delete(Analysis).where(Analysis.telegram_id == telegram_id))
-            await session.execute(delete(DoctorAppointment).where(DoctorAppointment.telegram_id == telegram_id))
-            await session.execute(delete(InstrumentalExamination).where(InstrumentalExamination.telegram_id == telegram_id))
-            await session.execute(delete(Recommendation).where(Recommendation.telegram_id == telegram_id))
-            await session.execute(delete(UserData).where(UserData.telegram_id == telegram_id))
+        # Удаление идёт в фоне пачками (services/purge.py) — по окончании придёт сообщение
+        if await request_purge(session, message.from_user.id, message.chat.id):
             await session.commit()
-
-        await message.answer("🔍 Все ваши данные были успешно удалены."
-        )
+            data_purger.wake()
+        # Кэш id ↔ название — в этом процессе: удаление может идти в другом
+        name_registry.forget_user(message.from_user.id)
+        await message.answer("⏳ Удаляю ваши данные. Пришлю сообщение, когда всё будет удалено.")
     else:
         await message.answer("🚫 Удаление отменено.")
 
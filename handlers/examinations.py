@@ -1,62 +1,66 @@
+import logging
+import lzma
+import zlib
+
 from aiogram import Router, F, types
 from aiogram.types import (
     Message,
     InlineKeyboardMarkup,
-    InlineKeyboardButton,
-    FSInputFile
+    InlineKeyboardButton
 )
 from aiogram.fsm.context import FSMContext
-from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, update
 from datetime import datetime
-from aiogram.exceptions import TelegramAPIError
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
 from aiogram.filters import StateFilter
 from aiogram.filters.command import Command
-import os
 
 from keyboards.main_menu import InlineKeyboardButton, InlineKeyboardMarkup, examination_keyboard
 from states.examination_states import EditExamStates 
-from db import  async_session, InstrumentalExamination
+from db import InstrumentalExamination, StoredFile
+from services.pagination import KeysetPager, BUTTON_PAGE_SIZE
+from services.file_store import file_store, FileTooLarge, FILE_MAX_MB, StoredInputFile
 
 
 router = Router() 
+logger = logging.getLogger(__name__)
 
-UPLOAD_DIR = "uploaded_files"  # Папка для сохранения файлов
-
-# Создание директории, если её нет
-if not os.path.exists(UPLOAD_DIR):
-    os.makedirs(UPLOAD_DIR)
+# Списки обследований для просмотра, редактирования и удаления: pager → callback кнопки
+examinations_pager = KeysetPager(
+    "pg:ex", InstrumentalExamination.examination_date, InstrumentalExamination.id, size=BUTTON_PAGE_SIZE
+)
+edit_examinations_pager = KeysetPager(
+    "pg:exe", InstrumentalExamination.examination_date, InstrumentalExamination.id, size=BUTTON_PAGE_SIZE
+)
+delete_examinations_pager = KeysetPager(
+    "pg:exd", InstrumentalExamination.examination_date, InstrumentalExamination.id, size=BUTTON_PAGE_SIZE
+)
+_EXAMINATION_LISTS = {
+    examinations_pager.prefix: (examinations_pager, "view_examination"),
+    edit_examinations_pager.prefix: (edit_examinations_pager, "edit_examination"),
+    delete_examinations_pager.prefix: (delete_examinations_pager, "choose_examination_to_delete"),
+}
 
 async def save_examination_file(message: Message):
+    """Кладёт присланный документ в хранилище; поля файла для InstrumentalExamination или None"""
     try:
         if not message.document:
             return None
 
-        file_info = await message.bot.get_file(message.document.file_id)
-        file_name = message.document.file_name
-
-        # Генерируем уникальный путь
-        file_path = get_unique_file_path(UPLOAD_DIR, file_name)
-
-        # Сохраняем файл
-        await message.bot.download(message.document.file_id, destination=file_path)
-
-        return file_path
+        stored = await file_store.save_from_telegram(message.bot, message.document.file_id)
+        return {
+            "file": stored.path,
+            "file_hash": stored.sha256,
+            "file_name": message.document.file_name or "file",
+            # Этот же документ бот может переслать по file_id, не загружая заново
+            "tg_file_id": message.document.file_id,
+            "tg_file_unique_id": message.document.file_unique_id,
+        }
 
     except TelegramAPIError as e:
         print(f"Ошибка при получении файла: {e}")
         return None
-    
-def get_unique_file_path(upload_dir: str, original_name: str) -> str:
-    """Формирует уникальное имя файла, если такой файл уже есть"""
-    base, extension = os.path.splitext(original_name)
-    counter = 1
-    new_name = original_name
-
-    while os.path.exists(os.path.join(upload_dir, new_name)):
-        new_name = f"{base}_{counter}{extension}"
-        counter += 1
-
-    return os.path.join(upload_dir, new_name)
 
 @router.message(F.text == "🩻 Обследования")
 async def examinations_menu_handler(message: types.Message):
@@ -92,25 +96,30 @@ async def get_examination_description(message: types.Message, state: FSMContext)
     await state.set_state("examination_file")
 
 @router.message(StateFilter("examination_file"), F.document)
-async def get_examination_file(message: types.Message, state: FSMContext):
+async def get_examination_file(message: types.Message, state: FSMContext, session: AsyncSession):
     file = message.document
 
-    if file.file_size > 50 * 1024 * 1024:
-        await message.answer("❗ Файл слишком большой. Пожалуйста, прикрепите файл размером до 50 МБ.")
+    # file_size от клиента — только быстрая проверка; настоящая — при скачивании
+    if file.file_size and file.file_size > FILE_MAX_MB * 1024 * 1024:
+        await message.answer(f"❗ Файл слишком большой. Пожалуйста, прикрепите файл размером до {FILE_MAX_MB} МБ.")
         return
 
-    # Сохраняем файл и получаем путь
-    file_path = await save_examination_file(message)
+    # Сохраняем файл и получаем путь, хэш и исходное имя
+    try:
+        stored = await save_examination_file(message)
+    except FileTooLarge:
+        await message.answer(f"❗ Файл слишком большой. Пожалуйста, прикрепите файл размером до {FILE_MAX_MB} МБ.")
+        return
 
-    await state.update_data(file=file_path)
-    await save_examination(message, state)
+    await state.update_data(**(stored or {"file": None}))
+    await save_examination(message, state, session)
 
 @router.message(StateFilter("examination_file"), Command("skip"))
-async def skip_examination_file(message: types.Message, state: FSMContext):
+async def skip_examination_file(message: types.Message, state: FSMContext, session: AsyncSession):
     await state.update_data(file=None)
-    await save_examination(message, state)
+    await save_examination(message, state, session)
 
-async def save_examination(message: types.Message, state: FSMContext):
+async def save_examination(message: types.Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
 
     # Создаем новый объект обследования
@@ -120,62 +129,91 @@ async def save_examination(message: types.Message, state: FSMContext):
         examination_date=data["date"],
         description=data["description"],
         file_path=data.get("file"),  # file_path теперь хранит путь к файлу
+        file_name=data.get("file_name"),
+        file_hash=data.get("file_hash"),
+        tg_file_id=data.get("tg_file_id"),
+        tg_file_unique_id=data.get("tg_file_unique_id"),
         created_at=datetime.utcnow()
     )
 
     # Сохраняем в базе данных
-    async with async_session() as session:
-        session.add(new_exam)
-        await session.commit()
+    session.add(new_exam)
+    await session.commit()
 
     await message.answer("✅ Обследование успешно добавлено.")
     await state.clear()
 # --------------- Посмотреть обследования -----------------
 
-# 1) Список обследований
-@router.message(F.text == "📋 Посмотреть обследования")
-async def view_examinations(message: types.Message):
-    async with async_session() as session:
-        result = await session.execute(
-            select(InstrumentalExamination.id, InstrumentalExamination.name)
-            .where(InstrumentalExamination.telegram_id == message.from_user.id)
-            .distinct()
-        )
-
-        exams = result.all()  # список кортежей (id, name)
-
-    if not exams:
-        await message.answer("❗ Пока нет доступных обследований.")
-        return
+# 1) Список обследований, новые сверху, по странице за раз
+async def _examinations_keyboard(session: AsyncSession, telegram_id: int, cursor=None, backward=False,
+                                 pager: KeysetPager = examinations_pager):
+    action = _EXAMINATION_LISTS[pager.prefix][1]
+    page = await pager.fetch(
+        session,
+        select(InstrumentalExamination.id, InstrumentalExamination.name)
+        .where(InstrumentalExamination.telegram_id == telegram_id),
+        cursor, backward,
+    )
+    if not page.rows:
+        return None
 
     # Кнопка для каждого обследования хранит в callback_data его ID
     rows = [
         [
             InlineKeyboardButton(
-                text=name,
-                callback_data=f"view_examination:{exam_id}"
+                text=row.name,
+                callback_data=f"{action}:{row.id}"
             )
         ]
-        for exam_id, name in exams
+        for row in page.rows
     ]
-    keyboard = InlineKeyboardMarkup(inline_keyboard=rows)
+    nav = pager.nav_buttons(page)
+    if nav:
+        rows.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@router.message(F.text == "📋 Посмотреть обследования")
+async def view_examinations(message: types.Message, session: AsyncSession):
+    keyboard = await _examinations_keyboard(session, message.from_user.id)
+
+    if keyboard is None:
+        await message.answer("❗ Пока нет доступных обследований.")
+        return
+
     await message.answer("Выберите обследование для просмотра:", reply_markup=keyboard)
 
 
+@router.callback_query(F.data.startswith(examinations_pager.prefix + "|"))
+@router.callback_query(F.data.startswith(edit_examinations_pager.prefix + "|"))
+@router.callback_query(F.data.startswith(delete_examinations_pager.prefix + "|"))
+async def view_examinations_page(callback: types.CallbackQuery, session: AsyncSession):
+    pager = _EXAMINATION_LISTS[callback.data.split("|", 1)[0]][0]
+    cursor, backward = pager.parse(callback.data)
+    keyboard = await _examinations_keyboard(session, callback.from_user.id, cursor, backward, pager)
+    if keyboard is None:
+        await callback.answer("Список изменился, откройте его заново.", show_alert=True)
+        return
+    try:
+        await callback.message.edit_reply_markup(reply_markup=keyboard)
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
+
+
 # 2) Детали выбранного обследования
 @router.callback_query(F.data.startswith("view_examination:"))
-async def view_examination_details(callback_query: types.CallbackQuery):
+async def view_examination_details(callback_query: types.CallbackQuery, session: AsyncSession):
     exam_id = int(callback_query.data.split(":", 1)[1])
 
-    async with async_session() as session:
-        result = await session.execute(
-            select(InstrumentalExamination)
-            .where(
-                InstrumentalExamination.id == exam_id,
-                InstrumentalExamination.telegram_id == callback_query.from_user.id
-            )
-)
-        exam = result.scalar_one_or_none()
+    result = await session.execute(
+        select(InstrumentalExamination)
+        .where(
+            InstrumentalExamination.id == exam_id,
+            InstrumentalExamination.telegram_id == callback_query.from_user.id
+        )
+    )
+    exam = result.scalar_one_or_none()
 
     if not exam:
         await callback_query.answer("❗ Обследование не найдено.", show_alert=True)
@@ -213,28 +251,53 @@ async def view_examination_details(callback_query: types.CallbackQuery):
 
 # 3) Загрузка файла
 @router.callback_query(F.data.startswith("download:"))
-async def download_file(callback_query: types.CallbackQuery):
+async def download_file(callback_query: types.CallbackQuery, session: AsyncSession):
     exam_id = int(callback_query.data.split(":", 1)[1])
 
-    async with async_session() as session:
-        result = await session.execute(
-            select(InstrumentalExamination.file_path).filter_by(id=exam_id)
-        )
-        file_path = result.scalar_one_or_none()
+    exam = await session.get(InstrumentalExamination, exam_id)
 
-    if not file_path:
+    if not exam or exam.telegram_id != callback_query.from_user.id or not exam.file_path:
         await callback_query.answer("❗ Файл не найден в базе.", show_alert=True)
         return
 
     await callback_query.answer("📥 Загружаю файл...")
 
+    # Файл уже есть у Telegram — отправляем по file_id: ни БД, ни диска, ни исходящего трафика.
+    # last_access при этом не трогаем: такой файл может сжаться, читать его с диска не нужно.
+    if exam.tg_file_id:
+        try:
+            await callback_query.message.answer_document(exam.tg_file_id)
+            return
+        except TelegramBadRequest:
+            pass  # file_id устарел или чужого бота — отправим с диска и запомним новый
+
+    compression = None
+    if exam.file_hash:
+        # Файл читается с диска — снова «горячий», фоновое сжатие его не тронет
+        await session.execute(
+            update(StoredFile).where(StoredFile.sha256 == exam.file_hash).values(last_access=datetime.utcnow())
+        )
+        await session.commit()
+        compression = await session.scalar(select(StoredFile.compression).where(StoredFile.sha256 == exam.file_hash))
+
     try:
-        document = FSInputFile(path=file_path)
-        await callback_query.message.answer_document(document)
+        # Объект в хранилище назван по хэшу — пользователю отдаём исходное имя;
+        # сжатый холодный файл распаковывается по ходу отправки
+        document = StoredInputFile(exam.file_path, compression, filename=exam.file_name)
+        async with file_store.transfer():
+            sent = await callback_query.message.answer_document(document)
     except FileNotFoundError:
         await callback_query.message.answer("❗ Файл отсутствует на сервере.")
-    except Exception:
+        return
+    except (TelegramAPIError, OSError, zlib.error, lzma.LZMAError):
+        logger.exception("Не удалось отправить файл обследования %s", exam.id)
         await callback_query.message.answer("❗ Не удалось отправить файл.")
+        return
+
+    if sent.document:
+        exam.tg_file_id = sent.document.file_id
+        exam.tg_file_unique_id = sent.document.file_unique_id
+        await session.commit()
 
 
 # 4) Отмена/закрыть
@@ -246,32 +309,19 @@ async def cancel(callback_query: types.CallbackQuery):
 
 # 1) Запуск редактирования: показываем список обследований
 @router.message(F.text == "✏️ Редактировать обследования")
-async def edit_examination_start(message: types.Message):
-    user_id = message.from_user.id
-    async with async_session() as session:
-        result = await session.execute(
-            select(InstrumentalExamination.id, InstrumentalExamination.name)
-            .filter_by(telegram_id=user_id)
-            .order_by(InstrumentalExamination.examination_date.desc())
-        )
-        exams = result.all()
+async def edit_examination_start(message: types.Message, session: AsyncSession):
+    kb = await _examinations_keyboard(session, message.from_user.id, pager=edit_examinations_pager)
 
-    if not exams:
+    if kb is None:
         return await message.answer("❗ У вас нет ни одного обследования для редактирования.")
 
-    rows = [
-        [InlineKeyboardButton(text=name, callback_data=f"edit_examination:{exam_id}")]
-        for exam_id, name in exams
-    ]
-    kb = InlineKeyboardMarkup(inline_keyboard=rows)
     await message.answer("Выберите обследование для редактирования:", reply_markup=kb)
 
 # 2) Пользователь выбрал обследование — запрашиваем новое описание
 @router.callback_query(F.data.startswith("edit_examination:"))
-async def edit_examination_select(callback: types.CallbackQuery, state: FSMContext):
+async def edit_examination_select(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     exam_id = int(callback.data.split(":", 1)[1])
-    async with async_session() as session:
-        exam = await session.get(InstrumentalExamination, exam_id)
+    exam = await session.get(InstrumentalExamination, exam_id)
     if not exam or exam.telegram_id != callback.from_user.id:
         await callback.answer("❗ Обследование не найдено или доступ запрещён.", show_alert=True)
         return
@@ -280,7 +330,8 @@ async def edit_examination_select(callback: types.CallbackQuery, state: FSMConte
     await state.update_data(
         exam_id=exam_id,
         old_description=exam.description or "",
-        old_file_path=exam.file_path
+        old_file_path=exam.file_path,
+        old_file_hash=exam.file_hash
     )
 
     text = (
@@ -305,67 +356,60 @@ async def edit_examination_desc(message: types.Message, state: FSMContext):
 
 # 4a) Пользователь присылает новый файл
 @router.message(StateFilter(EditExamStates.file), F.document)
-async def edit_examination_file(message: types.Message, state: FSMContext):
+async def edit_examination_file(message: types.Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     # Сохраняем новый файл
-    new_path = await save_examination_file(message)
-    await state.update_data(new_file_path=new_path)
-    await _commit_edit(message, state)
+    try:
+        stored = await save_examination_file(message)
+    except FileTooLarge:
+        await message.answer(f"❗ Файл слишком большой. Прикрепите файл до {FILE_MAX_MB} МБ или отправьте /skip.")
+        return
+    await state.update_data(new_file=stored)
+    await _commit_edit(message, state, session)
 
 # 4b) Пользователь пропускает замену файла
 @router.message(StateFilter(EditExamStates.file), F.text == "/skip")
-async def edit_examination_file_skip(message: types.Message, state: FSMContext):
-    await state.update_data(new_file_path=None)
-    await _commit_edit(message, state)
+async def edit_examination_file_skip(message: types.Message, state: FSMContext, session: AsyncSession):
+    await state.update_data(new_file=None)
+    await _commit_edit(message, state, session)
 
 # Вспомогательная функция для сохранения изменений
-async def _commit_edit(message: types.Message, state: FSMContext):
+async def _commit_edit(message: types.Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     exam_id       = data["exam_id"]
     new_desc      = data.get("new_description")
-    new_file      = data.get("new_file_path")
+    new_file      = data.get("new_file")
     old_file      = data.get("old_file_path")
 
-    async with async_session() as session:
-        exam = await session.get(InstrumentalExamination, exam_id)
+    exam = await session.get(InstrumentalExamination, exam_id)
 
-        if new_desc is not None:
-            exam.description = new_desc
+    if new_desc is not None:
+        exam.description = new_desc
 
-        if new_file is not None:
-            # удаляем старый файл
-            if old_file and os.path.exists(old_file):
-                try:
-                    os.remove(old_file)
-                except OSError:
-                    pass
-            exam.file_path = new_file
+    if new_file is not None:
+        exam.file_path = new_file["file"]
+        exam.file_name = new_file["file_name"]
+        exam.file_hash = new_file["file_hash"]
+        exam.tg_file_id = new_file["tg_file_id"]
+        exam.tg_file_unique_id = new_file["tg_file_unique_id"]
 
-        await session.commit()
+    await session.commit()
+
+    if new_file is not None:
+        # снимаем ссылку на старый файл (удаляется, если больше никому не нужен)
+        await file_store.release(old_file, data.get("old_file_hash"))
 
     await message.answer("✅ Обследование успешно обновлено.")
     await state.clear()
 # --------------- Удалить обследование -----------------
 # 1) Показываем список обследований для выбора
 @router.message(F.text == "❌ Удалить обследования")
-async def delete_examination_start(message: types.Message):
-    user_id = message.from_user.id
-    async with async_session() as session:
-        result = await session.execute(
-            select(InstrumentalExamination.id, InstrumentalExamination.name)
-            .filter_by(telegram_id=user_id)
-            .order_by(InstrumentalExamination.examination_date.desc())
-        )
-        exams = result.all()
+async def delete_examination_start(message: types.Message, session: AsyncSession):
+    kb = await _examinations_keyboard(session, message.from_user.id, pager=delete_examinations_pager)
 
-    if not exams:
+    if kb is None:
         return await message.answer("❗ У вас нет ни одного обследования для удаления.")
 
-    rows = [
-        [InlineKeyboardButton(text=name, callback_data=f"choose_examination_to_delete:{exam_id}")]
-        for exam_id, name in exams
-    ]
-    kb = InlineKeyboardMarkup(inline_keyboard=rows)
     await message.answer("Выберите обследование, которое хотите удалить:", reply_markup=kb)
 
 
@@ -387,25 +431,20 @@ async def confirm_delete_examination(callback_query: types.CallbackQuery):
 
 # 3) Пользователь подтвердил удаление
 @router.callback_query(F.data.startswith("confirm_delete:"))
-async def delete_examination(callback_query: types.CallbackQuery):
+async def delete_examination(callback_query: types.CallbackQuery, session: AsyncSession):
     exam_id = int(callback_query.data.split(":")[1])
 
-    async with async_session() as session:
-        exam = await session.get(InstrumentalExamination, exam_id)
-        if not exam or exam.telegram_id != callback_query.from_user.id:
-            await callback_query.answer("❗ Обследование не найдено или доступ запрещён.", show_alert=True)
-            return
+    exam = await session.get(InstrumentalExamination, exam_id)
+    if not exam or exam.telegram_id != callback_query.from_user.id:
+        await callback_query.answer("❗ Обследование не найдено или доступ запрещён.", show_alert=True)
+        return
 
-        file_path = exam.file_path
+    file_path, file_hash = exam.file_path, exam.file_hash
 
-        await session.delete(exam)
-        await session.commit()
+    await session.delete(exam)
+    await session.commit()
 
-    if file_path and os.path.exists(file_path):
-        try:
-            os.remove(file_path)
-        except OSError:
-            pass
+    await file_store.release(file_path, file_hash)
 
     await callback_query.message.answer("✅ Обследование успешно удалено.")
     await callback_query.answer()
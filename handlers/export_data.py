@@ -0,0 +1,14 @@
+from aiogram import Router, types, F
+from aiogram.filters.command import Command
+
+from services.export import data_exporter
+
+router = Router()
+
+# Архив собирается в фоне (services/export.py) и приходит документом
+@router.message(F.text == "📦 Выгрузить все данные")
+@router.message(Command("export"))
+async def export_all_data(message: types.Message):
+    progress = await message.answer("⏳ Собираю архив с вашими данными…")
+    if not data_exporter.start(message.bot, message.chat.id, progress.message_id, message.from_user.id):
+        await progress.edit_text("⏳ Архив уже готовится — пришлю его, как только он будет готов.")
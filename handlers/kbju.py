@@ -3,9 +3,10 @@ from keyboards.main_menu import main_keyboard
 from aiogram.types import(
     Message
     )
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, delete
 
-from db import async_session, UserData
+from db import UserData
 router = Router() 
 
 def calculate_kbju(weight, goal):
@@ -35,14 +36,12 @@ def calculate_kbju(weight, goal):
 
 
 @router.message(F.text == "🍽 Рекомендации по КБЖУ")
-async def kbju_recommendation(message: Message):
+async def kbju_recommendation(message: Message, session: AsyncSession):
     # Достаём из БД вес и цель пользователя
-    async with async_session() as session:
-        async with session.begin():
-            result = await session.execute(
-                select(UserData).where(UserData.telegram_id == message.from_user.id)
-            )
-            user = result.scalars().first()
+    result = await session.execute(
+        select(UserData).where(UserData.telegram_id == message.from_user.id)
+    )
+    user = result.scalars().first()
 
     if not user:
         await message.answer(
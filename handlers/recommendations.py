@@ -4,86 +4,124 @@ from aiogram.types import(
     Message,
     CallbackQuery
     )
+from sqlalchemy.ext.asyncio import AsyncSession
+from aiogram.exceptions import TelegramBadRequest
 from sqlalchemy import select
 
-from db import async_session, Recommendation
+from db import Recommendation
+from keyboards.callbacks import RecCategoryCb
+from services.name_registry import name_registry, CATEGORY
+from services.pagination import KeysetPager, TEXT_PAGE_SIZE
 router = Router() 
 
-@router.message(F.text == "📊 Рекомендации")
-async def show_recommendation_categories(message: Message):
-    async with async_session() as session:
-        res = await session.execute(
-            select(Recommendation.category)
-            .where(Recommendation.telegram_id == message.from_user.id)
-            .distinct()
-        )
-        categories = [r[0] for r in res.all()]
-
-    if not categories:
-        await message.answer("У вас пока нет рекомендаций.")
-        return
+recommendations_pager = KeysetPager(
+    "pg:rc", Recommendation.created_at, Recommendation.id, size=TEXT_PAGE_SIZE, descending=False
+)
 
-    kb = InlineKeyboardMarkup(
+async def _categories_keyboard(telegram_id: int, categories: list) -> InlineKeyboardMarkup:
+    ids = await name_registry.ids(telegram_id, CATEGORY, categories)
+    return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text=cat, callback_data=f"rec_cat|{cat}")]
+            [InlineKeyboardButton(text=cat, callback_data=RecCategoryCb(id=ids[cat]).pack())]
             for cat in categories
         ]
     )
-    await message.answer("Выберите категорию рекомендаций:", reply_markup=kb)
 
-# Step 2: Show all recommendations in selected category
-@router.callback_query(F.data.startswith("rec_cat|"))
-async def show_recommendations(callback: CallbackQuery):
-    category = callback.data.split("|", 1)[1]
-    async with async_session() as session:
-        res = await session.execute(
-            select(Recommendation)
-            .where(
-                Recommendation.telegram_id == callback.from_user.id,
-                Recommendation.category == category
-            )
-            .order_by(Recommendation.created_at)
-        )
-        recs = res.scalars().all()
 
-    if not recs:
-        await callback.answer("Нет рекомендаций в этой категории.", show_alert=True)
+@router.message(F.text == "📊 Рекомендации")
+async def show_recommendation_categories(message: Message, session: AsyncSession):
+    res = await session.execute(
+        select(Recommendation.category)
+        .where(Recommendation.telegram_id == message.from_user.id)
+        .distinct()
+    )
+    categories = [r[0] for r in res.all()]
+
+    if not categories:
+        await message.answer("У вас пока нет рекомендаций.")
         return
 
-    text_lines = [f"<b>📊 Рекомендации — {category}:</b>\n"]
-    for idx, rec in enumerate(recs, 1):
+    kb = await _categories_keyboard(message.from_user.id, categories)
+    await message.answer("Выберите категорию рекомендаций:", reply_markup=kb)
+
+# Step 2: Show recommendations in selected category, page by page
+async def _recommendations_page(session: AsyncSession, telegram_id: int, category: str, cursor=None, backward=False):
+    page = await recommendations_pager.fetch(
+        session,
+        select(Recommendation)
+        .where(
+            Recommendation.telegram_id == telegram_id,
+            Recommendation.category == category
+        ),
+        cursor, backward,
+    )
+    text_lines = []
+    for row in page.rows:
+        rec = row[0]
         created = rec.created_at.strftime("%d.%m.%Y")
-        text_lines.append(f"{idx}. {rec.text} <i>({created})</i>")
+        text_lines.append(f"• {rec.text} <i>({created})</i>")
+    text = page.fit(f"<b>📊 Рекомендации — {category}:</b>\n\n", text_lines)
 
     kb = InlineKeyboardMarkup(
-        inline_keyboard=[[
-            InlineKeyboardButton(text="◀️ Назад", callback_data="rec_back")
-        ]]
+        inline_keyboard=[row for row in (
+            recommendations_pager.nav_buttons(page),
+            [InlineKeyboardButton(text="◀️ Назад", callback_data="rec_back")],
+        ) if row]
     )
+    return page, text, kb
+
+
+@router.callback_query(RecCategoryCb.filter())
+async def show_recommendations(callback: CallbackQuery, callback_data: RecCategoryCb, session: AsyncSession):
+    category = await name_registry.name(callback.from_user.id, CATEGORY, callback_data.id)
+    if category is None:
+        await callback.answer("Список устарел, откройте его заново.", show_alert=True)
+        return
+    page, text, kb = await _recommendations_page(session, callback.from_user.id, category)
+
+    if not page.rows:
+        await callback.answer("Нет рекомендаций в этой категории.", show_alert=True)
+        return
+
     await callback.message.edit_text(
-        "\n".join(text_lines),
+        text,
         reply_markup=kb,
         parse_mode="HTML"
     )
     await callback.answer()
 
-# Step 3: Back to category list
-@router.callback_query(F.data == "rec_back")
-async def back_to_categories(callback: CallbackQuery):
-    async with async_session() as session:
-        res = await session.execute(
-            select(Recommendation.category)
-            .where(Recommendation.telegram_id == callback.from_user.id)
-            .distinct()
+
+@router.callback_query(F.data.startswith(recommendations_pager.prefix + "|"))
+async def show_recommendations_page(callback: CallbackQuery, session: AsyncSession):
+    cursor, backward = recommendations_pager.parse(callback.data)
+    # Категория — по id строки-курсора
+    category = await session.scalar(
+        select(Recommendation.category).where(
+            Recommendation.id == cursor[-1],
+            Recommendation.telegram_id == callback.from_user.id
         )
-        categories = [r[0] for r in res.all()]
+    )
+    if category is None:
+        await callback.answer("Рекомендации изменились, откройте категорию заново.", show_alert=True)
+        return
+    page, text, kb = await _recommendations_page(session, callback.from_user.id, category, cursor, backward)
+    try:
+        await callback.message.edit_text(text, reply_markup=kb, parse_mode="HTML")
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
 
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=cat, callback_data=f"rec_cat|{cat}")]
-            for cat in categories
-        ]
+# Step 3: Back to category list
+@router.callback_query(F.data == "rec_back")
+async def back_to_categories(callback: CallbackQuery, session: AsyncSession):
+    res = await session.execute(
+        select(Recommendation.category)
+        .where(Recommendation.telegram_id == callback.from_user.id)
+        .distinct()
     )
+    categories = [r[0] for r in res.all()]
+
+    kb = await _categories_keyboard(callback.from_user.id, categories)
     await callback.message.edit_text(
         "Выберите категорию рекомендаций:",
         reply_markup=kb
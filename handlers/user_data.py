@@ -7,10 +7,11 @@ from aiogram.types import(
     )
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import StateFilter
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, delete
 
 from states.data_states import DataStates, EditStates, DeleteStates 
-from db import async_session, UserData
+from db import UserData
 router = Router() 
 
 # Главное меню → "Данные пользователя"
@@ -130,29 +131,27 @@ async def process_heredity(message: Message, state: FSMContext):
 
 # Финальный шаг: сохранение и вывод
 @router.message(StateFilter(DataStates.clinical))
-async def process_clinical(message: Message, state: FSMContext):
+async def process_clinical(message: Message, state: FSMContext, session: AsyncSession):
     await state.update_data(clinical=message.text)
     data = await state.get_data()
 
     # Сохранение в БД (предполагается, что в модели есть поля height и weight)
-    async with async_session() as session:
-        async with session.begin():
-            user_data = UserData(
-                telegram_id=message.from_user.id,
-                username=message.from_user.username or message.from_user.full_name,
-                full_name=data['fio'],
-                goal=data['goal'],
-                sport=data['sport'],
-                height=data['height'],
-                weight=data['weight'],
-                smoking=data['smoking'],
-                alcohol=data['alcohol'],
-                diseases=data['chronic'],
-                heredity=data['heredity'],
-                symptoms=data['clinical']
-            )
-            session.add(user_data)
-        await session.commit()
+    user_data = UserData(
+        telegram_id=message.from_user.id,
+        username=message.from_user.username or message.from_user.full_name,
+        full_name=data['fio'],
+        goal=data['goal'],
+        sport=data['sport'],
+        height=data['height'],
+        weight=data['weight'],
+        smoking=data['smoking'],
+        alcohol=data['alcohol'],
+        diseases=data['chronic'],
+        heredity=data['heredity'],
+        symptoms=data['clinical']
+    )
+    session.add(user_data)
+    await session.commit()
 
     await message.answer("Ваши данные были успешно сохранены!", reply_markup=main_keyboard)
     await state.clear()
@@ -160,15 +159,12 @@ async def process_clinical(message: Message, state: FSMContext):
 #---------------------------------------------------------------------------------------------------------------------------------
 # Остальные пункты меню  
 @router.message(F.text == "👁️ Посмотреть текущие данные")
-async def view_data_handler(message: Message):
-    # Открываем асинхронную сессию
-    async with async_session() as session:
-        async with session.begin():
-            # Ищем пользователя по telegram_id
-            result = await session.execute(
-                select(UserData).where(UserData.telegram_id == message.from_user.id)
-            )
-            user = result.scalars().first()
+async def view_data_handler(message: Message, session: AsyncSession):
+    # Ищем пользователя по telegram_id
+    result = await session.execute(
+        select(UserData).where(UserData.telegram_id == message.from_user.id)
+    )
+    user = result.scalars().first()
 
     if not user:
         # Если данных нет — приглашаем сначала их ввести
@@ -291,23 +287,21 @@ async def process_edit_field(query: CallbackQuery, state: FSMContext):
 @router.callback_query(StateFilter(EditStates.value), F.data.startswith("edit_goal:"))
 @router.callback_query(StateFilter(EditStates.value), F.data.startswith("edit_smoking:"))
 @router.callback_query(StateFilter(EditStates.value), F.data.startswith("edit_alcohol:"))
-async def process_edit_choice_cb(query: CallbackQuery, state: FSMContext):
+async def process_edit_choice_cb(query: CallbackQuery, state: FSMContext, session: AsyncSession):
     await query.answer()
     prefix, new_value = query.data.split(":", 1)
     data = await state.get_data()
     field = data['field']
 
     # Обновляем в БД
-    async with async_session() as session:
-        async with session.begin():
-            result = await session.execute(
-                select(UserData).where(UserData.telegram_id == query.from_user.id)
-            )
-            user = result.scalars().first()
-            if user:
-                setattr(user, field_model_attr[field], new_value)
-                session.add(user)
-        await session.commit()
+    result = await session.execute(
+        select(UserData).where(UserData.telegram_id == query.from_user.id)
+    )
+    user = result.scalars().first()
+    if user:
+        setattr(user, field_model_attr[field], new_value)
+        session.add(user)
+    await session.commit()
 
     await query.message.edit_reply_markup()
     await query.message.answer(
@@ -318,7 +312,7 @@ async def process_edit_choice_cb(query: CallbackQuery, state: FSMContext):
 
 # Обработка свободного ввода для остальных полей
 @router.message(StateFilter(EditStates.value))
-async def process_edit_text_value(message: Message, state: FSMContext):
+async def process_edit_text_value(message: Message, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     field = data['field']
     new_value = message.text
@@ -346,16 +340,14 @@ async def process_edit_text_value(message: Message, state: FSMContext):
             return
     
     # Обновляем в БД
-    async with async_session() as session:
-        async with session.begin():
-            result = await session.execute(
-                select(UserData).where(UserData.telegram_id == message.from_user.id)
-            )
-            user = result.scalars().first()
-            if user:
-                setattr(user, field_model_attr[field], new_value)
-                session.add(user)
-        await session.commit()
+    result = await session.execute(
+        select(UserData).where(UserData.telegram_id == message.from_user.id)
+    )
+    user = result.scalars().first()
+    if user:
+        setattr(user, field_model_attr[field], new_value)
+        session.add(user)
+    await session.commit()
 
     await message.answer(
         f"✅ Поле «{field_display_map[field]}» успешно обновлено!",
@@ -387,18 +379,16 @@ async def delete_data_handler(message: Message, state: FSMContext):
 
 # Обработка подтверждения/отмены
 @router.message(StateFilter(DeleteStates.confirm))
-async def process_delete_confirmation(message: Message, state: FSMContext):
+async def process_delete_confirmation(message: Message, state: FSMContext, session: AsyncSession):
     text = message.text.strip().lower()
 
     if text == "да":
         # Удаляем строку пользователя
-        async with async_session() as session:
-            async with session.begin():
-                await session.execute(
-                    delete(UserData)
-                    .where(UserData.telegram_id == message.from_user.id)
-                )
-            await session.commit()
+        await session.execute(
+            delete(UserData)
+            .where(UserData.telegram_id == message.from_user.id)
+        )
+        await session.commit()
 
         await message.answer("✅ Ваши данные успешно удалены!", reply_markup=main_keyboard)
 
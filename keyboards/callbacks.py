@@ -0,0 +1,47 @@
+"""
+Типизированные callback_data: короткий префикс и числовые id.
+
+Названия в кнопки не кладём — только id: ``mem_id`` строки справочника
+analyzes_mem или id из реестра services/name_registry.py. Упакованная
+строка вида ``va:1234`` занимает несколько байт при любой длине названия.
+"""
+from aiogram.filters.callback_data import CallbackData
+
+
+# Справочник при добавлении анализа: id любого варианта группы / анализа
+class CatalogGroupCb(CallbackData, prefix="cg"):
+    mem_id: int
+
+
+class CatalogNameCb(CallbackData, prefix="cn"):
+    mem_id: int
+
+
+# Данные пользователя: id из реестра названий
+class ViewGroupCb(CallbackData, prefix="vg"):
+    id: int
+
+
+class ViewAnalysisCb(CallbackData, prefix="va"):
+    id: int
+
+
+class ViewChartCb(CallbackData, prefix="vc"):
+    id: int
+
+
+class DeleteGroupCb(CallbackData, prefix="dg"):
+    id: int
+
+
+class DeleteNameCb(CallbackData, prefix="dn"):
+    id: int
+
+
+class DoctorCb(CallbackData, prefix="dr"):
+    action: str  # view / edit / delete
+    id: int
+
+
+class RecCategoryCb(CallbackData, prefix="rc"):
+    id: int
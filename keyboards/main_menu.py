@@ -9,6 +9,7 @@ main_keyboard = ReplyKeyboardMarkup(
         [KeyboardButton(text="🩻 Обследования")],
         [KeyboardButton(text="📊 Рекомендации")],
         [KeyboardButton(text="💊 Назначения врачей")],
+        [KeyboardButton(text="📦 Выгрузить все данные")],
         [KeyboardButton(text="❌ Удалить все данные")]
     ],
     resize_keyboard=True
@@ -30,6 +31,8 @@ fill_data_keyboard = ReplyKeyboardMarkup(
 analysis_keyboard = ReplyKeyboardMarkup(
     keyboard=[
         [KeyboardButton(text="➕ Добавить анализ")],
+        [KeyboardButton(text="📥 Добавить списком")],
+        [KeyboardButton(text="📄 Загрузить PDF из лаборатории")],
         [KeyboardButton(text="📋 Посмотреть анализы")],
         [KeyboardButton(text="❌ Удалить анализ")],
         [KeyboardButton(text="⬅️ Назад")]
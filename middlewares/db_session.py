@@ -0,0 +1,36 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from sqlalchemy.orm import sessionmaker
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Одна сессия (и одна транзакция) БД на апдейт.
+
+    AsyncSession не берёт соединение из пула до первого запроса, поэтому
+    апдейты, которым БД не нужна, соединение не занимают вовсе.
+    Хендлер получает сессию аргументом ``session``; незафиксированные
+    изменения коммитятся после хендлера, при исключении — откатываются.
+    """
+
+    def __init__(self, session_pool: sessionmaker):
+        self.session_pool = session_pool
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with self.session_pool() as session:
+            data["session"] = session
+            try:
+                result = await handler(event, data)
+            except Exception:
+                await session.rollback()
+                raise
+            if session.in_transaction():
+                await session.commit()
+            return result
@@ -0,0 +1,204 @@
+import logging
+import logging.handlers
+import queue
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass
+from os import getenv
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Апдейты дольше порога (мс) пишутся в журнал медленных апдейтов; 0 — выключено
+SLOW_UPDATE_MS = float(getenv("SLOW_UPDATE_MS", "0"))
+
+# Верхние границы корзин гистограмм, мс
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+@dataclass
+class UpdateStats:
+    """Счётчики одного апдейта; заполняются событиями SQLAlchemy и сессии бота"""
+    handler: str = "unhandled"
+    db_ms: float = 0.0
+    statements: int = 0
+    rows: int = 0
+    api_ms: float = 0.0
+    api_calls: int = 0
+
+
+_current: ContextVar[Optional[UpdateStats]] = ContextVar("update_stats", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 2) if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": round(self.max, 2),
+        }
+
+
+class HandlerMetrics:
+    """Гистограммы времени и счётчики SQL по каждому хендлеру"""
+
+    FIELDS = ("wall_ms", "db_ms", "api_ms", "statements", "rows")
+
+    def __init__(self):
+        self.histograms: Dict[str, Dict[str, Histogram]] = {}
+
+    def record(self, stats: UpdateStats, wall_ms: float):
+        hist = self.histograms.get(stats.handler)
+        if hist is None:
+            hist = self.histograms[stats.handler] = {f: Histogram() for f in self.FIELDS}
+        hist["wall_ms"].observe(wall_ms)
+        hist["db_ms"].observe(stats.db_ms)
+        hist["api_ms"].observe(stats.api_ms)
+        hist["statements"].observe(stats.statements)
+        hist["rows"].observe(stats.rows)
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        return {
+            handler: {name: h.snapshot() for name, h in hist.items()}
+            for handler, hist in sorted(self.histograms.items())
+        }
+
+
+metrics = HandlerMetrics()
+
+
+def _make_slow_logger() -> logging.Logger:
+    # Запись в поток ошибок делает QueueListener в своём потоке — цикл событий не блокируется
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    slow_logger = logging.getLogger("bot.slow_updates")
+    slow_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    slow_logger.setLevel(logging.WARNING)
+    slow_logger.propagate = False
+    return slow_logger
+
+
+_slow_logger = _make_slow_logger() if SLOW_UPDATE_MS > 0 else None
+
+
+# Начало запроса храним на контексте выполнения, а не на соединении: у упавшего
+# запроса after_cursor_execute не вызывается, и контекст просто уходит вместе с ним
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_query_start", None)
+    stats = _current.get()
+    if stats is None or started is None:
+        return
+    stats.db_ms += (time.perf_counter() - started) * 1000
+    stats.statements += 1
+    # Для SELECT драйверы MySQL отдают число строк, SQLite — -1
+    if cursor.rowcount and cursor.rowcount > 0:
+        stats.rows += cursor.rowcount
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Время и число SQL-запросов текущего апдейта через события курсора; повторный вызов ничего не делает"""
+    target = engine.sync_engine
+    if event.contains(target, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(target, "before_cursor_execute", _before_cursor_execute)
+    event.listen(target, "after_cursor_execute", _after_cursor_execute)
+
+
+class ApiTimingMiddleware(BaseRequestMiddleware):
+    """Время запросов к Telegram Bot API в рамках апдейта"""
+
+    async def __call__(self, make_request, bot, method):
+        stats = _current.get()
+        if stats is None:
+            return await make_request(bot, method)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            stats.api_ms += (time.perf_counter() - started) * 1000
+            stats.api_calls += 1
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware апдейта: общее время и запись в гистограммы"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        stats = UpdateStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            wall_ms = (time.perf_counter() - started) * 1000
+            _current.reset(token)
+            metrics.record(stats, wall_ms)
+            if _slow_logger is not None and wall_ms >= SLOW_UPDATE_MS:
+                _slow_logger.warning(
+                    "slow update %s: handler=%s wall=%.1fms db=%.1fms/%d stmts/%d rows "
+                    "api=%.1fms/%d calls state=%s",
+                    getattr(event, "update_id", "?"), stats.handler, wall_ms, stats.db_ms,
+                    stats.statements, stats.rows, stats.api_ms, stats.api_calls,
+                    data.get("raw_state"),
+                )
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Внутренний middleware: запоминает, какой хендлер (модуль:функция) сработал"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        stats = _current.get()
+        handler_object = data.get("handler")
+        if stats is not None and handler_object is not None:
+            callback = handler_object.callback
+            stats.handler = f"{callback.__module__}:{callback.__qualname__}"
+        return await handler(event, data)
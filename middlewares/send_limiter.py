@@ -0,0 +1,248 @@
+"""
+Планировщик исходящих запросов к Bot API (request-middleware сессии бота).
+
+Telegram ограничивает отправку примерно 30 сообщениями в секунду на бота,
+1 сообщением в секунду в личный чат и 20 в минуту в группу; при
+превышении отвечает 429 с retry_after. Middleware пропускает отправки
+через token bucket'ы:
+
+* у каждого чата свой bucket — сообщения в разные чаты друг друга не ждут;
+* общий bucket бота раздаёт токены из двух очередей, и ответы на действия
+  пользователя (interactive) всегда идут раньше фоновых рассылок (bulk);
+* на 429 чат (или весь бот) ставится на паузу retry_after, и запрос
+  повторяется до SEND_MAX_RETRIES раз.
+
+Bucket'ы живут в памяти процесса. При BOT_WORKERS > 1 каждый воркер
+получает SEND_GLOBAL_RATE / BOT_WORKERS, чтобы вместе они не превышали
+лимит бота; чаты не делятся — пользователь закреплён за одним воркером.
+Несколько реплик вебхука так не считаются: SEND_GLOBAL_RATE для них
+нужно уменьшить вручную.
+
+Фоновые задачи помечают свои запросы через ``with bulk_sends(): ...``.
+Глубина очередей, ожидание и число 429 видны в ``send_limiter.snapshot()``.
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import getenv
+from typing import Deque, Dict, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from middlewares.metrics import Histogram
+from services.sharding import BOT_WORKERS, current_shard
+
+SEND_LIMITS = getenv("SEND_LIMITS", "1") == "1"
+SEND_GLOBAL_RATE = float(getenv("SEND_GLOBAL_RATE", "30"))      # сообщений в секунду на бота
+SEND_CHAT_RATE = float(getenv("SEND_CHAT_RATE", "1"))           # в секунду в личный чат
+SEND_GROUP_RATE = float(getenv("SEND_GROUP_RATE", str(20 / 60)))  # в секунду в группу
+SEND_CHAT_BURST = int(getenv("SEND_CHAT_BURST", "3"))           # короткая пачка без ожидания
+SEND_MAX_RETRIES = int(getenv("SEND_MAX_RETRIES", "3"))
+
+INTERACTIVE = 0
+BULK = 1
+
+_priority: ContextVar[int] = ContextVar("send_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def bulk_sends():
+    """Запросы внутри блока идут в фоновую очередь и уступают ответам пользователям"""
+    token = _priority.set(BULK)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _process_global_rate() -> float:
+    """Доля общего лимита бота на этот процесс"""
+    if current_shard() is None:
+        return SEND_GLOBAL_RATE
+    return SEND_GLOBAL_RATE / BOT_WORKERS
+
+
+def _is_send(method) -> bool:
+    # Лимиты считаются по новым сообщениям; правки и ответы на callback их не тратят
+    name = type(method).__name__
+    return name.startswith(("Send", "Copy", "Forward")) and name != "SendChatAction"
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько ждать до свободного токена (не забирая его)"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def reserve(self) -> float:
+        """Забирает токен, при необходимости в долг, и возвращает время ожидания своей очереди"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.paused_until - now)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.paused_until
+
+
+class SendLimiter(BaseRequestMiddleware):
+    def __init__(self, global_rate: Optional[float] = None, chat_rate: float = SEND_CHAT_RATE,
+                 group_rate: float = SEND_GROUP_RATE, chat_burst: int = SEND_CHAT_BURST,
+                 max_retries: int = SEND_MAX_RETRIES, enabled: bool = SEND_LIMITS):
+        self.enabled = enabled
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global_rate = global_rate
+        self._global_bucket: Optional[TokenBucket] = None
+        self._chats: Dict[object, TokenBucket] = {}
+        self._queues: Dict[int, Deque[asyncio.Future]] = {INTERACTIVE: deque(), BULK: deque()}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pump_task: Optional[asyncio.Task] = None
+        self.wait_ms = {INTERACTIVE: Histogram(), BULK: Histogram()}
+        self.sent = 0
+        self.retries = 0
+        self.rejected = 0  # 429, после которых попытки кончились
+
+    @property
+    def _global(self) -> TokenBucket:
+        # Создаётся при первой отправке: воркер узнаёт свой номер уже после импорта модуля
+        if self._global_bucket is None:
+            rate = self._global_rate if self._global_rate is not None else _process_global_rate()
+            self._global_bucket = TokenBucket(rate, rate)
+        return self._global_bucket
+
+    async def __call__(self, make_request, bot, method):
+        if not self.enabled:
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        limited = _is_send(method)
+        attempt = 0
+        while True:
+            if limited:
+                await self._acquire(chat_id)
+            try:
+                result = await make_request(bot, method)
+                if limited:
+                    self.sent += 1
+                return result
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    self.rejected += 1
+                    raise
+                attempt += 1
+                self.retries += 1
+                # Пауза для чата, а без чата — для всего бота; ждём её в _acquire или здесь
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+                bucket.pause(e.retry_after)
+                if not limited:
+                    await asyncio.sleep(e.retry_after)
+
+    async def _acquire(self, chat_id):
+        started = time.monotonic()
+        priority = _priority.get()
+        if chat_id is not None:
+            # Очередь внутри чата — по времени резервирования
+            bucket = self._chat_bucket(chat_id)
+            wait = bucket.reserve()
+            if wait > 0:
+                try:
+                    await asyncio.sleep(wait)
+                except asyncio.CancelledError:
+                    bucket.tokens += 1  # отменённый запрос возвращает свой токен
+                    raise
+
+        if not any(self._queues.values()) and self._global.delay() == 0:
+            self._global.take()
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._queues[priority].append(future)
+            self._ensure_pump()
+            self._wakeup.set()
+            await future
+        self.wait_ms[priority].observe((time.monotonic() - started) * 1000)
+
+    def _ensure_pump(self):
+        if self._pump_task is None or self._pump_task.done():
+            self._wakeup = asyncio.Event()
+            self._pump_task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        """Выдаёт общие токены по одному: сначала interactive, затем bulk"""
+        while True:
+            queue = self._queues[INTERACTIVE] or self._queues[BULK]
+            while queue and queue[0].done():
+                queue.popleft()  # ожидающий отменён — токен ему не нужен
+            if not queue:
+                if not any(self._queues.values()):
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                continue
+            wait = self._global.delay()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self._global.take()
+            queue.popleft().set_result(None)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                self._prune()
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate if is_group else self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _prune(self):
+        # Полные bucket'ы без паузы ничего не помнят — их можно пересоздать
+        for chat_id in [c for c, b in self._chats.items() if b.idle()]:
+            del self._chats[chat_id]
+
+    async def close(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            self._pump_task = None
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            "queue_interactive": len(self._queues[INTERACTIVE]),
+            "queue_bulk": len(self._queues[BULK]),
+            "chats_tracked": len(self._chats),
+            "global_rate": self._global.rate,
+            "sent": self.sent,
+            "retries_429": self.retries,
+            "rejected_429": self.rejected,
+            "wait_ms_interactive": self.wait_ms[INTERACTIVE].snapshot(),
+            "wait_ms_bulk": self.wait_ms[BULK].snapshot(),
+        }
+
+
+send_limiter = SendLimiter()
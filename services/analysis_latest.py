@@ -0,0 +1,145 @@
+"""
+Таблица analysis_latest: последний и предыдущий результат каждого анализа.
+
+Пути добавления и удаления анализов вызывают ``refresh_latest`` в своей
+транзакции: два верхних результата по (telegram_id, name) берутся из
+индекса ix_analysis_user_name_date, так что обновление не зависит от
+длины истории. «Последний» — максимальная дата, при равных датах —
+больший id, поэтому дублей не бывает. Новая строка вставляется upsert'ом:
+фоновый импорт PDF пишет вне очереди апдейтов пользователя и может
+одновременно с хендлером добавить тот же анализ.
+
+    python -m services.analysis_latest   # пересобрать таблицу целиком
+"""
+import asyncio
+from typing import Iterable
+
+from sqlalchemy import select, delete, update, insert, desc, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import Analysis, AnalysisLatest, upsert
+
+
+def _latest_values(last, previous_id) -> dict:
+    return {
+        "group_name": last.group_name,
+        "latest_id": last.id,
+        "previous_id": previous_id,
+        "result": last.result,
+        "result_value": last.result_value,
+        "ref_min": last.ref_min,
+        "ref_max": last.ref_max,
+        "reference": last.reference,
+        "units": last.units,
+        "date": last.date,
+    }
+
+
+async def refresh_latest(session: AsyncSession, telegram_id: int, name: str) -> None:
+    """Пересчитывает строку analysis_latest для одного анализа пользователя"""
+    top = (await session.execute(
+        select(
+            Analysis.id, Analysis.group_name, Analysis.result, Analysis.result_value,
+            Analysis.ref_min, Analysis.ref_max, Analysis.reference, Analysis.units, Analysis.date,
+        )
+        .where(Analysis.telegram_id == telegram_id, Analysis.name == name)
+        .order_by(desc(Analysis.date), desc(Analysis.id))
+        .limit(2)
+    )).all()
+
+    key = (AnalysisLatest.telegram_id == telegram_id, AnalysisLatest.name == name)
+    if not top:
+        await session.execute(delete(AnalysisLatest).where(*key))
+        return
+
+    values = _latest_values(top[0], top[1].id if len(top) > 1 else None)
+    res = await session.execute(update(AnalysisLatest).where(*key).values(**values))
+    if not res.rowcount:
+        await session.execute(upsert(
+            session.get_bind().dialect.name, AnalysisLatest,
+            {"telegram_id": telegram_id, "name": name, **values},
+            [AnalysisLatest.telegram_id, AnalysisLatest.name],
+            values,
+        ))
+
+
+async def refresh_latest_many(session: AsyncSession, telegram_id: int, names: Iterable[str]) -> None:
+    for name in set(names):
+        await refresh_latest(session, telegram_id, name)
+
+
+# ---------------- пересборка ----------------
+
+async def rebuild(session_pool, batch: int = 500) -> int:
+    """
+    Пересобирает analysis_latest по всей таблице analysis.
+
+    Пользователи обрабатываются пачками по ``batch`` (keyset по telegram_id):
+    два верхних результата каждого анализа выбираются оконной функцией,
+    и строки пачки заменяются в одной транзакции — бот может работать
+    во время пересборки, а память не зависит от размера таблицы.
+    """
+    rank = func.row_number().over(
+        partition_by=(Analysis.telegram_id, Analysis.name),
+        order_by=(desc(Analysis.date), desc(Analysis.id)),
+    ).label("rn")
+    columns = (
+        Analysis.telegram_id, Analysis.name, Analysis.id, Analysis.group_name, Analysis.result,
+        Analysis.result_value, Analysis.ref_min, Analysis.ref_max, Analysis.reference,
+        Analysis.units, Analysis.date,
+    )
+
+    last_user = None
+    written = 0
+    while True:
+        async with session_pool() as session:
+            users_q = select(Analysis.telegram_id).distinct().order_by(Analysis.telegram_id).limit(batch)
+            if last_user is not None:
+                users_q = users_q.where(Analysis.telegram_id > last_user)
+            users = (await session.scalars(users_q)).all()
+            if not users:
+                break
+
+            ranked = select(*columns, rank).where(
+                Analysis.telegram_id.in_(users), Analysis.name.isnot(None)
+            ).subquery()
+            top = (await session.execute(
+                select(ranked).where(ranked.c.rn <= 2)
+                .order_by(ranked.c.telegram_id, ranked.c.name, ranked.c.rn)
+            )).all()
+
+            rows = []
+            for row in top:
+                if row.rn == 1:
+                    rows.append(dict(telegram_id=row.telegram_id, name=row.name, **_latest_values(row, None)))
+                else:
+                    rows[-1]["previous_id"] = row.id
+
+            await session.execute(delete(AnalysisLatest).where(AnalysisLatest.telegram_id.in_(users)))
+            if rows:  # у пользователей пачки могут быть только анализы без названия
+                await session.execute(insert(AnalysisLatest), rows)
+            await session.commit()
+        written += len(rows)
+        last_user = users[-1]
+        print(f"\rпользователей до {last_user}, записано {written}", end="", flush=True)
+
+    # Пользователи, у которых анализов больше нет вовсе
+    async with session_pool() as session:
+        await session.execute(
+            delete(AnalysisLatest).where(AnalysisLatest.latest_id.not_in(select(Analysis.id)))
+        )
+        await session.commit()
+    print()
+    return written
+
+
+async def _main():
+    from db import async_session, engine, init_db
+
+    await init_db()
+    await rebuild(async_session)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,94 @@
+"""
+Разбор анализов, вставленных списком: одна строка — один результат.
+
+    Гемоглобин 135 г/л
+    Глюкоза: 5,4 ммоль/л
+    HGB 13.5
+
+Название и единица ищутся по нормализованному индексу справочника
+(``AnalysisCatalog.lookup``), результат пересчитывается в стандартную
+единицу так же, как при пошаговом вводе.
+"""
+import re
+from dataclasses import dataclass, field
+from datetime import date
+from typing import List
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import Analysis
+from services.analysis_latest import refresh_latest_many
+from services.catalog import AnalysisCatalog, CatalogEntry, normalize_unit
+from services.reference import reference_columns
+from services.report_cache import bump_version
+
+BULK_MAX_LINES = 100
+
+# Название — всё до первого отдельно стоящего числа, дальше — единица
+_LINE = re.compile(
+    r"^\s*(?P<name>.+?)(?:\s*[:=]\s*|\s+)(?P<value>\d+(?:[.,]\d+)?)(?=\s|$)\s*(?P<unit>.*?)\s*$"
+)
+
+
+@dataclass
+class ParsedLine:
+    line: str
+    status: str                     # ok / ambiguous / unknown / invalid
+    value: float = None
+    unit: str = ""
+    candidates: List[CatalogEntry] = field(default_factory=list)
+
+
+def parse_line(line: str, catalog: AnalysisCatalog, unit_token: bool = False) -> ParsedLine:
+    """
+    Разбор одной строки. ``unit_token=True`` — единица только первое слово
+    после числа (строки из PDF: «Гемоглобин 135 г/л 120-160»).
+    """
+    m = _LINE.match(line)
+    if not m:
+        return ParsedLine(line, "invalid")
+    value = float(m["value"].replace(",", "."))
+    unit = m["unit"]
+    if unit_token:
+        unit = unit.split(maxsplit=1)[0] if unit else ""
+    candidates = catalog.lookup(m["name"], unit)
+    if not candidates:
+        status = "unknown"
+    elif len(candidates) == 1 and (not unit or normalize_unit(candidates[0].unit) == normalize_unit(unit)):
+        status = "ok"
+    else:
+        # Несколько вариантов или единица не совпала — уточняем у пользователя
+        status = "ambiguous"
+    return ParsedLine(line, status, value, unit, candidates)
+
+
+def parse_block(text: str, catalog: AnalysisCatalog) -> List[ParsedLine]:
+    return [
+        parse_line(line.strip(), catalog)
+        for line in text.splitlines()[:BULK_MAX_LINES]
+        if line.strip()
+    ]
+
+
+async def save_analyses(session: AsyncSession, telegram_id: int, rows: List[dict]) -> None:
+    """Все строки — одним пакетным INSERT; analysis_latest и версия — в той же транзакции"""
+    await session.execute(insert(Analysis), rows)
+    await refresh_latest_many(session, telegram_id, (r["name"] for r in rows))
+    await bump_version(session, telegram_id)
+    await session.commit()
+
+
+def analysis_values(telegram_id: int, entry: CatalogEntry, raw_value: float, day: date) -> dict:
+    """Строка analysis для результата в единицах варианта ``entry``"""
+    standardized_val = round(raw_value * entry.conversion_to_standard, 2)
+    return dict(
+        telegram_id=telegram_id,
+        name=entry.name,
+        group_name=entry.group_name,
+        units=entry.standard_unit,
+        reference=entry.standard_reference,
+        result=str(standardized_val),
+        date=day,
+        **reference_columns(standardized_val, entry.standard_reference),
+    )
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import re
+import time
+from dataclasses import dataclass
+from os import getenv
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from sqlalchemy import select
+
+from db import async_session, AnalyzesMem
+from keyboards.callbacks import CatalogGroupCb, CatalogNameCb
+
+# Как часто перечитывать справочник анализов из БД (секунды)
+CATALOG_TTL = int(getenv("CATALOG_TTL", "600"))
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_name(text: str) -> str:
+    """Ключ поиска по названию: регистр, ё/е, пробелы и знаки препинания не важны"""
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"[^\w%/]+", " ", text)
+    return " ".join(text.split())
+
+
+def normalize_unit(text: str) -> str:
+    text = text.lower().replace("ё", "е").replace("×", "x").replace("*", "^")
+    return "".join(text.split())
+
+
+def _name_keys(name: str):
+    """Полное название, название без скобок и сокращения в скобках: «Гемоглобин (HGB)»"""
+    keys = {normalize_name(name), normalize_name(re.sub(r"\(.*?\)", " ", name))}
+    keys.update(normalize_name(part) for part in re.findall(r"\((.*?)\)", name))
+    keys.discard("")
+    return keys
+
+
+@dataclass(frozen=True)
+class CatalogEntry:
+    """Неизменяемая копия строки AnalyzesMem, не привязанная к сессии"""
+    id: int
+    name: str
+    group_name: str
+    unit: str
+    standard_unit: str
+    reference_values: str
+    standard_reference: str
+    conversion_to_standard: float
+
+
+class AnalysisCatalog:
+    """
+    Справочник analyzes_mems в памяти процесса: группа → названия → варианты.
+
+    Загружается один раз при старте и перечитывается в фоне по истечении TTL,
+    так что навигация по группам/анализам/единицам не ходит в БД.
+    Клавиатуры собираются при загрузке и переиспользуются.
+    """
+
+    def __init__(self, ttl: int = CATALOG_TTL):
+        self.ttl = ttl
+        self.version = 0
+        self.loaded_at = None
+        self._rows = ()
+        self.groups = []
+        self.names_by_group = {}
+        self.variants = {}
+        self.by_id = {}
+        self.by_name_key = {}
+        self._groups_kb = None
+        self._names_kb = {}
+        self._variants_kb = {}
+        self._refresh_task = None
+        self._load_lock = asyncio.Lock()
+
+    async def load(self):
+        """Читает справочник целиком и перестраивает индексы и клавиатуры"""
+        async with self._load_lock:
+            async with async_session() as session:
+                res = await session.execute(select(AnalyzesMem).order_by(AnalyzesMem.id))
+                rows = tuple(
+                    CatalogEntry(
+                        id=m.id,
+                        name=m.name,
+                        group_name=m.group_name,
+                        unit=m.unit,
+                        standard_unit=m.standard_unit,
+                        reference_values=m.reference_values,
+                        standard_reference=m.standard_reference,
+                        conversion_to_standard=m.conversion_to_standard,
+                    )
+                    for m in res.scalars()
+                )
+            self.loaded_at = time.monotonic()
+            if rows != self._rows:
+                self._build(rows)
+
+    def _build(self, rows):
+        groups = []
+        names_by_group = {}
+        variants = {}
+        for entry in rows:
+            if entry.group_name not in names_by_group:
+                groups.append(entry.group_name)
+                names_by_group[entry.group_name] = []
+            key = (entry.group_name, entry.name)
+            if key not in variants:
+                names_by_group[entry.group_name].append(entry.name)
+                variants[key] = []
+            variants[key].append(entry)
+
+        # В кнопках группы и анализа — id первого варианта (analyzes_mem.id), а не название
+        groups_kb = InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(
+                    text=g,
+                    callback_data=CatalogGroupCb(mem_id=variants[(g, names_by_group[g][0])][0].id).pack()
+                )] for g in groups
+            ] + [[InlineKeyboardButton(text="✅ Закончить ввод", callback_data="finish")]]
+        )
+        names_kb = {
+            g: InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [InlineKeyboardButton(
+                        text=n, callback_data=CatalogNameCb(mem_id=variants[(g, n)][0].id).pack()
+                    )] for n in names
+                ] + [[InlineKeyboardButton(text="🔙 Назад к группам", callback_data="back_to_groups")]]
+            )
+            for g, names in names_by_group.items()
+        }
+        variants_kb = {
+            key: InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [InlineKeyboardButton(text=f"{v.unit} ({v.reference_values})", callback_data=f"variant|{v.id}")]
+                    for v in items
+                ] + [[InlineKeyboardButton(text="🔙 Назад к анализам", callback_data="back_to_analyses")]]
+            )
+            for key, items in variants.items()
+        }
+
+        # Индекс для ввода списком: нормализованное название → все варианты
+        by_name_key = {}
+        for entry in rows:
+            for key in _name_keys(entry.name):
+                by_name_key.setdefault(key, []).append(entry)
+
+        # Подменяем всё разом, чтобы хендлеры не увидели наполовину собранный индекс
+        self._rows = rows
+        self.groups = groups
+        self.names_by_group = names_by_group
+        self.variants = variants
+        self.by_id = {entry.id: entry for entry in rows}
+        self.by_name_key = by_name_key
+        self._groups_kb = groups_kb
+        self._names_kb = names_kb
+        self._variants_kb = variants_kb
+        self.version += 1
+
+    async def ensure_fresh(self):
+        """Первая загрузка — синхронно, дальше устаревший справочник обновляется в фоне"""
+        if self.loaded_at is None:
+            await self.load()
+        elif time.monotonic() - self.loaded_at > self.ttl and (
+            self._refresh_task is None or self._refresh_task.done()
+        ):
+            self._refresh_task = asyncio.create_task(self._refresh())
+
+    async def _refresh(self):
+        try:
+            await self.load()
+        except Exception:
+            # Остаётся прежний справочник; следующий запрос попробует ещё раз
+            logger.exception("Не удалось обновить справочник анализов")
+
+    def groups_keyboard(self) -> InlineKeyboardMarkup:
+        return self._groups_kb
+
+    def names_keyboard(self, group: str):
+        return self._names_kb.get(group)
+
+    def variants_keyboard(self, group: str, name: str):
+        return self._variants_kb.get((group, name))
+
+    def get(self, mem_id: int):
+        return self.by_id.get(mem_id)
+
+    def lookup(self, name: str, unit: str = ""):
+        """
+        Варианты справочника для названия и (необязательно) единицы.
+
+        Возвращает все подходящие варианты: один — значит однозначно,
+        несколько — нужно уточнить у пользователя, пусто — не найдено.
+        """
+        candidates = self.by_name_key.get(normalize_name(name), [])
+        if unit and candidates:
+            wanted = normalize_unit(unit)
+            by_unit = [e for e in candidates if normalize_unit(e.unit) == wanted]
+            if by_unit:
+                return by_unit
+        return list(candidates)
+
+
+catalog = AnalysisCatalog()
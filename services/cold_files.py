@@ -0,0 +1,221 @@
+"""
+Сжатие «холодных» файлов обследований.
+
+Раз в COLD_CHECK_INTERVAL основной процесс просматривает объекты
+хранилища (services/file_store.py), которые не скачивали COLD_AFTER_DAYS
+дней, и сжимает их рядом с оригиналом. Кодек выбирается по типу файла:
+
+* DICOM, BMP, TIFF и прочие несжатые снимки — xz: сжимаются в разы, а
+  распаковка нужна редко;
+* текст (отчёты, CSV, XML, JSON) — gzip: почти тот же выигрыш, быстрее;
+* JPEG, PNG, ZIP (docx/xlsx), видео и архивы уже сжаты — не трогаем;
+* остальное (в том числе PDF) — gzip, если пробный кусок ужимается
+  хотя бы на 10%.
+
+«Не скачивали» — значит не читали с диска: повторная отправка по
+Telegram file_id (handlers/examinations.py) last_access не обновляет,
+так что файл, который отдаётся только по file_id, тоже сожмётся. Это
+не мешает: с диска его прочитают, лишь если file_id перестанет работать.
+
+Сжатие идёт в потоке (zlib и lzma отпускают GIL), оригинал удаляется
+только после записи в stored_files. Скачивание распаковывает файл на
+лету (``StoredInputFile``). Освобождённое место — в логе после каждого
+прохода и в ``cold_files.snapshot()``.
+"""
+import asyncio
+import gzip
+import logging
+import lzma
+import os
+import shutil
+import time
+import zlib
+from datetime import datetime, timedelta
+from os import getenv
+from typing import Optional
+
+from sqlalchemy import select, update, func
+
+from db import async_session, StoredFile
+from services.file_store import object_path, stored_path, remove_file
+from services.sharding import is_primary_process
+
+COLD_AFTER_DAYS = int(getenv("COLD_AFTER_DAYS", "30"))
+COLD_CHECK_INTERVAL = float(getenv("COLD_CHECK_INTERVAL", str(6 * 3600)))  # секунд между проходами
+COLD_BATCH = int(getenv("COLD_BATCH", "100"))  # объектов за один запрос
+MIN_SAVING = 0.1  # меньше 10% экономии — оставляем файл как есть
+
+SAMPLE_SIZE = 256 * 1024
+
+logger = logging.getLogger(__name__)
+
+_COMPRESSED_MAGIC = (
+    b"\xff\xd8\xff",        # JPEG
+    b"\x89PNG",             # PNG
+    b"GIF8",                # GIF
+    b"PK\x03\x04",          # ZIP, docx, xlsx
+    b"\x1f\x8b",            # gzip
+    b"\xfd7zXZ",            # xz
+    b"7z\xbc\xaf",          # 7z
+    b"Rar!",                # RAR
+    b"RIFF",                # WebP, AVI
+)
+_RAW_IMAGE_MAGIC = (b"BM", b"II*\x00", b"MM\x00*")  # BMP, TIFF
+
+
+def choose_codec(path: str) -> Optional[str]:
+    """Кодек для файла по его содержимому или None, если сжимать не стоит"""
+    with open(path, "rb") as f:
+        head = f.read(SAMPLE_SIZE)
+    if head.startswith(_COMPRESSED_MAGIC) or head[4:8] == b"ftyp":  # ftyp — MP4/MOV/HEIC
+        return None
+    if head[128:132] == b"DICM" or head.startswith(_RAW_IMAGE_MAGIC):
+        return "xz"
+    try:
+        head.decode("utf-8")
+        return "gz"
+    except UnicodeDecodeError as e:
+        if e.start >= len(head) - 4:  # многобайтный символ разрезан концом пробы
+            return "gz"
+    # Неизвестный формат: пробуем, стоит ли он сжатия
+    if len(zlib.compress(head, 1)) < len(head) * (1 - MIN_SAVING):
+        return "gz"
+    return None
+
+
+def compress_file(src: str, codec: str) -> int:
+    """Пишет сжатую копию ``src`` рядом (через временный файл); возвращает её размер"""
+    dst = stored_path(src, codec)
+    tmp = dst + ".tmp"
+    opener = gzip.open if codec == "gz" else lzma.open
+    with open(src, "rb") as fin, opener(tmp, "wb") as fout:
+        shutil.copyfileobj(fin, fout, 1024 * 1024)
+    os.replace(tmp, dst)
+    return os.path.getsize(dst)
+
+
+class ColdFileCompressor:
+    def __init__(self, session_pool=async_session, after_days: int = COLD_AFTER_DAYS, batch: int = COLD_BATCH):
+        self._pool = session_pool
+        self.after = timedelta(days=after_days)
+        self.batch = batch
+        self._task: Optional[asyncio.Task] = None
+        self.compressed = 0
+        self.skipped = 0
+        self.saved_bytes = 0
+        self.last_run: Optional[float] = None
+
+    async def start(self):
+        if not is_primary_process():
+            return
+        self._task = asyncio.create_task(self._loop())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Ошибка сжатия холодных файлов")
+            await asyncio.sleep(COLD_CHECK_INTERVAL)
+
+    async def run_once(self) -> int:
+        """Один проход по холодным объектам; возвращает освобождённые байты"""
+        cutoff = datetime.utcnow() - self.after
+        saved = compressed = 0
+        last = ""
+        while True:
+            async with self._pool() as session:
+                rows = (await session.execute(
+                    select(StoredFile.sha256, StoredFile.size)
+                    .where(
+                        StoredFile.sha256 > last,
+                        StoredFile.compression.is_(None),
+                        func.coalesce(StoredFile.last_access, StoredFile.created_at) < cutoff,
+                    )
+                    .order_by(StoredFile.sha256)
+                    .limit(self.batch)
+                )).all()
+            if not rows:
+                break
+            for sha256, size in rows:
+                freed = await self._compress(sha256, size)
+                if freed is not None:
+                    compressed += 1
+                    saved += freed
+            last = rows[-1][0]
+
+        self.compressed += compressed
+        self.saved_bytes += saved
+        self.last_run = time.time()
+        if compressed:
+            logger.info("Сжато холодных файлов: %s, освобождено %.1f МБ", compressed, saved / 2**20)
+        return saved
+
+    async def _compress(self, sha256: str, size: int) -> Optional[int]:
+        path = object_path(sha256)
+        try:
+            codec = await asyncio.to_thread(choose_codec, path)
+            stored_size = await asyncio.to_thread(compress_file, path, codec) if codec else None
+        except FileNotFoundError:
+            logger.warning("Объект %s отсутствует на диске", sha256)
+            codec = stored_size = None
+
+        if codec and stored_size > size * (1 - MIN_SAVING):
+            await remove_file(stored_path(path, codec))
+            codec = stored_size = None
+        if codec is None:
+            self.skipped += 1
+            await self._mark(sha256, "none", None)
+            return None
+
+        if not await self._mark(sha256, codec, stored_size):
+            # Пока сжимали, объект удалили или изменили — копия не нужна
+            await remove_file(stored_path(path, codec))
+            return None
+        await remove_file(path)
+        return size - stored_size
+
+    async def _mark(self, sha256: str, codec: str, stored_size: Optional[int]) -> bool:
+        async with self._pool() as session:
+            result = await session.execute(
+                update(StoredFile)
+                .where(StoredFile.sha256 == sha256, StoredFile.compression.is_(None))
+                .values(compression=codec, stored_size=stored_size)
+            )
+            await session.commit()
+        return bool(result.rowcount)
+
+    async def totals(self) -> dict:
+        """Сколько места занимают объекты до и после сжатия"""
+        async with self._pool() as session:
+            raw, on_disk, compressed = (await session.execute(
+                select(
+                    func.coalesce(func.sum(StoredFile.size), 0),
+                    func.coalesce(func.sum(func.coalesce(StoredFile.stored_size, StoredFile.size)), 0),
+                    func.count(StoredFile.stored_size),
+                )
+            )).one()
+        return {
+            "objects_compressed": compressed,
+            "bytes_raw": int(raw),
+            "bytes_on_disk": int(on_disk),
+            "bytes_saved": int(raw) - int(on_disk),
+        }
+
+    async def snapshot(self) -> dict:
+        return {
+            **await self.totals(),
+            "compressed_since_start": self.compressed,
+            "skipped_since_start": self.skipped,
+            "saved_since_start": self.saved_bytes,
+            "last_run": self.last_run,
+        }
+
+
+cold_files = ColdFileCompressor()
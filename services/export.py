@@ -0,0 +1,253 @@
+"""
+Выгрузка всех данных пользователя одним ZIP-архивом.
+
+Архив собирается фоновой задачей во временный файл и пишется по ходу
+чтения: строки каждой таблицы идут из БД серверным курсором
+(``stream_scalars`` пачками по EXPORT_ROWS) и сразу дописываются в CSV
+внутри архива, файлы обследований копируются из хранилища по частям
+(сжатые холодные — распаковываются на лету). В памяти — одна пачка строк
+или один кусок файла, сколько бы лет истории ни набралось. Запись в ZIP
+(сжатие и диск) идёт в потоке, чтобы не держать цикл событий.
+
+Готовый архив отправляется документом. Бот может отправить файл до
+50 МБ, поэтому вложения, с которыми архив превысил бы лимит, не
+добавляются и перечисляются в export.json — их можно скачать из
+карточки обследования.
+"""
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import zipfile
+from datetime import date, datetime
+from os import getenv
+from typing import Optional, Set
+
+import aiofiles.os
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+from sqlalchemy import select
+
+from db import (
+    async_session, UserData, Analysis, DoctorAppointment, InstrumentalExamination, Recommendation, StoredFile
+)
+from services.file_store import file_store, read_stored
+
+EXPORT_ROWS = int(getenv("EXPORT_ROWS", "500"))      # строк в одной пачке из БД
+EXPORT_MAX = int(getenv("EXPORT_MAX", "2"))          # одновременных выгрузок на процесс
+EXPORT_MAX_MB = int(getenv("EXPORT_MAX_MB", "50"))   # лимит отправки файла ботом
+
+logger = logging.getLogger(__name__)
+
+# Таблицы архива: имя CSV, модель, порядок; служебные колонки не выгружаем
+_TABLES = (
+    ("analysis.csv", Analysis, (Analysis.date, Analysis.id)),
+    ("doctor_appointments.csv", DoctorAppointment, (DoctorAppointment.appointment_date, DoctorAppointment.id)),
+    ("recommendations.csv", Recommendation, (Recommendation.created_at, Recommendation.id)),
+    ("instrumental_examinations.csv", InstrumentalExamination,
+     (InstrumentalExamination.examination_date, InstrumentalExamination.id)),
+)
+_HIDDEN = {"telegram_id", "file_path", "file_hash", "tg_file_id", "tg_file_unique_id"}
+
+
+def _value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return "" if value is None else value
+
+
+def _attachment_name(exam_id: int, file_name: Optional[str]) -> str:
+    # Имя внутри архива: id обследования + исходное имя без путей и спецсимволов
+    safe = re.sub(r'[\\/:*?"<>|\x00-\x1f]', "_", os.path.basename(file_name or "file"))[:100]
+    return f"files/{exam_id}_{safe}"
+
+
+class _ZipWriter:
+    """ZIP во временном файле; вся запись — в потоке"""
+
+    def __init__(self, path: str):
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        self._member = None
+
+    async def open(self, name: str, compress: bool = True):
+        info = zipfile.ZipInfo(name, date_time=datetime.now().timetuple()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        self._member = await asyncio.to_thread(self.zip.open, info, "w", force_zip64=True)
+        return self._member
+
+    @staticmethod
+    async def write(member, data: bytes):
+        await asyncio.to_thread(member.write, data)
+
+    async def close_member(self, member):
+        self._member = None
+        await asyncio.to_thread(member.close)
+
+    def size(self) -> int:
+        return self.zip.fp.tell()
+
+    async def close(self):
+        # После ошибки посреди файла его запись ещё открыта — закрываем, иначе zipfile не закроет архив
+        if self._member is not None:
+            await self.close_member(self._member)
+        await asyncio.to_thread(self.zip.close)
+
+
+class DataExporter:
+    def __init__(self, session_pool=async_session, max_running: int = EXPORT_MAX):
+        self._pool = session_pool
+        self._slots = asyncio.Semaphore(max_running)
+        self._users: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self, bot: Bot, chat_id: int, message_id: int, telegram_id: int) -> bool:
+        """Запускает выгрузку; False — у пользователя уже идёт выгрузка"""
+        if telegram_id in self._users:
+            return False
+        self._users.add(telegram_id)
+        task = asyncio.create_task(self._run(bot, chat_id, message_id, telegram_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _run(self, bot: Bot, chat_id: int, message_id: int, telegram_id: int):
+        fd, path = await asyncio.to_thread(tempfile.mkstemp, suffix=".zip")
+        os.close(fd)
+        try:
+            async with self._slots:
+                manifest = await self.build(path, telegram_id)
+            caption = "📦 Все ваши данные: таблицы CSV и файлы обследований."
+            if manifest["skipped_files"]:
+                caption += (f"\n⚠️ Не поместились в лимит {EXPORT_MAX_MB} МБ файлов: {len(manifest['skipped_files'])}. "
+                            "Их можно скачать в разделе «🩻 Обследования».")
+            document = FSInputFile(path, filename=f"medical_data_{date.today().isoformat()}.zip")
+            async with file_store.transfer():
+                await bot.send_document(chat_id, document, caption=caption)
+            await _edit(bot, chat_id, message_id, "✅ Архив с данными готов.")
+        except asyncio.CancelledError:
+            await _edit(bot, chat_id, message_id, "⚠️ Выгрузка прервана остановкой бота. Запросите её ещё раз.")
+            raise
+        except Exception:
+            logger.exception("Ошибка выгрузки данных пользователя %s", telegram_id)
+            await _edit(bot, chat_id, message_id, "❌ Не удалось подготовить архив. Попробуйте позже.")
+        finally:
+            self._users.discard(telegram_id)
+            try:
+                await aiofiles.os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def build(self, path: str, telegram_id: int) -> dict:
+        """Пишет архив пользователя в ``path``; возвращает его опись (export.json)"""
+        writer = _ZipWriter(path)
+        manifest = {"created_at": datetime.now().isoformat(timespec="seconds"), "tables": {}, "skipped_files": []}
+        try:
+            await self._write_profile(writer, telegram_id)
+            for name, model, order in _TABLES:
+                manifest["tables"][name] = await self._write_table(writer, name, model, order, telegram_id)
+            manifest["files"] = await self._write_files(writer, telegram_id, manifest["skipped_files"])
+            member = await writer.open("export.json")
+            await writer.write(member, json.dumps(manifest, ensure_ascii=False, indent=2).encode())
+            await writer.close_member(member)
+        finally:
+            await writer.close()
+        return manifest
+
+    async def _write_profile(self, writer: _ZipWriter, telegram_id: int):
+        async with self._pool() as session:
+            profile = await session.scalar(select(UserData).where(UserData.telegram_id == telegram_id))
+        data = {} if profile is None else {
+            c.name: _value(getattr(profile, c.key)) for c in UserData.__table__.columns if c.name not in ("id", "telegram_id")
+        }
+        member = await writer.open("user_data.json")
+        await writer.write(member, json.dumps(data, ensure_ascii=False, indent=2).encode())
+        await writer.close_member(member)
+
+    async def _write_table(self, writer: _ZipWriter, name: str, model, order, telegram_id: int) -> int:
+        columns = [c for c in model.__table__.columns if c.name not in _HIDDEN]
+        header = [c.name for c in columns]
+        if model is InstrumentalExamination:
+            header.append("file")
+        buffer = io.StringIO()
+        out = csv.writer(buffer)
+        out.writerow(header)
+        member = await writer.open(name)
+        await writer.write(member, "\ufeff".encode())  # BOM: Excel откроет кириллицу правильно
+        count = 0
+        async with self._pool() as session:
+            rows = await session.stream_scalars(
+                select(model).where(model.telegram_id == telegram_id).order_by(*order)
+                .execution_options(yield_per=EXPORT_ROWS)
+            )
+            async for batch in rows.partitions():
+                for row in batch:
+                    values = [_value(getattr(row, c.key)) for c in columns]
+                    if model is InstrumentalExamination:
+                        values.append(_attachment_name(row.id, row.file_name) if row.file_path else "")
+                    out.writerow(values)
+                count += len(batch)
+                # Пачку — в архив, буфер — заново: в памяти только текущие строки
+                await writer.write(member, buffer.getvalue().encode())
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
+            await writer.write(member, buffer.getvalue().encode())
+        await writer.close_member(member)
+        return count
+
+    async def _write_files(self, writer: _ZipWriter, telegram_id: int, skipped: list) -> int:
+        limit = EXPORT_MAX_MB * 1024 * 1024 - 1024 * 1024  # запас на опись и каталог архива
+        written = 0
+        async with self._pool() as session:
+            rows = await session.stream(
+                select(
+                    InstrumentalExamination.id, InstrumentalExamination.file_name,
+                    InstrumentalExamination.file_path, StoredFile.compression, StoredFile.size,
+                )
+                .outerjoin(StoredFile, StoredFile.sha256 == InstrumentalExamination.file_hash)
+                .where(InstrumentalExamination.telegram_id == telegram_id, InstrumentalExamination.file_path.isnot(None))
+                .order_by(InstrumentalExamination.id)
+                .execution_options(yield_per=EXPORT_ROWS)
+            )
+            async for exam_id, file_name, file_path, compression, size in rows:
+                name = _attachment_name(exam_id, file_name)
+                if size is None:  # файл из времён до хранилища
+                    try:
+                        size = (await aiofiles.os.stat(file_path)).st_size
+                    except FileNotFoundError:
+                        skipped.append(name)
+                        continue
+                if writer.size() + size > limit:
+                    skipped.append(name)
+                    continue
+                # Вложения почти всегда уже сжаты (PDF, JPEG) — кладём без сжатия
+                member = await writer.open(name, compress=False)
+                try:
+                    async for chunk in read_stored(file_path, compression):
+                        await writer.write(member, chunk)
+                    written += 1
+                except FileNotFoundError:
+                    skipped.append(name)
+                finally:
+                    await writer.close_member(member)
+        return written
+
+    async def shutdown(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def _edit(bot: Bot, chat_id: int, message_id: int, text: str):
+    try:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+    except TelegramBadRequest:
+        pass
+
+
+data_exporter = DataExporter()
@@ -0,0 +1,277 @@
+"""
+Хранилище файлов обследований с адресацией по содержимому.
+
+Файл лежит в ``uploaded_files/objects/ab/cd/<sha256>``: хэш считается,
+пока файл качается из Telegram во временный файл, после чего временный
+файл переносится на место одним rename. Путь вычисляется из хэша, так
+что ни подбора свободного имени, ни обхода каталога нет, а два уровня
+подкаталогов по 256 держат в каждом из них сотни файлов даже при
+миллионах объектов.
+
+Одинаковые загрузки (тот же скан в двух обследованиях) хранятся один
+раз: число ссылающихся обследований — в ``stored_files.refcount``, файл
+удаляется вместе с последней ссылкой. Счётчик меняется отдельной
+короткой транзакцией до сохранения обследования и после его удаления,
+поэтому сбой между ними оставит лишний файл, но не потеряет нужный.
+
+Взятие ссылки с переносом файла на место и удаление последней ссылки с
+файлом идут под блокировкой объекта (по sha256), иначе удаление могло бы
+стереть файл, только что положенный новой загрузкой того же содержимого.
+Блокировка — в памяти процесса: у воркеров (services/sharding.py) она
+защищает загрузки одного пользователя, а одинаковые файлы разных
+пользователей в разных воркерах по-прежнему могут разминуться.
+
+Файлы, загруженные до хранилища, лежат прямо в uploaded_files и
+``file_hash`` у них пустой — такие удаляются как раньше, без счётчика.
+
+Вся работа с диском асинхронная (aiofiles): поток из Telegram пишется
+чанками во временный файл, размер проверяется по мере скачивания, а не
+по заявленному file_size, и одновременных передач не больше
+FILE_TRANSFERS_MAX — десяток сканов по 50 МБ не забьёт канал и диск.
+
+Давно не скачанные объекты services/cold_files.py сжимает рядом
+(``<sha256>.gz`` / ``.xz``); ``read_stored`` и ``StoredInputFile``
+распаковывают их на лету, так что остальной код про сжатие не знает.
+"""
+import asyncio
+import hashlib
+import logging
+import lzma
+import os
+import uuid
+import zlib
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from os import getenv
+from typing import AsyncGenerator, AsyncIterator, Dict, Optional
+
+import aiofiles
+import aiofiles.os
+from aiogram import Bot
+from aiogram.types import InputFile
+from sqlalchemy import select, update, delete
+from sqlalchemy.exc import IntegrityError
+
+from db import async_session, StoredFile
+
+UPLOAD_DIR = getenv("UPLOAD_DIR", "uploaded_files")
+OBJECTS_DIR = os.path.join(UPLOAD_DIR, "objects")
+TMP_DIR = os.path.join(UPLOAD_DIR, "tmp")  # на том же диске, чтобы rename был атомарным
+FILE_MAX_MB = int(getenv("FILE_MAX_MB", "50"))
+FILE_TRANSFERS_MAX = int(getenv("FILE_TRANSFERS_MAX", "4"))  # одновременных скачиваний/отправок с диска
+CHUNK_SIZE = 64 * 1024
+
+# Сжатые варианты объекта: код в stored_files.compression → суффикс файла
+CODEC_SUFFIXES = {"gz": ".gz", "xz": ".xz"}
+
+logger = logging.getLogger(__name__)
+
+
+class FileTooLarge(Exception):
+    def __init__(self, limit: int):
+        super().__init__(f"file is larger than {limit} bytes")
+        self.limit = limit
+
+
+@dataclass
+class StoredObject:
+    sha256: str
+    path: str
+    size: int
+
+
+def object_path(sha256: str) -> str:
+    return os.path.join(OBJECTS_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+def stored_path(path: str, compression: Optional[str]) -> str:
+    """Путь к файлу объекта на диске с учётом сжатия"""
+    return path + CODEC_SUFFIXES.get(compression, "")
+
+
+def _decompressor(compression: Optional[str]):
+    if compression == "gz":
+        return zlib.decompressobj(wbits=31)
+    if compression == "xz":
+        return lzma.LZMADecompressor()
+    return None
+
+
+async def read_stored(path: str, compression: Optional[str] = None,
+                      chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Содержимое объекта по частям; сжатый файл распаковывается на лету.
+
+    Если файла в записанном виде нет (его только что сжали или вернули
+    после повторной загрузки), пробуем остальные варианты.
+    """
+    variants = [compression] + [c for c in (None, *CODEC_SUFFIXES) if c != compression]
+    for variant in variants:
+        try:
+            f = await aiofiles.open(stored_path(path, variant), "rb")
+        except FileNotFoundError:
+            continue
+        try:
+            decompressor = _decompressor(variant)
+            while chunk := await f.read(chunk_size):
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                if chunk:
+                    yield chunk
+            if variant == "gz" and (tail := decompressor.flush()):
+                yield tail
+        finally:
+            await f.close()
+        return
+    raise FileNotFoundError(path)
+
+
+class StoredInputFile(InputFile):
+    """Файл из хранилища для отправки в Telegram; сжатый уходит распакованным"""
+
+    def __init__(self, path: str, compression: Optional[str] = None, filename: Optional[str] = None,
+                 chunk_size: int = CHUNK_SIZE):
+        super().__init__(filename=filename or os.path.basename(path), chunk_size=chunk_size)
+        self.path = path
+        self.compression = compression
+
+    async def read(self, bot: Bot) -> AsyncIterator[bytes]:
+        async for chunk in read_stored(self.path, self.compression, self.chunk_size):
+            yield chunk
+
+
+async def _telegram_stream(bot: Bot, file_id: str) -> AsyncIterator[bytes]:
+    file = await bot.get_file(file_id)
+    if bot.session.api.is_local:
+        # Локальный Bot API отдаёт путь к файлу на этой же машине
+        async with aiofiles.open(bot.session.api.wrap_local_file.to_local(file.file_path), "rb") as f:
+            while chunk := await f.read(CHUNK_SIZE):
+                yield chunk
+        return
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    async for chunk in bot.session.stream_content(url=url, chunk_size=CHUNK_SIZE, raise_for_status=True):
+        yield chunk
+
+
+class FileStore:
+    def __init__(self, session_pool=async_session, max_transfers: int = FILE_TRANSFERS_MAX):
+        self._pool = session_pool
+        self._transfers = asyncio.Semaphore(max_transfers)
+        self._locks: Dict[str, list] = {}
+
+    def transfer(self) -> asyncio.Semaphore:
+        """Слот передачи: ``async with file_store.transfer(): ...`` вокруг отправки файла с диска"""
+        return self._transfers
+
+    @asynccontextmanager
+    async def _object_lock(self, sha256: str) -> AsyncGenerator[None, None]:
+        """Блокировка объекта: ссылка и файл на диске меняются вместе"""
+        entry = self._locks.setdefault(sha256, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._locks.pop(sha256, None)
+
+    async def download(self, bot: Bot, file_id: str, max_bytes: int = FILE_MAX_MB * 1024 * 1024,
+                       directory: str = TMP_DIR, suffix: str = "") -> StoredObject:
+        """
+        Скачивает файл из Telegram во временный файл в ``directory``.
+
+        Размер и sha256 считаются на лету; больше ``max_bytes`` — FileTooLarge,
+        и недокачанный файл удаляется. Временный файл удаляет вызывающий.
+        """
+        await aiofiles.os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, f"{uuid.uuid4().hex}{suffix}")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async with self._transfers:
+                async with aiofiles.open(tmp_path, "xb") as f:
+                    async for chunk in _telegram_stream(bot, file_id):
+                        size += len(chunk)
+                        if size > max_bytes:
+                            raise FileTooLarge(max_bytes)
+                        digest.update(chunk)
+                        await f.write(chunk)
+        except BaseException:
+            await remove_file(tmp_path)
+            raise
+        return StoredObject(digest.hexdigest(), tmp_path, size)
+
+    async def save_from_telegram(self, bot: Bot, file_id: str, max_bytes: int = FILE_MAX_MB * 1024 * 1024) -> StoredObject:
+        """Скачивает файл из Telegram в хранилище и берёт на него ссылку"""
+        tmp = await self.download(bot, file_id, max_bytes)
+        try:
+            stored = StoredObject(tmp.sha256, object_path(tmp.sha256), tmp.size)
+            # Ссылка и файл — под блокировкой объекта: release того же sha256
+            # не удалит файл между взятием ссылки и переносом на место
+            async with self._object_lock(stored.sha256):
+                compression = await self.acquire(stored.sha256, stored.size)
+                if compression in CODEC_SUFFIXES:
+                    await remove_file(tmp.path)  # объект уже лежит сжатым — копия не нужна
+                else:
+                    await aiofiles.os.makedirs(os.path.dirname(stored.path), exist_ok=True)
+                    await aiofiles.os.replace(tmp.path, stored.path)
+            return stored
+        except BaseException:
+            await remove_file(tmp.path)
+            raise
+
+    async def acquire(self, sha256: str, size: int) -> Optional[str]:
+        """Берёт ссылку на объект; возвращает его сжатие (None у нового)"""
+        async with self._pool() as session:
+            result = await session.execute(
+                update(StoredFile).where(StoredFile.sha256 == sha256).values(refcount=StoredFile.refcount + 1)
+            )
+            if not result.rowcount:
+                session.add(StoredFile(sha256=sha256, size=size, refcount=1))
+                try:
+                    await session.commit()
+                    return None
+                except IntegrityError:
+                    # Тот же файл одновременно загрузил кто-то ещё
+                    await session.rollback()
+                    await session.execute(
+                        update(StoredFile).where(StoredFile.sha256 == sha256).values(refcount=StoredFile.refcount + 1)
+                    )
+            compression = await session.scalar(select(StoredFile.compression).where(StoredFile.sha256 == sha256))
+            await session.commit()
+            return compression
+
+    async def release(self, file_path: Optional[str], sha256: Optional[str]):
+        """Снимает ссылку обследования на файл; последний удаляет файл с диска"""
+        if not file_path:
+            return
+        if sha256 is None:
+            await remove_file(file_path)  # файл из времён до хранилища
+            return
+        async with self._object_lock(sha256):
+            async with self._pool() as session:
+                await session.execute(
+                    update(StoredFile)
+                    .where(StoredFile.sha256 == sha256, StoredFile.refcount > 0)
+                    .values(refcount=StoredFile.refcount - 1)
+                )
+                gone = await session.execute(
+                    delete(StoredFile).where(StoredFile.sha256 == sha256, StoredFile.refcount <= 0)
+                )
+                await session.commit()
+            if gone.rowcount:
+                for compression in (None, *CODEC_SUFFIXES):
+                    await remove_file(stored_path(file_path, compression))
+
+
+async def remove_file(path: str):
+    try:
+        await aiofiles.os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        logger.warning("Не удалось удалить файл %s", path)
+
+
+file_store = FileStore()
@@ -0,0 +1,194 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import Any, AsyncGenerator, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import (
+    BaseEventIsolation,
+    BaseStorage,
+    DefaultKeyBuilder,
+    KeyBuilder,
+    StateType,
+    StorageKey,
+)
+from sqlalchemy import select, update, delete, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from db import FSMRecord
+
+
+def _json_default(value):
+    # В state хранятся даты (дата сдачи анализа, дата приёма и т.п.)
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, date):
+        return {"__date__": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1:
+        if "__datetime__" in obj:
+            return datetime.fromisoformat(obj["__datetime__"])
+        if "__date__" in obj:
+            return date.fromisoformat(obj["__date__"])
+    return obj
+
+
+def dump_data(data: Dict[str, Any]) -> str:
+    return json.dumps(data, ensure_ascii=False, default=_json_default)
+
+
+def load_data(raw: Optional[str]) -> Dict[str, Any]:
+    return json.loads(raw, object_hook=_json_object_hook) if raw else {}
+
+
+@dataclass
+class _Record:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    exists: bool = False  # есть ли строка в БД
+    dirty: bool = False
+
+
+class SQLStorage(BaseStorage):
+    """
+    FSM-хранилище в нашей SQL-базе (таблица fsm_storage).
+
+    Внутри ``SQLEventIsolation.lock`` все чтения и записи одного апдейта идут
+    через буфер: строка читается один раз, а несколько ``set_state`` /
+    ``update_data`` хендлера сливаются в одну запись при выходе из блокировки.
+    Вне блокировки хранилище пишет в БД сразу.
+    """
+
+    def __init__(self, session_pool: sessionmaker, key_builder: Optional[KeyBuilder] = None):
+        self.session_pool = session_pool
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self._batch: ContextVar[Optional[Dict[str, _Record]]] = ContextVar("fsm_batch", default=None)
+
+    def create_isolation(self) -> "SQLEventIsolation":
+        return SQLEventIsolation(self)
+
+    async def close(self) -> None:
+        pass
+
+    async def _read(self, key: str) -> _Record:
+        async with self.session_pool() as session:
+            row = (await session.execute(
+                select(FSMRecord.state, FSMRecord.data).where(FSMRecord.key == key)
+            )).first()
+        if row is None:
+            return _Record()
+        return _Record(state=row.state, data=load_data(row.data), exists=True)
+
+    async def _record(self, key: str) -> _Record:
+        batch = self._batch.get()
+        if batch is None:
+            return await self._read(key)
+        if key not in batch:
+            batch[key] = await self._read(key)
+        return batch[key]
+
+    async def _write(self, key: str, record: _Record) -> None:
+        async with self.session_pool() as session:
+            if record.state is None and not record.data:
+                # Пустой контекст (state.clear()) — строку просто удаляем
+                if record.exists:
+                    await session.execute(delete(FSMRecord).where(FSMRecord.key == key))
+                record.exists = False
+            else:
+                values = {"state": record.state, "data": dump_data(record.data), "updated_at": datetime.utcnow()}
+                written = False
+                if record.exists:
+                    res = await session.execute(update(FSMRecord).where(FSMRecord.key == key).values(**values))
+                    written = res.rowcount > 0
+                if not written:
+                    try:
+                        await session.execute(insert(FSMRecord).values(key=key, **values))
+                        await session.commit()
+                    except IntegrityError:
+                        # Строку успел создать другой процесс
+                        await session.rollback()
+                        await session.execute(update(FSMRecord).where(FSMRecord.key == key).values(**values))
+                record.exists = True
+            await session.commit()
+        record.dirty = False
+
+    async def _save(self, key: str, record: _Record) -> None:
+        if self._batch.get() is None:
+            await self._write(key, record)
+        else:
+            record.dirty = True
+
+    async def flush(self) -> None:
+        """Записывает накопленные за апдейт изменения"""
+        batch = self._batch.get()
+        if not batch:
+            return
+        for key, record in batch.items():
+            if record.dirty:
+                await self._write(key, record)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self.key_builder.build(key)
+        record = await self._record(k)
+        record.state = state.state if isinstance(state, State) else state
+        await self._save(k, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(self.key_builder.build(key))).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k = self.key_builder.build(key)
+        record = await self._record(k)
+        record.data = data.copy()
+        await self._save(k, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._record(self.key_builder.build(key))).data.copy()
+
+
+class SQLEventIsolation(BaseEventIsolation):
+    """
+    Последовательная обработка апдейтов одного пользователя + буфер записи FSM.
+
+    FSMContextMiddleware держит эту блокировку на всё время обработки
+    апдейта (включая чтение state для фильтров), поэтому на апдейт
+    приходится одно чтение и не больше одной записи в fsm_storage.
+
+    Блокировка — в памяти процесса: апдейты одного пользователя должны
+    приходить в один процесс. В режиме воркеров (services/sharding.py)
+    это так по построению; вебхук — одна реплика (services/webhook.py).
+    """
+
+    def __init__(self, storage: SQLStorage):
+        self.storage = storage
+        self._locks: Dict[str, list] = {}
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        k = self.storage.key_builder.build(key)
+        entry = self._locks.setdefault(k, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                token = self.storage._batch.set({})
+                try:
+                    yield
+                finally:
+                    try:
+                        await self.storage.flush()
+                    finally:
+                        self.storage._batch.reset(token)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._locks.pop(k, None)
+
+    async def close(self) -> None:
+        self._locks.clear()
@@ -0,0 +1,143 @@
+"""
+Импорт PDF-бланков лаборатории в таблицу analysis.
+
+Хендлер только сохраняет присланный файл во временный файл (aiogram
+качает его потоком) и запускает фоновую задачу. Задача читает PDF
+пачками по LAB_IMPORT_PAGES страниц в воркерах ``renderer``, разбирает
+строки тем же парсером, что и ввод списком, и после каждой пачки
+записывает найденные результаты отдельной транзакцией. Ход импорта
+показывается правкой одного сообщения. Цикл событий не ждёт разбора PDF,
+а в памяти бота — только строки текущей пачки.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import date
+from os import getenv
+from typing import Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+
+from db import async_session
+from middlewares.send_limiter import bulk_sends
+from services import pdf_text
+from services.bulk_entry import parse_line, analysis_values, save_analyses
+from services.catalog import catalog
+from services.reports import renderer, ReportQueueFull
+
+# Telegram отдаёт ботам через getFile файлы до 20 МБ; 50 МБ — с локальным Bot API
+LAB_PDF_MAX_MB = int(getenv("LAB_PDF_MAX_MB", "50"))
+LAB_IMPORT_PAGES = int(getenv("LAB_IMPORT_PAGES", "5"))
+LAB_IMPORT_MAX = int(getenv("LAB_IMPORT_MAX", "2"))  # одновременных импортов на процесс
+PROGRESS_INTERVAL = 1.5  # секунд между правками сообщения
+
+logger = logging.getLogger(__name__)
+
+
+class LabImporter:
+    def __init__(self, max_running: int = LAB_IMPORT_MAX):
+        self._slots = asyncio.Semaphore(max_running)
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self, bot: Bot, chat_id: int, message_id: int, telegram_id: int, path: str, day: date):
+        """Запускает импорт файла ``path``; по окончании файл удаляется"""
+        task = asyncio.create_task(self._run(bot, chat_id, message_id, telegram_id, path, day))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, bot, chat_id, message_id, telegram_id, path, day):
+        progress = _Progress(bot, chat_id, message_id)
+        # Правки прогресса — фоновые: уступают ответам пользователям
+        with bulk_sends():
+            try:
+                async with self._slots:
+                    await self._import(progress, telegram_id, path, day)
+            except asyncio.CancelledError:
+                await progress.show("⚠️ Импорт прерван остановкой бота. Отправьте файл ещё раз.", force=True)
+                raise
+            except Exception:
+                logger.exception("Ошибка импорта PDF %s", path)
+                await progress.show("❌ Не удалось прочитать PDF. Проверьте, что файл не повреждён и содержит текст.", force=True)
+            finally:
+                await asyncio.to_thread(_remove, path)
+
+    async def _import(self, progress: "_Progress", telegram_id: int, path: str, day: date):
+        await catalog.ensure_fresh()
+        pages = await _in_worker(pdf_text.page_count, path)
+        saved, unmatched, seen = [], [], set()
+
+        for start in range(0, pages, LAB_IMPORT_PAGES):
+            lines = await _in_worker(pdf_text.extract_lines, path, start, start + LAB_IMPORT_PAGES)
+            rows = []
+            for line in lines:
+                parsed = parse_line(line, catalog, unit_token=True)
+                if parsed.status == "ok":
+                    entry = parsed.candidates[0]
+                    # Одно значение анализа на бланк: сводки и повторы на других страницах пропускаем
+                    if entry.name not in seen:
+                        seen.add(entry.name)
+                        rows.append(analysis_values(telegram_id, entry, parsed.value, day))
+                elif parsed.status == "ambiguous" and len(unmatched) < 20:
+                    unmatched.append(line)
+            if rows:
+                async with async_session() as session:
+                    await save_analyses(session, telegram_id, rows)
+                saved += [f"{r['name']} = {r['result']} {r['units']}" for r in rows]
+
+            done = min(start + LAB_IMPORT_PAGES, pages)
+            await progress.show(f"⏳ Обработано страниц: {done} из {pages}\nНайдено анализов: {len(saved)}")
+
+        text = [f"✅ Импорт завершён. Страниц: {pages}, сохранено анализов: {len(saved)}"]
+        text += saved[:50]
+        if len(saved) > 50:
+            text.append(f"… и ещё {len(saved) - 50}")
+        if unmatched:
+            text.append("\n⚠️ Не удалось однозначно сопоставить (введите их вручную):")
+            text += unmatched
+        await progress.show("\n".join(text)[:4096], force=True)
+
+    async def shutdown(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class _Progress:
+    """Правка одного сообщения не чаще раза в PROGRESS_INTERVAL"""
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self._last = 0.0
+
+    async def show(self, text: str, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last < PROGRESS_INTERVAL:
+            return
+        self._last = now
+        try:
+            await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+        except TelegramBadRequest:
+            pass  # сообщение удалено или текст не изменился
+
+
+async def _in_worker(func, *args):
+    # Фоновый импорт не отказывает при полной очереди отчётов, а ждёт
+    while True:
+        try:
+            return await renderer.run(func, *args)
+        except ReportQueueFull:
+            await asyncio.sleep(1)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+lab_importer = LabImporter()
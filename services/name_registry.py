@@ -0,0 +1,131 @@
+"""
+Реестр id ↔ название для callback_data.
+
+Вместо названия (группа, анализ, врач, категория) в кнопку кладётся
+числовой id строки callback_names, а хендлер получает название по
+первичному ключу. Так callback_data всегда укладывается в 64 байта
+Telegram, даже для длинных названий кириллицей. Id выдаются в пределах
+пользователя: чужой id просто не найдётся, а «Удалить все данные»
+удаляет и эти строки.
+
+Соответствия не меняются, поэтому кэшируются в памяти процесса (LRU).
+Исключение — удаление всех данных: строки удаляет фоновая задача
+(services/purge.py), возможно, в другом процессе. Процесс, который
+обслуживает пользователя, сбрасывает его кэш при заявке и не кэширует
+его, пока заявка в purge_jobs не исчезнет.
+"""
+from collections import OrderedDict
+from os import getenv
+from typing import Dict, Iterable, Optional, Set
+
+from sqlalchemy import select, insert
+from sqlalchemy.exc import IntegrityError
+
+from db import async_session, CallbackName, PurgeJob
+
+NAME_CACHE_SIZE = int(getenv("NAME_CACHE_SIZE", "100000"))
+
+# Виды названий
+GROUP = "group"
+ANALYSIS = "analysis"
+DOCTOR = "doctor"
+CATEGORY = "category"
+
+
+class NameRegistry:
+    def __init__(self, session_pool=async_session, cache_size: int = NAME_CACHE_SIZE):
+        self._pool = session_pool
+        self._cache_size = cache_size
+        self._ids: "OrderedDict[tuple, int]" = OrderedDict()     # (user, kind, name) → id
+        self._names: "OrderedDict[tuple, str]" = OrderedDict()   # (user, kind, id) → name
+        self._purging: Set[int] = set()  # пользователи, чьи данные сейчас удаляются
+
+    async def ids(self, telegram_id: int, kind: str, names: Iterable[str]) -> Dict[str, int]:
+        """Id для всех ``names``; недостающие создаются одним INSERT"""
+        if telegram_id in self._purging:
+            await self._check_purge(telegram_id)
+        result = {}
+        missing = set()
+        for name in names:
+            cached = self._ids.get((telegram_id, kind, name))
+            if cached is None:
+                missing.add(name)
+            else:
+                self._ids.move_to_end((telegram_id, kind, name))
+                result[name] = cached
+        if not missing:
+            return result
+
+        # Отдельная короткая сессия: регистрация не должна зависеть от транзакции хендлера
+        async with self._pool() as session:
+            found = await self._select(session, telegram_id, kind, missing)
+            new = missing - found.keys()
+            if new:
+                try:
+                    await session.execute(insert(CallbackName), [
+                        {"telegram_id": telegram_id, "kind": kind, "name": name} for name in new
+                    ])
+                    await session.commit()
+                except IntegrityError:
+                    # Те же названия одновременно регистрирует другой процесс
+                    await session.rollback()
+                found.update(await self._select(session, telegram_id, kind, new))
+
+        for name, name_id in found.items():
+            self._remember(telegram_id, kind, name, name_id)
+            result[name] = name_id
+        return result
+
+    async def id(self, telegram_id: int, kind: str, name: str) -> int:
+        return (await self.ids(telegram_id, kind, [name]))[name]
+
+    async def name(self, telegram_id: int, kind: str, name_id: int) -> Optional[str]:
+        """Название по id или None, если id чужой или другого вида"""
+        if telegram_id in self._purging:
+            await self._check_purge(telegram_id)
+        key = (telegram_id, kind, name_id)
+        cached = self._names.get(key)
+        if cached is not None:
+            self._names.move_to_end(key)
+            return cached
+        async with self._pool() as session:
+            row = await session.get(CallbackName, name_id)
+        if row is None or row.telegram_id != telegram_id or row.kind != kind:
+            return None
+        self._remember(telegram_id, kind, row.name, name_id)
+        return row.name
+
+    def forget_user(self, telegram_id: int) -> None:
+        """Сбрасывает кэш пользователя и не ведёт его, пока идёт удаление его данных"""
+        self._purging.add(telegram_id)
+        for cache in (self._ids, self._names):
+            for key in [k for k in cache if k[0] == telegram_id]:
+                del cache[key]
+
+    async def _check_purge(self, telegram_id: int) -> None:
+        async with self._pool() as session:
+            if await session.get(PurgeJob, telegram_id) is None:
+                self._purging.discard(telegram_id)
+
+    @staticmethod
+    async def _select(session, telegram_id: int, kind: str, names) -> Dict[str, int]:
+        rows = await session.execute(
+            select(CallbackName.name, CallbackName.id).where(
+                CallbackName.telegram_id == telegram_id,
+                CallbackName.kind == kind,
+                CallbackName.name.in_(names),
+            )
+        )
+        return dict(rows.all())
+
+    def _remember(self, telegram_id: int, kind: str, name: str, name_id: int) -> None:
+        if telegram_id in self._purging:
+            return
+        self._ids[(telegram_id, kind, name)] = name_id
+        self._names[(telegram_id, kind, name_id)] = name
+        for cache in (self._ids, self._names):
+            while len(cache) > self._cache_size:
+                cache.popitem(last=False)
+
+
+name_registry = NameRegistry()
@@ -0,0 +1,141 @@
+"""
+Постраничный вывод списков: keyset по (дата, id) и кнопки «◀️/▶️».
+
+Страница выбирается условием ``(date, id) < (курсор)`` с ``LIMIT size+1``
+по индексу пользователя, а не OFFSET: цена любой страницы одинакова, и
+из БД приходит только она. Курсор — ключ первой или последней строки
+страницы — лежит прямо в callback_data кнопки, поэтому навигация не
+хранит состояния и правит то же сообщение.
+
+Размеры подобраны под ограничения Telegram: текст сообщения — до 4096
+символов (оставляем запас на заголовок и HTML), а длинная клавиатура
+неудобна задолго до лимита в 100 кнопок.
+"""
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import List, Optional, Sequence, Tuple
+
+from aiogram.types import InlineKeyboardButton
+from sqlalchemy import Select, desc, tuple_
+
+PAGE_TEXT_LIMIT = 3500   # символов на страницу текста
+TEXT_PAGE_SIZE = 10      # записей на страницу текста
+BUTTON_PAGE_SIZE = 20    # кнопок на страницу клавиатуры
+
+
+@dataclass
+class Page:
+    rows: list
+    backward: bool      # страница получена кнопкой «◀️»
+    has_prev: bool
+    has_next: bool
+    key_size: int
+
+    @property
+    def first_key(self) -> tuple:
+        return tuple(self.rows[0][-self.key_size:])
+
+    @property
+    def last_key(self) -> tuple:
+        return tuple(self.rows[-1][-self.key_size:])
+
+    def fit(self, header: str, lines: List[str], limit: int = PAGE_TEXT_LIMIT) -> str:
+        """
+        Склеивает строки страницы (по одной на запись) в пределах ``limit``.
+
+        Не поместившиеся записи убираются со страницы и будут показаны
+        на соседней: при движении вперёд отрезается хвост, назад — начало.
+        """
+        budget = limit - len(header)
+        order = range(len(lines) - 1, -1, -1) if self.backward else range(len(lines))
+        kept = 0
+        for i in order:
+            if len(lines[i]) + 1 > budget and kept:
+                break
+            budget -= len(lines[i]) + 1
+            kept += 1
+
+        if kept < len(lines):
+            if self.backward:
+                self.rows, lines = self.rows[-kept:], lines[-kept:]
+                self.has_prev = True
+            else:
+                self.rows, lines = self.rows[:kept], lines[:kept]
+                self.has_next = True
+        if kept == 1 and len(lines[0]) > limit - len(header):
+            lines = [lines[0][:limit - len(header) - 1] + "…"]
+        return header + "\n".join(lines)
+
+
+def _encode(value) -> str:
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def _decode(column, text: str):
+    kind = column.type.python_type
+    if kind is datetime:
+        return datetime.fromisoformat(text)
+    if kind is date:
+        return date.fromisoformat(text)
+    return kind(text)
+
+
+class KeysetPager:
+    """
+    Пагинация одного списка.
+
+    ``prefix`` — начало callback_data кнопок навигации (до ~10 символов,
+    курсор должен уложиться в 64 байта); ``keys`` — колонки порядка,
+    последняя уникальна (обычно id). Колонки ключа не должны быть NULL.
+    """
+
+    def __init__(self, prefix: str, *keys, size: int = TEXT_PAGE_SIZE, descending: bool = True):
+        self.prefix = prefix
+        self.keys = keys
+        self.size = size
+        self.descending = descending
+
+    async def fetch(self, session, stmt: Select, cursor: Optional[Sequence] = None,
+                    backward: bool = False) -> Page:
+        """
+        Страница после курсора (или перед ним при ``backward``).
+
+        К ``stmt`` добавляются колонки ключа: они — последние элементы
+        каждой строки.
+        """
+        key = tuple_(*self.keys)
+        # При движении назад идём по индексу в обратную сторону и переворачиваем
+        go_desc = self.descending != backward
+        if cursor is not None:
+            stmt = stmt.where(key < tuple_(*cursor) if go_desc else key > tuple_(*cursor))
+        order = [desc(k) if go_desc else k for k in self.keys]
+        rows = (await session.execute(
+            stmt.add_columns(*self.keys).order_by(*order).limit(self.size + 1)
+        )).all()
+
+        more = len(rows) > self.size
+        rows = rows[:self.size]
+        if backward:
+            rows.reverse()
+            return Page(rows, True, has_prev=more, has_next=True, key_size=len(self.keys))
+        return Page(rows, False, has_prev=cursor is not None, has_next=more, key_size=len(self.keys))
+
+    def nav_buttons(self, page: Page) -> List[InlineKeyboardButton]:
+        """Ряд «◀️/▶️» (пустой, если страница одна)"""
+        buttons = []
+        if page.rows and page.has_prev:
+            buttons.append(InlineKeyboardButton(text="◀️", callback_data=self._data("p", page.first_key)))
+        if page.rows and page.has_next:
+            buttons.append(InlineKeyboardButton(text="▶️", callback_data=self._data("n", page.last_key)))
+        return buttons
+
+    def parse(self, data: str) -> Tuple[tuple, bool]:
+        """(курсор, назад ли) из callback_data кнопки навигации"""
+        direction, *values = data[len(self.prefix) + 1:].split("|")
+        cursor = tuple(_decode(col, v) for col, v in zip(self.keys, values))
+        return cursor, direction == "p"
+
+    def _data(self, direction: str, key: tuple) -> str:
+        return "|".join([self.prefix, direction, *map(_encode, key)])
@@ -0,0 +1,29 @@
+"""
+Извлечение текста из PDF (pypdf) — выполняется в воркерах ``renderer``.
+
+Файл открывается как поток, а не путь: тогда pypdf не читает его в
+память целиком, а подгружает только объекты запрошенных страниц. Каждая
+пачка страниц открывает файл заново и сразу закрывает — воркер не держит
+ни память, ни дескриптор между вызовами.
+"""
+from typing import List
+
+
+def page_count(path: str) -> int:
+    from pypdf import PdfReader
+
+    with open(path, "rb") as fh:
+        return len(PdfReader(fh).pages)
+
+
+def extract_lines(path: str, start: int, stop: int) -> List[str]:
+    """Непустые строки текста страниц [start, stop)"""
+    from pypdf import PdfReader
+
+    lines = []
+    with open(path, "rb") as fh:
+        reader = PdfReader(fh)
+        for number in range(start, min(stop, len(reader.pages))):
+            text = reader.pages[number].extract_text() or ""
+            lines.extend(line.strip() for line in text.splitlines() if line.strip())
+    return lines
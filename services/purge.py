@@ -0,0 +1,163 @@
+"""
+Фоновое удаление всех данных пользователя («❌ Удалить все данные»).
+
+Хендлер только записывает заявку в purge_jobs и сразу отвечает.
+Основной процесс (``is_primary_process``) разбирает заявки: из каждой
+таблицы строки пользователя удаляются пачками по PURGE_BATCH, каждая
+пачка — своей короткой транзакцией, поэтому тяжёлый пользователь не
+держит блокировки на большом диапазоне analysis. Файлы обследований
+освобождаются в хранилище (services/file_store.py) вслед за своей
+пачкой строк. Когда всё удалено, заявка снимается, а пользователю
+приходит сообщение. Первым удаляется состояние диалога (fsm_storage) —
+вместе с недописанными данными. Кэш названий сбрасывает процесс,
+обслуживающий пользователя (handlers/delete_data.py).
+
+Удаление пачками идемпотентно, так что после перезапуска незавершённая
+заявка просто выполняется заново с того места, где остались строки.
+"""
+import asyncio
+import logging
+from os import getenv
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+from aiogram.fsm.storage.base import DefaultKeyBuilder, StorageKey
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import (
+    async_session, PurgeJob, FSMRecord, UserData, Analysis, AnalysisLatest, DoctorAppointment, AppointmentReminder,
+    InstrumentalExamination, Recommendation, CallbackName
+)
+from middlewares.send_limiter import bulk_sends
+from services.file_store import file_store
+from services.report_cache import bump_version
+from services.sharding import is_primary_process
+
+PURGE_BATCH = int(getenv("PURGE_BATCH", "1000"))  # строк в одной транзакции
+PURGE_POLL = float(getenv("PURGE_POLL", "5"))     # как часто искать заявки из других процессов
+
+logger = logging.getLogger(__name__)
+
+# Таблицы и ключ, по которому удаляем пачку (у всех строк есть telegram_id);
+# напоминания — раньше назначений, чтобы не ушли о визите, которого уже нет
+_TABLES = (
+    (AppointmentReminder, AppointmentReminder.id),
+    (DoctorAppointment, DoctorAppointment.id),
+    (Recommendation, Recommendation.id),
+    (AnalysisLatest, AnalysisLatest.name),
+    (Analysis, Analysis.id),
+    (UserData, UserData.id),
+    (CallbackName, CallbackName.id),
+)
+
+
+async def request_purge(session: AsyncSession, telegram_id: int, chat_id: int) -> bool:
+    """Ставит заявку в транзакцию ``session``; False — заявка уже есть"""
+    if await session.get(PurgeJob, telegram_id) is not None:
+        return False
+    session.add(PurgeJob(telegram_id=telegram_id, chat_id=chat_id))
+    return True
+
+
+class DataPurger:
+    def __init__(self, session_pool=async_session, batch: int = PURGE_BATCH):
+        self._pool = session_pool
+        self.batch = batch
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.purged_rows = 0
+
+    async def start(self, bot: Bot):
+        if not is_primary_process():
+            return
+        self._task = asyncio.create_task(self._loop(bot))
+
+    def wake(self):
+        """Новая заявка в этом процессе — не ждать следующего опроса"""
+        self._wakeup.set()
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self, bot: Bot):
+        with bulk_sends():
+            while True:
+                self._wakeup.clear()
+                try:
+                    async with self._pool() as session:
+                        jobs = (await session.execute(
+                            select(PurgeJob.telegram_id, PurgeJob.chat_id).order_by(PurgeJob.created_at).limit(10)
+                        )).all()
+                    for telegram_id, chat_id in jobs:
+                        await self.purge(telegram_id, chat_id, bot.id)
+                        await self._notify(bot, chat_id)
+                except Exception:
+                    logger.exception("Ошибка удаления данных пользователя")
+                    jobs = []
+                if not jobs:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), PURGE_POLL)
+                    except asyncio.TimeoutError:
+                        pass
+
+    async def purge(self, telegram_id: int, chat_id: int, bot_id: int):
+        """Удаляет все данные пользователя пачками и снимает заявку"""
+        # Ключ диалога — как у SQLStorage (DefaultKeyBuilder)
+        fsm_key = DefaultKeyBuilder().build(StorageKey(bot_id=bot_id, chat_id=chat_id, user_id=telegram_id))
+        async with self._pool() as session:
+            await session.execute(delete(FSMRecord).where(FSMRecord.key == fsm_key))
+            await session.commit()
+        await self._purge_examinations(telegram_id)
+        for model, key in _TABLES:
+            while await self._delete_batch(model, key, telegram_id):
+                pass
+        async with self._pool() as session:
+            await bump_version(session, telegram_id)
+            await session.execute(delete(PurgeJob).where(PurgeJob.telegram_id == telegram_id))
+            await session.commit()
+        logger.info("Данные пользователя %s удалены", telegram_id)
+
+    async def _delete_batch(self, model, key, telegram_id: int) -> int:
+        async with self._pool() as session:
+            keys = (await session.execute(
+                select(key).where(model.telegram_id == telegram_id).limit(self.batch)
+            )).scalars().all()
+            if keys:
+                await session.execute(delete(model).where(model.telegram_id == telegram_id, key.in_(keys)))
+                await session.commit()
+        self.purged_rows += len(keys)
+        return len(keys)
+
+    async def _purge_examinations(self, telegram_id: int):
+        while True:
+            async with self._pool() as session:
+                rows = (await session.execute(
+                    select(
+                        InstrumentalExamination.id, InstrumentalExamination.file_path, InstrumentalExamination.file_hash
+                    ).where(InstrumentalExamination.telegram_id == telegram_id).limit(self.batch)
+                )).all()
+                if not rows:
+                    return
+                await session.execute(
+                    delete(InstrumentalExamination).where(InstrumentalExamination.id.in_([r.id for r in rows]))
+                )
+                await session.commit()
+            self.purged_rows += len(rows)
+            # Строк уже нет: сбой здесь оставит лишний файл, но не ссылку на удалённый
+            for _, file_path, file_hash in rows:
+                await file_store.release(file_path, file_hash)
+
+    @staticmethod
+    async def _notify(bot: Bot, chat_id: int):
+        try:
+            await bot.send_message(chat_id, "🔍 Все ваши данные были успешно удалены.")
+        except TelegramAPIError as e:
+            logger.info("Не удалось сообщить об удалении данных в чат %s: %s", chat_id, e)
+
+
+data_purger = DataPurger()
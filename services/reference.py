@@ -0,0 +1,138 @@
+"""
+Разбор референсных значений и результатов анализов.
+
+Строки вида «3.5-5.5», «3,5 – 5,5», «< 5», «до 200», «> 1.2» один раз при
+записи превращаются в числа ``ref_min``/``ref_max``, а результат — в
+``result_value``. Просмотр анализов берёт готовые числа из БД.
+
+    python -m services.reference   # заполнить колонки у старых записей
+"""
+import asyncio
+import re
+from typing import Optional, Tuple
+
+from sqlalchemy import select, update, bindparam, and_
+
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)?")
+_UPPER = re.compile(r"^\s*(<|≤|<=|до|менее|меньше)", re.IGNORECASE)
+_LOWER = re.compile(r"^\s*(>|≥|>=|от|более|больше)", re.IGNORECASE)
+
+
+def parse_number(text) -> Optional[float]:
+    """Число из результата: учитывает «4,5» и «4.5»"""
+    if text is None:
+        return None
+    if isinstance(text, (int, float)):
+        return float(text)
+    try:
+        return float(str(text).strip().replace(",", "."))
+    except ValueError:
+        return None
+
+
+def parse_range(reference: Optional[str]) -> Tuple[Optional[float], Optional[float]]:
+    """Границы нормы (min, max); для односторонних норм вторая граница None"""
+    if not reference:
+        return None, None
+    nums = [float(n.replace(",", ".")) for n in _NUMBER.findall(reference)]
+    if len(nums) >= 2:
+        return nums[0], nums[1]
+    if len(nums) == 1:
+        if _UPPER.match(reference):
+            return None, nums[0]
+        if _LOWER.match(reference):
+            return nums[0], None
+    return None, None
+
+
+def reference_columns(result, reference: Optional[str]) -> dict:
+    """Значения числовых колонок Analysis для записи"""
+    ref_min, ref_max = parse_range(reference)
+    return {"result_value": parse_number(result), "ref_min": ref_min, "ref_max": ref_max}
+
+
+def in_range(value: Optional[float], ref_min: Optional[float], ref_max: Optional[float]) -> Optional[bool]:
+    """True/False — в норме или нет; None — сравнить не с чем"""
+    if value is None or (ref_min is None and ref_max is None):
+        return None
+    return (ref_min is None or value >= ref_min) and (ref_max is None or value <= ref_max)
+
+
+def status_emoji(value, ref_min, ref_max) -> str:
+    status = in_range(value, ref_min, ref_max)
+    if status is None:
+        return ""
+    return "🟢" if status else "🔴"
+
+
+def status_color(value, ref_min, ref_max) -> Optional[str]:
+    status = in_range(value, ref_min, ref_max)
+    if status is None:
+        return None
+    return "green" if status else "red"
+
+
+# ---------------- заполнение старых записей ----------------
+
+async def backfill(session_pool, batch: int = 5000) -> int:
+    """
+    Заполняет result_value/ref_min/ref_max у записей, где все три пусты.
+
+    Идёт по id пачками (keyset), каждая пачка — отдельная транзакция,
+    так что прерванный запуск можно просто повторить.
+    """
+    from db import Analysis
+
+    table = Analysis.__table__
+    stmt = (
+        update(table)
+        .where(table.c.id == bindparam("row_id"))
+        .values(result_value=bindparam("rv"), ref_min=bindparam("lo"), ref_max=bindparam("hi"))
+    )
+    last_id = 0
+    updated = 0
+    while True:
+        async with session_pool() as session:
+            rows = (await session.execute(
+                select(table.c.id, table.c.result, table.c.reference)
+                .where(and_(
+                    table.c.id > last_id,
+                    table.c.result_value.is_(None),
+                    table.c.ref_min.is_(None),
+                    table.c.ref_max.is_(None),
+                ))
+                .order_by(table.c.id)
+                .limit(batch)
+            )).all()
+            if not rows:
+                break
+            params = []
+            for row_id, result, reference in rows:
+                values = reference_columns(result, reference)
+                if any(v is not None for v in values.values()):
+                    params.append({
+                        "row_id": row_id,
+                        "rv": values["result_value"],
+                        "lo": values["ref_min"],
+                        "hi": values["ref_max"],
+                    })
+            if params:
+                await session.execute(stmt, params)
+                await session.commit()
+            updated += len(params)
+            last_id = rows[-1][0]
+        print(f"\rобработано до id={last_id}, заполнено {updated}", end="", flush=True)
+    print()
+    return updated
+
+
+async def _main():
+    from db import async_session, engine, init_db
+
+    await init_db()  # добавит недостающие колонки
+    await backfill(async_session)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
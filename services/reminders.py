@@ -0,0 +1,290 @@
+"""
+Напоминания о приёмах у врачей.
+
+Для каждого визита (пользователь, врач, дата приёма) в таблице
+appointment_reminders лежат строки с временем отправки — таблица и есть
+очередь, поэтому перезапуск бота ничего не теряет. Планировщик работает
+в одном процессе (``is_primary_process``) и держит в памяти только
+ближайшее окно: индексным запросом по (remind_at, id) берёт не больше
+REMINDER_BATCH строк со временем до now + REMINDER_WINDOW, складывает их
+в кучу и отправляет по мере наступления срока. Сколько бы напоминаний ни
+было запланировано, в памяти — одна пачка.
+
+Отправка идёт фоновой очередью ``send_limiter`` (``bulk_sends``):
+рассылка в 9:00 не задерживает ответы пользователям и не упирается в 429.
+Отправленные строки удаляются пачкой перед следующей загрузкой окна,
+поэтому доставка «хотя бы один раз»: если процесс упадёт между отправкой
+и этим удалением, после перезапуска напоминание уйдёт повторно.
+Удаление назначения убирает напоминания визита (``unschedule_visit``),
+когда у визита не осталось других назначений.
+"""
+import asyncio
+import heapq
+import html
+import logging
+from datetime import date, datetime, time, timedelta
+from os import getenv
+from typing import List, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from sqlalchemy import select, delete, update, insert, exists, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import async_session, AppointmentReminder, DoctorAppointment
+from middlewares.send_limiter import bulk_sends
+from services.sharding import is_primary_process
+
+# За сколько дней до приёма напоминать (через запятую) и в котором часу
+REMINDER_DAYS = [int(d) for d in getenv("REMINDER_DAYS", "1").split(",") if d.strip()]
+REMINDER_HOUR = int(getenv("REMINDER_HOUR", "9"))
+REMINDER_WINDOW = float(getenv("REMINDER_WINDOW", "300"))  # секунд вперёд в памяти
+REMINDER_POLL = float(getenv("REMINDER_POLL", "60"))       # как часто перечитывать окно
+REMINDER_BATCH = int(getenv("REMINDER_BATCH", "1000"))     # напоминаний в памяти максимум
+REMINDER_SENDERS = int(getenv("REMINDER_SENDERS", "20"))   # одновременных отправок
+REMINDER_RETRY = timedelta(minutes=5)
+REMINDER_STALE = timedelta(hours=12)  # опоздавшие дольше (бот был выключен) не отправляем
+
+logger = logging.getLogger(__name__)
+
+
+def reminder_times(day: date) -> List[datetime]:
+    """Моменты напоминаний о приёме ``day``"""
+    return sorted(datetime.combine(day - timedelta(days=d), time(REMINDER_HOUR)) for d in set(REMINDER_DAYS))
+
+
+async def schedule_visit(session: AsyncSession, telegram_id: int, doctor: str, day: date):
+    """Добавляет будущие напоминания о визите в транзакцию ``session`` (коммитит вызывающий)"""
+    now = datetime.now()
+    times = [t for t in reminder_times(day) if t > now]
+    if not times:
+        return
+    planned = set((await session.execute(
+        select(AppointmentReminder.remind_at).where(
+            AppointmentReminder.telegram_id == telegram_id,
+            AppointmentReminder.doctor == doctor,
+            AppointmentReminder.appointment_date == day,
+        )
+    )).scalars())
+    for remind_at in times:
+        if remind_at not in planned:
+            session.add(AppointmentReminder(
+                telegram_id=telegram_id, doctor=doctor, appointment_date=day, remind_at=remind_at
+            ))
+
+
+async def unschedule_visit(session: AsyncSession, telegram_id: int, doctor: str, day: date):
+    """Удаляет напоминания визита, если у него не осталось назначений (в транзакции ``session``)"""
+    visit = (
+        DoctorAppointment.telegram_id == telegram_id,
+        DoctorAppointment.doctor == doctor,
+        DoctorAppointment.appointment_date == day,
+    )
+    if await session.scalar(select(exists().where(*visit))):
+        return
+    await session.execute(
+        delete(AppointmentReminder).where(
+            AppointmentReminder.telegram_id == telegram_id,
+            AppointmentReminder.doctor == doctor,
+            AppointmentReminder.appointment_date == day,
+        )
+    )
+
+
+def _when(day: date, today: date) -> str:
+    days = (day - today).days
+    if days == 0:
+        return "сегодня"
+    if days == 1:
+        return "завтра"
+    return f"через {days} дн."
+
+
+class ReminderScheduler:
+    def __init__(self, session_pool=async_session, window: float = REMINDER_WINDOW,
+                 batch: int = REMINDER_BATCH, senders: int = REMINDER_SENDERS):
+        self._pool = session_pool
+        self.window = timedelta(seconds=window)
+        self.batch = batch
+        self.senders = senders
+        self._heap: list = []  # (remind_at, id, telegram_id, doctor, appointment_date)
+        self._full = False     # окно упёрлось в batch — дочитать сразу после отправки
+        self._sent: List[int] = []
+        self._retry: List[int] = []
+        self._sending: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.skipped = 0
+
+    async def start(self, bot: Bot):
+        if not is_primary_process():
+            return
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, bot: Bot):
+        try:
+            await self._backfill()
+        except Exception:
+            logger.exception("Не удалось запланировать напоминания для старых назначений")
+        slots = asyncio.Semaphore(self.senders)
+        with bulk_sends():
+            while True:
+                try:
+                    await self._refill()
+                    await self._drain(bot, slots)
+                except asyncio.CancelledError:
+                    await self._finish()
+                    raise
+                except Exception:
+                    logger.exception("Ошибка планировщика напоминаний")
+                    await asyncio.sleep(REMINDER_POLL)
+
+    async def _drain(self, bot: Bot, slots: asyncio.Semaphore):
+        """Отправляет загруженное окно по мере наступления сроков; выходит, когда пора перечитать БД"""
+        loop = asyncio.get_running_loop()
+        reload_at = loop.time() + REMINDER_POLL
+        while self._heap:
+            delay = (self._heap[0][0] - datetime.now()).total_seconds()
+            if delay > 0:
+                if loop.time() + delay >= reload_at:
+                    break
+                await asyncio.sleep(delay)
+                continue
+            item = heapq.heappop(self._heap)
+            await slots.acquire()
+            task = asyncio.create_task(self._send(bot, item))
+            self._sending.add(task)
+            task.add_done_callback(lambda t: (self._sending.discard(t), slots.release()))
+        else:
+            # Окно пусто: до следующего опроса ждём, только если пачка не была полной
+            if not self._full:
+                await asyncio.sleep(max(0.0, reload_at - loop.time()))
+
+    async def _refill(self):
+        """Досылает начатое, удаляет отправленное и читает следующее окно"""
+        await self._finish()
+        horizon = datetime.now() + self.window
+        async with self._pool() as session:
+            rows = (await session.execute(
+                select(
+                    AppointmentReminder.remind_at, AppointmentReminder.id,
+                    AppointmentReminder.telegram_id, AppointmentReminder.doctor,
+                    AppointmentReminder.appointment_date,
+                )
+                .where(AppointmentReminder.remind_at <= horizon)
+                .order_by(AppointmentReminder.remind_at, AppointmentReminder.id)
+                .limit(self.batch)
+            )).all()
+        self._heap = [tuple(r) for r in rows]  # уже упорядочено — это готовая куча
+        self._full = len(rows) == self.batch
+
+    async def _finish(self):
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        sent, retry = self._sent, self._retry
+        if not sent and not retry:
+            return
+        async with self._pool() as session:
+            for start in range(0, len(sent), 500):
+                await session.execute(
+                    delete(AppointmentReminder).where(AppointmentReminder.id.in_(sent[start:start + 500]))
+                )
+            if retry:
+                await session.execute(
+                    update(AppointmentReminder)
+                    .where(AppointmentReminder.id.in_(retry))
+                    .values(remind_at=datetime.now() + REMINDER_RETRY)
+                )
+            await session.commit()
+        # Списки очищаем только после коммита: иначе при сбое БД напоминания ушли бы повторно
+        self._sent, self._retry = [], []
+
+    async def _send(self, bot: Bot, item: tuple):
+        remind_at, reminder_id, telegram_id, doctor, day = item
+        today = date.today()
+        if day < today or datetime.now() - remind_at > REMINDER_STALE:
+            self.skipped += 1
+            self._sent.append(reminder_id)
+            return
+        try:
+            async with self._pool() as session:
+                notes = (await session.execute(
+                    select(DoctorAppointment.recommendation).where(
+                        DoctorAppointment.telegram_id == telegram_id,
+                        DoctorAppointment.doctor == doctor,
+                        DoctorAppointment.appointment_date == day,
+                    ).order_by(DoctorAppointment.id).limit(10)
+                )).scalars().all()
+            if not notes:
+                # Назначения визита удалены — напоминать не о чем
+                self.skipped += 1
+                self._sent.append(reminder_id)
+                return
+            text = (
+                f"⏰ Напоминание: {_when(day, today)} ({day.strftime('%d.%m.%Y')}) "
+                f"приём у врача <b>{html.escape(doctor)}</b>.\n\n"
+                + "\n".join(f"📝 {html.escape(n[:300])}" for n in notes)
+            )
+            await bot.send_message(telegram_id, text[:4096])
+            self.sent += 1
+            self._sent.append(reminder_id)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Бот заблокирован или чат недоступен — повтор не поможет
+            logger.info("Напоминание %s не доставлено: %s", reminder_id, e)
+            self.skipped += 1
+            self._sent.append(reminder_id)
+        except Exception:
+            logger.exception("Ошибка отправки напоминания %s, повтор позже", reminder_id)
+            self._retry.append(reminder_id)
+
+    async def _backfill(self):
+        """Планирует напоминания для будущих визитов, записанных без них (до появления напоминаний)"""
+        now = datetime.now()
+        first_day = now.date() + timedelta(days=min(REMINDER_DAYS, default=0))
+        planned = exists().where(and_(
+            AppointmentReminder.telegram_id == DoctorAppointment.telegram_id,
+            AppointmentReminder.doctor == DoctorAppointment.doctor,
+            AppointmentReminder.appointment_date == DoctorAppointment.appointment_date,
+        ))
+        last_id = 0
+        while True:
+            # Пачками по id: уже запланированные визиты отсекает NOT EXISTS
+            async with self._pool() as session:
+                chunk = (await session.execute(
+                    select(
+                        DoctorAppointment.id, DoctorAppointment.telegram_id,
+                        DoctorAppointment.doctor, DoctorAppointment.appointment_date,
+                    )
+                    .where(DoctorAppointment.id > last_id, DoctorAppointment.appointment_date >= first_day, ~planned)
+                    .order_by(DoctorAppointment.id)
+                    .limit(self.batch)
+                )).all()
+                if not chunk:
+                    return
+                last_id = chunk[-1][0]
+                visits = {(uid, doctor, day) for _, uid, doctor, day in chunk}
+                rows = [
+                    {"telegram_id": uid, "doctor": doctor, "appointment_date": day, "remind_at": at}
+                    for uid, doctor, day in visits
+                    for at in reminder_times(day) if at > now
+                ]
+                if rows:
+                    await session.execute(insert(AppointmentReminder), rows)
+                    await session.commit()
+
+    def snapshot(self) -> dict:
+        return {
+            "loaded": len(self._heap),
+            "sending": len(self._sending),
+            "sent": self.sent,
+            "skipped": self.skipped,
+        }
+
+
+reminder_scheduler = ReminderScheduler()
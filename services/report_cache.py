@@ -0,0 +1,99 @@
+"""
+Кэш готовых отчётов по анализам (текст «Все анализы», динамика, PDF).
+
+Отчёт кэшируется под версией данных пользователя из user_data_versions.
+Любое добавление или удаление анализов увеличивает версию в той же
+транзакции (``bump_version``), поэтому устаревшая запись просто не
+совпадёт по версии. Версия хранится в БД и одинакова для всех процессов
+бота, а сам кэш — LRU в памяти процесса, ограниченный по объёму.
+"""
+from collections import OrderedDict
+from os import getenv
+from typing import Any, Hashable, Optional, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import UserDataVersion, upsert
+
+REPORT_CACHE_MB = float(getenv("REPORT_CACHE_MB", "64"))
+
+
+async def get_version(session: AsyncSession, telegram_id: int) -> int:
+    version = await session.scalar(
+        select(UserDataVersion.version).where(UserDataVersion.telegram_id == telegram_id)
+    )
+    return version or 0
+
+
+async def bump_version(session: AsyncSession, telegram_id: int) -> None:
+    """
+    Увеличивает версию данных пользователя в текущей транзакции.
+
+    Вызывать рядом с insert/delete анализов до commit. Первая запись
+    пользователя создаёт строку через upsert: фоновые задачи (импорт PDF,
+    удаление данных) пишут вне очереди апдейтов пользователя, и строку
+    может одновременно создать хендлер.
+    """
+    res = await session.execute(
+        update(UserDataVersion)
+        .where(UserDataVersion.telegram_id == telegram_id)
+        .values(version=UserDataVersion.version + 1)
+    )
+    if not res.rowcount:
+        await session.execute(upsert(
+            session.get_bind().dialect.name, UserDataVersion,
+            {"telegram_id": telegram_id, "version": 1},
+            [UserDataVersion.telegram_id],
+            {"version": UserDataVersion.version + 1},
+        ))
+
+
+def _size(value: Any) -> int:
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value) * 2  # грубо: кириллица в UTF-8 — два байта
+    if isinstance(value, tuple):
+        return sum(map(_size, value))
+    return 256
+
+
+class ReportCache:
+    """LRU по суммарному размеру значений; запись действительна только для своей версии"""
+
+    def __init__(self, max_bytes: int = int(REPORT_CACHE_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Hashable, Tuple[int, Any, int]]" = OrderedDict()
+
+    def get(self, key: Hashable, version: int) -> Optional[Any]:
+        item = self._items.get(key)
+        if item is None or item[0] != version:
+            if item is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key: Hashable, version: int, value: Any) -> None:
+        size = _size(value)
+        if size > self.max_bytes:
+            return
+        if key in self._items:
+            self._drop(key)
+        self._items[key] = (version, value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self._items)))
+
+    def _drop(self, key: Hashable) -> None:
+        _, _, size = self._items.pop(key)
+        self.size -= size
+
+
+report_cache = ReportCache()
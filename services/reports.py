@@ -0,0 +1,223 @@
+"""
+Отрисовка отчётов и графиков (reportlab) в отдельных процессах.
+
+Сборка PDF и PNG занимает процессор на сотни миллисекунд и дольше, поэтому
+она идёт в ProcessPoolExecutor: цикл событий бота в это время
+обслуживает остальных пользователей. Шрифт регистрируется один раз при
+старте каждого воркера. Одновременно рендерится не больше REPORT_WORKERS
+отчётов, остальные ждут в очереди длиной до REPORT_MAX_QUEUE.
+"""
+import asyncio
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from os import getenv
+from typing import List, Optional
+
+# Шрифт с кириллицей для PDF; на Linux укажите путь в PDF_FONT_PATH
+PDF_FONT_PATH = getenv("PDF_FONT_PATH", r'C:\Windows\Fonts\arial.ttf')
+PDF_FONT_NAME = "ArialUnicode"
+
+REPORT_WORKERS = int(getenv("REPORT_WORKERS", str(min(2, os.cpu_count() or 1))))
+REPORT_MAX_QUEUE = int(getenv("REPORT_MAX_QUEUE", "50"))
+
+
+class ReportQueueFull(Exception):
+    """Очередь на отрисовку переполнена — просим пользователя повторить позже"""
+
+
+# ---------------- код воркера ----------------
+
+def _init_worker(font_path: str):
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    pdfmetrics.registerFont(TTFont(PDF_FONT_NAME, font_path))
+
+
+def _cell(item: Optional[dict], body):
+    from reportlab.platypus import Paragraph
+
+    if item is None:
+        return Paragraph('—', body)
+    if item["color"]:
+        # цветим только число, дату оставляем чёрной
+        return Paragraph(
+            f'<font name="{PDF_FONT_NAME}">'
+            f'<font color="{item["color"]}">{item["result"]}</font> '
+            f'({item["date"]})'
+            f'</font>',
+            body
+        )
+    return Paragraph(f'{item["result"]} ({item["date"]})', body)
+
+
+def render_analyses_pdf(rows: List[dict]) -> bytes:
+    """
+    Таблица «последний / предыдущий результат» по каждому анализу.
+
+    ``rows`` — простые словари (name, last, prev, reference, units), где
+    last/prev — {result, date, color} или None: их дёшево передать в воркер.
+    """
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
+
+    data = [[
+        'Анализ', 'Последний результат (дата)',
+        'Предыдущий результат (дата)', 'Референс', 'Ед. изм.'
+    ]]
+    styles = [
+        ('FONTNAME',   (0,0), (-1,-1), PDF_FONT_NAME),
+        ('GRID',       (0,0), (-1,-1), 0.5, colors.black),
+        ('BACKGROUND', (0,0), (-1,0), colors.lightgrey),
+    ]
+
+    stylesheet = getSampleStyleSheet()
+    body = stylesheet['BodyText']
+    body.fontName = PDF_FONT_NAME
+    body.fontSize = 10
+
+    for row in rows:
+        data.append([
+            Paragraph(row["name"], body),
+            _cell(row["last"], body),
+            _cell(row["prev"], body),
+            Paragraph(row["reference"] or '—', body),
+            Paragraph(row["units"] or '—', body),
+        ])
+
+    buf = BytesIO()
+    doc = SimpleDocTemplate(buf, pagesize=A4)
+    tbl = Table(
+        data,
+        colWidths=[80, 150, 150, 70, 60],
+        repeatRows=1
+    )
+    tbl.setStyle(TableStyle(styles))
+    doc.build([tbl])
+    return buf.getvalue()
+
+
+def render_trend_png(series: dict) -> Optional[bytes]:
+    """
+    График динамики анализа на фоне полосы нормы.
+
+    ``series`` — {name, units, days: [ordinal], values: [float], ref_min,
+    ref_max}. Возвращает None, если нет растрового бэкенда reportlab
+    (rlPyCairo): тогда бот покажет динамику текстом.
+    """
+    from datetime import date
+    from reportlab.lib import colors
+    from reportlab.graphics.shapes import Drawing, Rect, String, Circle
+    from reportlab.graphics.charts.lineplots import LinePlot
+    from reportlab.graphics import renderPM
+    from reportlab.graphics.utils import RenderPMError
+
+    days, values = series["days"], series["values"]
+    ref_min, ref_max = series["ref_min"], series["ref_max"]
+
+    # Границы осей: все точки и обе границы нормы плюс поля
+    bounds = values + [v for v in (ref_min, ref_max) if v is not None]
+    y_lo, y_hi = min(bounds), max(bounds)
+    pad = (y_hi - y_lo) * 0.1 or abs(y_hi) * 0.1 or 1
+    y_lo, y_hi = y_lo - pad, y_hi + pad
+    x_lo, x_hi = days[0], days[-1]
+    if x_lo == x_hi:
+        x_lo, x_hi = x_lo - 1, x_hi + 1
+
+    drawing = Drawing(640, 360)
+    plot = LinePlot()
+    plot.x, plot.y, plot.width, plot.height = 60, 50, 550, 260
+
+    def px(x):
+        return plot.x + (x - x_lo) / (x_hi - x_lo) * plot.width
+
+    def py(y):
+        return plot.y + (y - y_lo) / (y_hi - y_lo) * plot.height
+
+    # Полоса нормы под графиком; для односторонней нормы — до края оси
+    if ref_min is not None or ref_max is not None:
+        band_lo = py(max(ref_min if ref_min is not None else y_lo, y_lo))
+        band_hi = py(min(ref_max if ref_max is not None else y_hi, y_hi))
+        drawing.add(Rect(plot.x, band_lo, plot.width, band_hi - band_lo,
+                         fillColor=colors.Color(0.8, 0.95, 0.8), strokeColor=None))
+
+    plot.data = [list(zip(days, values))]
+    plot.lines[0].strokeColor = colors.HexColor("#1f5fa8")
+    plot.lines[0].strokeWidth = 2
+    for axis in (plot.xValueAxis, plot.yValueAxis):
+        axis.labels.fontName = PDF_FONT_NAME
+        axis.labels.fontSize = 8
+    plot.xValueAxis.valueMin, plot.xValueAxis.valueMax = x_lo, x_hi
+    plot.xValueAxis.maximumTicks = 6
+    plot.xValueAxis.labelTextFormat = lambda x: date.fromordinal(int(x)).strftime("%d.%m.%y")
+    plot.yValueAxis.valueMin, plot.yValueAxis.valueMax = y_lo, y_hi
+    plot.yValueAxis.labelTextFormat = "%g"
+    drawing.add(plot)
+
+    # Точки: зелёные в норме, красные вне её
+    for x, y in zip(days, values):
+        inside = (ref_min is None or y >= ref_min) and (ref_max is None or y <= ref_max)
+        color = colors.green if inside or (ref_min is None and ref_max is None) else colors.red
+        drawing.add(Circle(px(x), py(y), 3.5, fillColor=color, strokeColor=colors.white))
+
+    title = series["name"] + (f", {series['units']}" if series["units"] else "")
+    drawing.add(String(plot.x, 330, title, fontName=PDF_FONT_NAME, fontSize=14))
+
+    try:
+        return renderPM.drawToString(drawing, fmt="PNG", dpi=144)
+    except RenderPMError:
+        return None
+
+
+# ---------------- сторона бота ----------------
+
+class ReportRenderer:
+    def __init__(self, workers: int = REPORT_WORKERS, max_queue: int = REPORT_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots = asyncio.Semaphore(workers)
+        self.waiting = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=mp.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(PDF_FONT_PATH,),
+            )
+        return self._executor
+
+    async def start(self):
+        """Поднимает воркеры заранее, чтобы первый отчёт не ждал запуска процессов"""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        await asyncio.gather(*(loop.run_in_executor(executor, os.getpid) for _ in range(self.workers)))
+
+    async def run(self, func, *args):
+        """Выполняет ``func(*args)`` в пуле; ждёт в очереди, если все воркеры заняты"""
+        if self.waiting >= self.max_queue:
+            raise ReportQueueFull()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self._slots.release()
+
+    async def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+renderer = ReportRenderer()
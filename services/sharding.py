@@ -0,0 +1,198 @@
+import asyncio
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue
+import time
+from os import getenv
+from typing import Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+BOT_WORKERS = int(getenv("BOT_WORKERS", "1"))
+SHARD_HEALTH_INTERVAL = float(getenv("SHARD_HEALTH_INTERVAL", "10"))
+SHARD_POLL_TIMEOUT = int(getenv("SHARD_POLL_TIMEOUT", "30"))
+# Запускает ли процесс фоновые задачи (напоминания, удаление данных, сжатие файлов).
+# При нескольких репликах вебхука BOT_PRIMARY=1 должен быть ровно у одной,
+# у остальных — 0, иначе напоминания уйдут по разу от каждой реплики.
+BOT_PRIMARY = getenv("BOT_PRIMARY", "1") == "1"
+
+# Номер воркера задаётся супервизором; None — обычный однопроцессный запуск
+_SHARD_ENV = "BOT_SHARD_INDEX"
+
+
+def current_shard() -> Optional[int]:
+    value = os.getenv(_SHARD_ENV)
+    return int(value) if value is not None else None
+
+
+def is_primary_process() -> bool:
+    """Фоновые задачи (рассылки, очистка) запускаем только в одном процессе"""
+    return BOT_PRIMARY and current_shard() in (None, 0)
+
+
+def shard_for(update: Update, workers: int) -> int:
+    """Все апдейты одного пользователя попадают в один и тот же воркер"""
+    event = update.event
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id % workers
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return chat.id % workers
+    return update.update_id % workers
+
+
+# ---------------- воркер ----------------
+
+async def _worker_loop(index: int, inbox: mp.Queue, health: mp.Queue):
+    # bot.py уже выполнен здесь как __mp_main__, но без блока __main__ —
+    # бот и диспетчер воркер собирает сам, один раз
+    import bot as app
+
+    dp, tg = app.build_app()
+    loop = asyncio.get_running_loop()
+    stats = {"processed": 0, "errors": 0}
+    tasks = set()
+
+    async def feed(raw: dict):
+        try:
+            await dp.feed_raw_update(tg, raw)
+            stats["processed"] += 1
+        except Exception:
+            stats["errors"] += 1
+            logger.exception("Shard %s failed to process update", index)
+
+    async def report():
+        while True:
+            health.put({
+                "shard": index,
+                "pid": os.getpid(),
+                "processed": stats["processed"],
+                "errors": stats["errors"],
+                "in_flight": len(tasks),
+                "ts": time.time(),
+            })
+            await asyncio.sleep(SHARD_HEALTH_INTERVAL)
+
+    await dp.emit_startup(bot=tg, dispatcher=dp, bots=[tg])
+    reporter = asyncio.create_task(report())
+    try:
+        while True:
+            payload = await loop.run_in_executor(None, inbox.get)
+            if payload is None:
+                break
+            task = asyncio.create_task(feed(json.loads(payload)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks, timeout=30)
+    finally:
+        reporter.cancel()
+        await dp.emit_shutdown(bot=tg, dispatcher=dp, bots=[tg])
+        await tg.session.close()
+
+
+def _worker_main(index: int, inbox: mp.Queue, health: mp.Queue):
+    os.environ[_SHARD_ENV] = str(index)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_worker_loop(index, inbox, health))
+    except KeyboardInterrupt:
+        pass
+
+
+# ---------------- супервизор ----------------
+
+class ShardSupervisor:
+    """
+    Получает апдейты long polling'ом и раздаёт их N процессам-воркерам
+    по ``from_user.id``: порядок апдейтов одного пользователя сохраняется,
+    а PDF, dateparser и ORM используют все ядра. Воркеры присылают
+    heartbeat; упавший воркер перезапускается с той же очередью.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int = BOT_WORKERS):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self._ctx = mp.get_context("spawn")
+        self._health = self._ctx.Queue()
+        self._inboxes = [self._ctx.Queue() for _ in range(workers)]
+        self._procs = [None] * workers
+        self.last_health = {}
+
+    def _start_worker(self, index: int):
+        proc = self._ctx.Process(
+            target=_worker_main,
+            args=(index, self._inboxes[index], self._health),
+            name=f"bot-shard-{index}",
+            # Не daemon: воркер поднимает свой пул процессов для PDF (services/reports.py)
+            daemon=False,
+        )
+        proc.start()
+        self._procs[index] = proc
+        logger.info("Shard %s started (pid %s)", index, proc.pid)
+
+    async def _watch_health(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                report = await loop.run_in_executor(None, self._health.get, True, SHARD_HEALTH_INTERVAL)
+                self.last_health[report["shard"]] = report
+            except queue.Empty:
+                pass
+            now = time.time()
+            for index, proc in enumerate(self._procs):
+                if not proc.is_alive():
+                    logger.error("Shard %s died with code %s, restarting", index, proc.exitcode)
+                    self._start_worker(index)
+                    continue
+                report = self.last_health.get(index)
+                if report and now - report["ts"] > 3 * SHARD_HEALTH_INTERVAL:
+                    logger.warning("Shard %s has not reported for %.0f s", index, now - report["ts"])
+
+    async def run(self):
+        for index in range(self.workers):
+            self._start_worker(index)
+        watcher = asyncio.create_task(self._watch_health())
+        allowed = self.dp.resolve_used_update_types()
+        offset = None
+        try:
+            await self.bot.delete_webhook()
+            while True:
+                try:
+                    updates = await self.bot.get_updates(
+                        offset=offset, timeout=SHARD_POLL_TIMEOUT, allowed_updates=allowed
+                    )
+                except Exception:
+                    logger.exception("getUpdates failed, retrying")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    payload = update.model_dump_json(by_alias=True, exclude_none=True)
+                    self._inboxes[shard_for(update, self.workers)].put(payload)
+                    offset = update.update_id + 1
+        finally:
+            watcher.cancel()
+            for inbox in self._inboxes:
+                inbox.put(None)
+            for proc in self._procs:
+                if proc is not None:
+                    proc.join(timeout=30)
+                    if proc.is_alive():
+                        proc.terminate()
+            await self.bot.session.close()
+
+
+def run_sharded(dp: Dispatcher, bot: Bot, workers: int = BOT_WORKERS) -> None:
+    """Запуск в режиме супервизора с ``workers`` процессами-обработчиками"""
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(ShardSupervisor(dp, bot, workers).run())
+    except KeyboardInterrupt:
+        pass
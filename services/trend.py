@@ -0,0 +1,49 @@
+"""
+Динамика одного анализа: сводная статистика по ряду значений.
+
+Ряд приходит из БД столбцами (даты и числа ``result_value``), и все
+величины считаются встроенными функциями над этими столбцами — min/max,
+``fsum`` и ``map(mul, ...)`` для наклона, без цикла по записям в Python.
+"""
+from dataclasses import dataclass
+from itertools import repeat
+from math import fsum
+from operator import mul, sub
+from typing import Optional, Sequence
+
+from services.reference import in_range
+
+
+@dataclass(frozen=True)
+class TrendStats:
+    count: int
+    min: float
+    max: float
+    mean: float
+    slope: Optional[float]  # изменение за 30 дней (МНК); None — все точки в один день
+
+
+def series_stats(days: Sequence[int], values: Sequence[float]) -> TrendStats:
+    """``days`` — даты как ``date.toordinal()``, по возрастанию"""
+    n = len(values)
+    xs = days
+    slope = None
+    if n > 1 and xs[0] != xs[-1]:
+        dx = list(map(sub, xs, repeat(fsum(xs) / n)))
+        slope = fsum(map(mul, dx, values)) / fsum(map(mul, dx, dx)) * 30
+    return TrendStats(n, min(values), max(values), fsum(values) / n, slope)
+
+
+def trend_caption(name: str, units: str, stats: TrendStats, last: float, ref_min, ref_max) -> str:
+    units = units or ""
+    lines = [
+        f"<b>{name}</b> — {stats.count} измерений",
+        f"мин {stats.min:g} · макс {stats.max:g} · среднее {stats.mean:.2f} {units}",
+    ]
+    if stats.slope is not None:
+        arrow = "↗" if stats.slope > 0 else "↘" if stats.slope < 0 else "→"
+        lines.append(f"тренд {arrow} {stats.slope:+.2f} {units} в месяц")
+    status = in_range(last, ref_min, ref_max)
+    if status is not None:
+        lines.append("последнее значение " + ("🟢 в норме" if status else "🔴 вне нормы"))
+    return "\n".join(lines)
@@ -0,0 +1,141 @@
+"""
+Приём апдейтов вебхуком (aiohttp).
+
+Вебхук рассчитан на одну реплику. Апдейты одного пользователя
+обрабатываются по очереди блокировкой в памяти процесса
+(``SQLEventIsolation``), и две реплики могли бы одновременно обработать
+два апдейта одного пользователя — тогда последняя запись FSM затрёт
+предыдущую. Несколько реплик допустимы только за балансировщиком,
+который отправляет апдейты одного пользователя всегда в одну реплику;
+нагрузку по ядрам распределяет режим BOT_WORKERS. В таком случае
+фоновые задачи оставляют одной реплике: у остальных BOT_PRIMARY=0
+(services/sharding.py).
+"""
+import asyncio
+import logging
+from os import getenv
+from typing import Any, Dict
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from middlewares.metrics import metrics
+from middlewares.send_limiter import send_limiter
+from services.cold_files import cold_files
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = getenv("WEBHOOK_URL")                # внешний адрес, например https://bot.example.com
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET")          # проверка, что запрос пришёл от Telegram
+WEBAPP_HOST = getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(getenv("WEBAPP_PORT", "8080"))
+WEBHOOK_MAX_IN_FLIGHT = int(getenv("WEBHOOK_MAX_IN_FLIGHT", "100"))
+WEBHOOK_QUEUE_TIMEOUT = float(getenv("WEBHOOK_QUEUE_TIMEOUT", "5"))
+WEBHOOK_MAX_CONNECTIONS = int(getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_SET_ON_STARTUP = getenv("WEBHOOK_SET_ON_STARTUP", "1") == "1"
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Обработка апдейтов в фоне с ограничением числа одновременно выполняемых.
+
+    Когда все слоты заняты, запрос Telegram ждёт свободный слот не дольше
+    ``queue_timeout`` секунд, после чего получает 503 — Telegram повторит
+    доставку позже, а мы не копим бесконечную очередь задач в памяти.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        secret_token: str,
+        max_in_flight: int = WEBHOOK_MAX_IN_FLIGHT,
+        queue_timeout: float = WEBHOOK_QUEUE_TIMEOUT,
+        **data: Any,
+    ) -> None:
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self.rejected = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return web.Response(status=503, text="Busy")
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except Exception:
+            self._slots.release()
+            raise
+        task = asyncio.create_task(self._feed_and_release(bot, update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _feed_and_release(self, bot: Bot, update: Dict[str, Any]) -> None:
+        try:
+            await self._background_feed_update(bot=bot, update=update)
+        finally:
+            self._slots.release()
+
+    async def close(self) -> None:
+        # Даём начатым апдейтам завершиться, прежде чем закрыть сессию бота
+        if self._background_feed_update_tasks:
+            await asyncio.wait(self._background_feed_update_tasks, timeout=30)
+        await super().close()
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "rejected": self.rejected,
+        })
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.json_response(metrics.snapshot())
+
+    async def send_metrics(self, request: web.Request) -> web.Response:
+        return web.json_response(send_limiter.snapshot())
+
+    async def file_metrics(self, request: web.Request) -> web.Response:
+        return web.json_response(await cold_files.snapshot())
+
+
+async def _set_webhook(bot: Bot, dispatcher: Dispatcher) -> None:
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dispatcher.resolve_used_update_types(),
+    )
+
+
+def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    """Запуск бота в режиме вебхука на aiohttp (вместо long polling)"""
+    if not WEBHOOK_SECRET:
+        raise ValueError("WEBHOOK_SECRET is missing in .env file")
+
+    if WEBHOOK_SET_ON_STARTUP:
+        # setWebhook идемпотентен, повторный вызов при перезапуске безопасен
+        dp.startup.register(_set_webhook)
+
+    app = web.Application()
+    handler = BoundedRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET)
+    handler.register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/healthz", handler.health)
+    app.router.add_get("/metrics", handler.metrics)
+    app.router.add_get("/metrics/send", handler.send_metrics)
+    app.router.add_get("/metrics/files", handler.file_metrics)
+    setup_application(app, dp, bot=bot)
+
+    logger.info("Webhook server on %s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
@@ -7,6 +7,15 @@ class AddAnalysis(StatesGroup):
     select_variant = State()
     result = State()
 
+class BulkAddAnalysis(StatesGroup):
+    date = State()
+    lines = State()
+    confirm = State()
+
+class ImportLabPdf(StatesGroup):
+    date = State()
+    file = State()
+
 class DeleteFlow(StatesGroup):
     waiting_for_group = State()
     waiting_for_name = State()